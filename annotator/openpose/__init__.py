@@ -1,11 +1,13 @@
 import os
 os.environ["KMP_DUPLICATE_LIB_OK"]="TRUE"
 
+import cv2
 import torch
 import numpy as np
 from . import util
 from .body import Body
 from .hand import Hand
+from .skeleton import draw_skeletons, pose_keypoints
 from annotator.util import annotator_ckpts_path
 
 
@@ -27,18 +29,53 @@ class OpenposeDetector:
         self.hand_estimation = Hand(hand_modelpath)
 
     def __call__(self, oriImg, hand=False):
-        oriImg = oriImg[:, :, ::-1].copy()
+        return self.batch_call([oriImg], hand=hand)[0]
+
+    def batch_call(self, frames, hand=False, size=None):
+        # body poses of all frames in one batched pass, returns a (canvas, pose) pair per frame
+        # with `size` (H, W) the body pose maps are drawn straight at that resolution
+        poses = self.batch_detect(frames)
+        frames = [frame[:, :, ::-1].copy() for frame in frames]
+        if size is None or hand:
+            hand_peaks = self.batch_hands(frames, poses) if hand else [None] * len(frames)
+            results = [self._render(oriImg, candidate, subset, peaks)
+                       for oriImg, (candidate, subset), peaks in zip(frames, poses, hand_peaks)]
+            if size is not None:
+                results = [(cv2.resize(canvas, (size[1], size[0]), interpolation=cv2.INTER_NEAREST), pose)
+                           for canvas, pose in results]
+            return results
+        results = []
+        for oriImg, (candidate, subset) in zip(frames, poses):
+            canvas = draw_skeletons([pose_keypoints(candidate, subset)], size, oriImg.shape[:2])[0]
+            results.append((canvas, dict(candidate=candidate.tolist(), subset=subset.tolist())))
+        return results
+
+    def batch_detect(self, frames):
+        # (candidate, subset) body keypoints of every frame, without rendering anything
+        frames = [frame[:, :, ::-1].copy() for frame in frames]
         with torch.no_grad():
-            candidate, subset = self.body_estimation(oriImg)
-            canvas = np.zeros_like(oriImg)
-            canvas = util.draw_bodypose(canvas, candidate, subset)
-            if hand:
-                hands_list = util.handDetect(candidate, subset, oriImg)
-                all_hand_peaks = []
-                for x, y, w, is_left in hands_list:
-                    peaks = self.hand_estimation(oriImg[y:y+w, x:x+w, :])
-                    peaks[:, 0] = np.where(peaks[:, 0] == 0, peaks[:, 0], peaks[:, 0] + x)
-                    peaks[:, 1] = np.where(peaks[:, 1] == 0, peaks[:, 1], peaks[:, 1] + y)
-                    all_hand_peaks.append(peaks)
-                canvas = util.draw_handpose(canvas, all_hand_peaks)
-            return canvas, dict(candidate=candidate.tolist(), subset=subset.tolist())
+            return self.body_estimation.batch_call(frames)
+
+    def batch_hands(self, frames, poses):
+        # hand keypoints in frame coordinates, a list per frame; the crops of all frames are estimated together
+        boxes = [util.handDetect(candidate, subset, oriImg) for oriImg, (candidate, subset) in zip(frames, poses)]
+        crops = [oriImg[y:y+w, x:x+w, :] for oriImg, frame_boxes in zip(frames, boxes) for x, y, w, _ in frame_boxes]
+        with torch.no_grad():
+            crop_peaks = iter(self.hand_estimation.batch_call(crops))
+        all_hand_peaks = []
+        for frame_boxes in boxes:
+            frame_peaks = []
+            for x, y, w, is_left in frame_boxes:
+                peaks = next(crop_peaks)
+                peaks[:, 0] = np.where(peaks[:, 0] == 0, peaks[:, 0], peaks[:, 0] + x)
+                peaks[:, 1] = np.where(peaks[:, 1] == 0, peaks[:, 1], peaks[:, 1] + y)
+                frame_peaks.append(peaks)
+            all_hand_peaks.append(frame_peaks)
+        return all_hand_peaks
+
+    def _render(self, oriImg, candidate, subset, all_hand_peaks=None):
+        canvas = np.zeros_like(oriImg)
+        canvas = util.draw_bodypose(canvas, candidate, subset)
+        if all_hand_peaks is not None:
+            canvas = util.draw_handpose(canvas, all_hand_peaks)
+        return canvas, dict(candidate=candidate.tolist(), subset=subset.tolist())
@@ -0,0 +1,264 @@
+import numpy as np
+
+from .peaks import peaks_to_array
+
+# find connection in the specified sequence, center 29 is in the position 15
+limbSeq = [[2, 3], [2, 6], [3, 4], [4, 5], [6, 7], [7, 8], [2, 9], [9, 10], \
+           [10, 11], [2, 12], [12, 13], [13, 14], [2, 1], [1, 15], [15, 17], \
+           [1, 16], [16, 18], [3, 17], [6, 18]]
+# the middle joints heatmap correpondence
+mapIdx = [[31, 32], [39, 40], [33, 34], [35, 36], [41, 42], [43, 44], [19, 20], [21, 22], \
+          [23, 24], [25, 26], [27, 28], [29, 30], [47, 48], [49, 50], [53, 54], [51, 52], \
+          [55, 56], [37, 38], [45, 46]]
+
+
+def score_limb(candA, candB, score_mid, height, mid_num=10, thre2=0.05):
+    """
+    Scores every (candA, candB) pair of one limb at once and greedily keeps the best disjoint pairs.
+    candA, candB: (n, 4) arrays of x, y, score, id. score_mid: (H, W, 2) PAF of the limb.
+    Returns the connections (m, 5): id A, id B, score, index in candA, index in candB.
+    """
+    nA, nB = len(candA), len(candB)
+    vec = candB[None, :, :2] - candA[:, None, :2]  # nA nB 2
+    norm = np.maximum(0.001, np.sqrt(vec[..., 0] * vec[..., 0] + vec[..., 1] * vec[..., 1]))
+    vec = vec / norm[..., None]
+
+    # mid_num sample points on every segment, looked up with a single gather per PAF channel
+    startend = np.linspace(
+        np.broadcast_to(candA[:, None, :2], (nA, nB, 2)), np.broadcast_to(candB[None, :, :2], (nA, nB, 2)),
+        num=mid_num, axis=2,
+    )  # nA nB mid_num 2
+    xs = np.round(startend[..., 0]).astype(int)
+    ys = np.round(startend[..., 1]).astype(int)
+    score_midpts = score_mid[ys, xs, 0] * vec[..., None, 0] + score_mid[ys, xs, 1] * vec[..., None, 1]
+
+    # summed left to right, like the builtin `sum`, so that scores are bit identical to the per pair loop
+    total = 0
+    for i in range(mid_num):
+        total = total + score_midpts[..., i]
+    score_with_dist_prior = total / mid_num + np.minimum(0.5 * height / norm - 1, 0)
+    criterion1 = np.count_nonzero(score_midpts > thre2, axis=-1) > 0.8 * mid_num
+    criterion2 = score_with_dist_prior > 0
+
+    i, j = np.nonzero(criterion1 & criterion2)  # row major, the order of the per pair loop
+    scores = score_with_dist_prior[i, j]
+    order = np.argsort(-scores, kind="stable")
+
+    max_connections = min(nA, nB)
+    connection = np.zeros((max_connections, 5))
+    used_a = np.zeros(nA, dtype=bool)
+    used_b = np.zeros(nB, dtype=bool)
+    count = 0
+    for c in order:
+        a, b = i[c], j[c]
+        if used_a[a] or used_b[b]:
+            continue
+        used_a[a] = used_b[b] = True
+        connection[count] = (candA[a, 3], candB[b, 3], scores[c], a, b)
+        count += 1
+        if count >= max_connections:
+            break
+    return connection[:count]
+
+
+def connect_limbs(all_peaks, paf_avg, height, mid_num=10, thre2=0.05):
+    # connections of every limb; `special_k` lists the limbs missing one of their parts
+    connection_all = []
+    special_k = []
+    for k in range(len(mapIdx)):
+        candA = peaks_to_array(all_peaks[limbSeq[k][0] - 1])
+        candB = peaks_to_array(all_peaks[limbSeq[k][1] - 1])
+        if len(candA) != 0 and len(candB) != 0:
+            score_mid = paf_avg[:, :, [x - 19 for x in mapIdx[k]]]
+            connection_all.append(score_limb(candA, candB, score_mid, height, mid_num, thre2))
+        else:
+            special_k.append(k)
+            connection_all.append([])
+    return connection_all, special_k
+
+
+def assemble_people(candidate, connection_all, special_k):
+    """
+    Groups the limb connections into people, on a preallocated subset array.
+    Returns subset: n*20 array, 0-17 is the index in candidate, 18 is the total score, 19 is the total parts
+    """
+    capacity = sum(len(connection_all[k]) for k in range(len(mapIdx)) if k not in special_k)
+    subset = -1 * np.ones((capacity, 20))
+    count = 0
+
+    for k in range(len(mapIdx)):
+        if k in special_k:
+            continue
+        partAs = connection_all[k][:, 0]
+        partBs = connection_all[k][:, 1]
+        indexA, indexB = np.array(limbSeq[k]) - 1
+
+        for i in range(len(connection_all[k])):
+            rows = subset[:count]
+            subset_idx = np.nonzero((rows[:, indexA] == partAs[i]) | (rows[:, indexB] == partBs[i]))[0][:2]
+            found = len(subset_idx)
+
+            if found == 1:
+                j = subset_idx[0]
+                if subset[j][indexB] != partBs[i]:
+                    subset[j][indexB] = partBs[i]
+                    subset[j][-1] += 1
+                    subset[j][-2] += candidate[partBs[i].astype(int), 2] + connection_all[k][i][2]
+            elif found == 2:  # if found 2 and disjoint, merge them
+                j1, j2 = subset_idx
+                membership = ((subset[j1] >= 0).astype(int) + (subset[j2] >= 0).astype(int))[:-2]
+                if len(np.nonzero(membership == 2)[0]) == 0:  # merge
+                    subset[j1][:-2] += (subset[j2][:-2] + 1)
+                    subset[j1][-2:] += subset[j2][-2:]
+                    subset[j1][-2] += connection_all[k][i][2]
+                    # drop row j2, keeping the order of the remaining people
+                    subset[j2:count - 1] = subset[j2 + 1:count]
+                    count -= 1
+                else:  # as like found == 1
+                    subset[j1][indexB] = partBs[i]
+                    subset[j1][-1] += 1
+                    subset[j1][-2] += candidate[partBs[i].astype(int), 2] + connection_all[k][i][2]
+
+            # if find no partA in the subset, create a new subset
+            elif not found and k < 17:
+                row = subset[count]
+                row[:] = -1
+                row[indexA] = partAs[i]
+                row[indexB] = partBs[i]
+                row[-1] = 2
+                row[-2] = sum(candidate[connection_all[k][i, :2].astype(int), 2]) + connection_all[k][i][2]
+                count += 1
+
+    # delete some rows of subset which has few parts occur
+    subset = subset[:count]
+    keep = ~((subset[:, -1] < 4) | (subset[:, -2] / subset[:, -1] < 0.4))
+    return subset[keep]
+
+
+if __name__ == "__main__":
+    # compares candidate/subset with the previous per pair loops on the bundled motion clips:
+    # python -m annotator.openpose.assembly
+    import glob
+    import math
+    import os
+
+    import decord
+
+    from annotator.util import annotator_ckpts_path
+    from .body import Body
+
+    def legacy_connect_and_assemble(all_peaks, paf_avg, height):
+        thre2 = 0.05
+        connection_all = []
+        special_k = []
+        mid_num = 10
+
+        for k in range(len(mapIdx)):
+            score_mid = paf_avg[:, :, [x - 19 for x in mapIdx[k]]]
+            candA = all_peaks[limbSeq[k][0] - 1]
+            candB = all_peaks[limbSeq[k][1] - 1]
+            nA = len(candA)
+            nB = len(candB)
+            if (nA != 0 and nB != 0):
+                connection_candidate = []
+                for i in range(nA):
+                    for j in range(nB):
+                        vec = np.subtract(candB[j][:2], candA[i][:2])
+                        norm = math.sqrt(vec[0] * vec[0] + vec[1] * vec[1])
+                        norm = max(0.001, norm)
+                        vec = np.divide(vec, norm)
+
+                        startend = list(zip(np.linspace(candA[i][0], candB[j][0], num=mid_num), \
+                                            np.linspace(candA[i][1], candB[j][1], num=mid_num)))
+
+                        vec_x = np.array([score_mid[int(round(startend[I][1])), int(round(startend[I][0])), 0] \
+                                          for I in range(len(startend))])
+                        vec_y = np.array([score_mid[int(round(startend[I][1])), int(round(startend[I][0])), 1] \
+                                          for I in range(len(startend))])
+
+                        score_midpts = np.multiply(vec_x, vec[0]) + np.multiply(vec_y, vec[1])
+                        score_with_dist_prior = sum(score_midpts) / len(score_midpts) + min(
+                            0.5 * height / norm - 1, 0)
+                        criterion1 = len(np.nonzero(score_midpts > thre2)[0]) > 0.8 * len(score_midpts)
+                        criterion2 = score_with_dist_prior > 0
+                        if criterion1 and criterion2:
+                            connection_candidate.append(
+                                [i, j, score_with_dist_prior, score_with_dist_prior + candA[i][2] + candB[j][2]])
+
+                connection_candidate = sorted(connection_candidate, key=lambda x: x[2], reverse=True)
+                connection = np.zeros((0, 5))
+                for c in range(len(connection_candidate)):
+                    i, j, s = connection_candidate[c][0:3]
+                    if (i not in connection[:, 3] and j not in connection[:, 4]):
+                        connection = np.vstack([connection, [candA[i][3], candB[j][3], s, i, j]])
+                        if (len(connection) >= min(nA, nB)):
+                            break
+
+                connection_all.append(connection)
+            else:
+                special_k.append(k)
+                connection_all.append([])
+
+        subset = -1 * np.ones((0, 20))
+        candidate = np.array([item for sublist in all_peaks for item in sublist])
+
+        for k in range(len(mapIdx)):
+            if k not in special_k:
+                partAs = connection_all[k][:, 0]
+                partBs = connection_all[k][:, 1]
+                indexA, indexB = np.array(limbSeq[k]) - 1
+
+                for i in range(len(connection_all[k])):
+                    found = 0
+                    subset_idx = [-1, -1]
+                    for j in range(len(subset)):
+                        if subset[j][indexA] == partAs[i] or subset[j][indexB] == partBs[i]:
+                            subset_idx[found] = j
+                            found += 1
+
+                    if found == 1:
+                        j = subset_idx[0]
+                        if subset[j][indexB] != partBs[i]:
+                            subset[j][indexB] = partBs[i]
+                            subset[j][-1] += 1
+                            subset[j][-2] += candidate[partBs[i].astype(int), 2] + connection_all[k][i][2]
+                    elif found == 2:
+                        j1, j2 = subset_idx
+                        membership = ((subset[j1] >= 0).astype(int) + (subset[j2] >= 0).astype(int))[:-2]
+                        if len(np.nonzero(membership == 2)[0]) == 0:
+                            subset[j1][:-2] += (subset[j2][:-2] + 1)
+                            subset[j1][-2:] += subset[j2][-2:]
+                            subset[j1][-2] += connection_all[k][i][2]
+                            subset = np.delete(subset, j2, 0)
+                        else:
+                            subset[j1][indexB] = partBs[i]
+                            subset[j1][-1] += 1
+                            subset[j1][-2] += candidate[partBs[i].astype(int), 2] + connection_all[k][i][2]
+                    elif not found and k < 17:
+                        row = -1 * np.ones(20)
+                        row[indexA] = partAs[i]
+                        row[indexB] = partBs[i]
+                        row[-1] = 2
+                        row[-2] = sum(candidate[connection_all[k][i, :2].astype(int), 2]) + connection_all[k][i][2]
+                        subset = np.vstack([subset, row])
+        deleteIdx = []
+        for i in range(len(subset)):
+            if subset[i][-1] < 4 or subset[i][-2] / subset[i][-1] < 0.4:
+                deleteIdx.append(i)
+        subset = np.delete(subset, deleteIdx, axis=0)
+        return candidate, subset
+
+    body_estimation = Body(os.path.join(annotator_ckpts_path, "body_pose_model.pth"))
+    for video_path in sorted(glob.glob("__assets__/*.mp4")):
+        vr = decord.VideoReader(video_path)
+        frames = [frame[:, :, ::-1].copy() for frame in vr.get_batch(range(0, len(vr), 4)).asnumpy()]
+        for start in range(0, len(frames), 8):
+            chunk = frames[start:start + 8]
+            heatmaps, pafs = body_estimation.heatmaps_and_pafs(chunk)
+            for frame, heatmap_avg, paf_avg in zip(chunk, heatmaps.astype(np.float64), pafs.astype(np.float64)):
+                all_peaks = [[tuple(peak) for peak in peaks.tolist()] for peaks in body_estimation.find_peaks(heatmap_avg)]
+                expected_candidate, expected_subset = legacy_connect_and_assemble(all_peaks, paf_avg, frame.shape[0])
+                candidate, subset = body_estimation.parse(frame.shape[0], heatmap_avg, paf_avg)
+                assert np.array_equal(expected_candidate.reshape(-1, 4), candidate), video_path
+                assert np.array_equal(expected_subset, subset), video_path
+        print(f"{video_path}: {len(frames)} frames match")
@@ -7,10 +7,11 @@ from scipy.ndimage.filters import gaussian_filter
 import matplotlib.pyplot as plt
 import matplotlib
 import torch
-from skimage.measure import label
 
 from .model import handpose_model
 from . import util
+from .body import upsample_maps
+from .peaks import find_region_peaks
 
 class Hand(object):
     def __init__(self, model_path):
@@ -23,56 +24,71 @@ class Hand(object):
         self.model.eval()
 
     def __call__(self, oriImg):
+        return self.batch_call([oriImg])[0]
+
+    def batch_call(self, crops, batch_size=16):
+        """
+        Hand keypoints of every crop (B,G,R order), returns a (21, 2) x, y array per crop with [0, 0] for parts
+        that were not found. The crops of all hands of all frames go through each scale of the pyramid
+        together: crops with the same padded size share micro-batches of `batch_size`, and heatmaps with the
+        same padding and crop size are upsampled together.
+        """
+        thre = 0.05
+        heatmaps = self.heatmaps(crops, batch_size)
+        results = []
+        for heatmap_avg in heatmaps:
+            # strongest region of every part, all 21 parts at once; [0, 0] for parts that were not found
+            peaks = find_region_peaks(heatmap_avg[:, :, :21], thre)
+            results.append(np.stack([peaks["x"], peaks["y"]], axis=1))
+        return results
+
+    def heatmaps(self, crops, batch_size=16):
         scale_search = [0.5, 1.0, 1.5, 2.0]
         # scale_search = [0.5]
         boxsize = 368
         stride = 8
         padValue = 128
-        thre = 0.05
-        multiplier = [x * boxsize / oriImg.shape[0] for x in scale_search]
-        heatmap_avg = np.zeros((oriImg.shape[0], oriImg.shape[1], 22))
-        # paf_avg = np.zeros((oriImg.shape[0], oriImg.shape[1], 38))
+        heatmap_avg = [np.zeros((crop.shape[0], crop.shape[1], 22)) for crop in crops]
 
-        for m in range(len(multiplier)):
-            scale = multiplier[m]
-            imageToTest = cv2.resize(oriImg, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
-            imageToTest_padded, pad = util.padRightDownCorner(imageToTest, stride, padValue)
-            im = np.transpose(np.float32(imageToTest_padded[:, :, :, np.newaxis]), (3, 2, 0, 1)) / 256 - 0.5
-            im = np.ascontiguousarray(im)
+        for scale in scale_search:
+            padded, pads = [], []
+            for crop in crops:
+                multiplier = scale * boxsize / crop.shape[0]
+                imageToTest = cv2.resize(crop, (0, 0), fx=multiplier, fy=multiplier, interpolation=cv2.INTER_CUBIC)
+                imageToTest_padded, pad = util.padRightDownCorner(imageToTest, stride, padValue)
+                padded.append(imageToTest_padded)
+                pads.append(pad)
 
-            data = torch.from_numpy(im).float()
-            if torch.cuda.is_available():
-                data = data.cuda()
-            # data = data.permute([2, 0, 1]).unsqueeze(0).float()
-            with torch.no_grad():
-                output = self.model(data).cpu().numpy()
-                # output = self.model(data).numpy()q
+            outputs = [None] * len(crops)
+            for indices in _group(range(len(crops)), lambda i: padded[i].shape):
+                im = np.transpose(np.float32(np.stack([padded[i] for i in indices])), (0, 3, 1, 2)) / 256 - 0.5
+                im = np.ascontiguousarray(im)
+                for start in range(0, len(indices), batch_size):
+                    data = torch.from_numpy(im[start:start + batch_size]).float()
+                    if torch.cuda.is_available():
+                        data = data.cuda()
+                    with torch.no_grad():
+                        output = self.model(data).cpu().numpy()
+                    for i, heatmap in zip(indices[start:start + batch_size], output):
+                        outputs[i] = heatmap
 
             # extract outputs, resize, and remove padding
-            heatmap = np.transpose(np.squeeze(output), (1, 2, 0))  # output 1 is heatmaps
-            heatmap = cv2.resize(heatmap, (0, 0), fx=stride, fy=stride, interpolation=cv2.INTER_CUBIC)
-            heatmap = heatmap[:imageToTest_padded.shape[0] - pad[2], :imageToTest_padded.shape[1] - pad[3], :]
-            heatmap = cv2.resize(heatmap, (oriImg.shape[1], oriImg.shape[0]), interpolation=cv2.INTER_CUBIC)
+            for indices in _group(range(len(crops)), lambda i: (padded[i].shape, tuple(pads[i]), crops[i].shape)):
+                first = indices[0]
+                heatmap = upsample_maps(
+                    np.stack([outputs[i] for i in indices]), stride, padded[first].shape, pads[first], crops[first].shape
+                )
+                for i, upsampled in zip(indices, heatmap):
+                    heatmap_avg[i] += upsampled / len(scale_search)
+        return heatmap_avg
 
-            heatmap_avg += heatmap / len(multiplier)
 
-        all_peaks = []
-        for part in range(21):
-            map_ori = heatmap_avg[:, :, part]
-            one_heatmap = gaussian_filter(map_ori, sigma=3)
-            binary = np.ascontiguousarray(one_heatmap > thre, dtype=np.uint8)
-            # 全部小于阈值
-            if np.sum(binary) == 0:
-                all_peaks.append([0, 0])
-                continue
-            label_img, label_numbers = label(binary, return_num=True, connectivity=binary.ndim)
-            max_index = np.argmax([np.sum(map_ori[label_img == i]) for i in range(1, label_numbers + 1)]) + 1
-            label_img[label_img != max_index] = 0
-            map_ori[label_img == 0] = 0
+def _group(indices, key):
+    groups = {}
+    for i in indices:
+        groups.setdefault(key(i), []).append(i)
+    return list(groups.values())
 
-            y, x = util.npmax(map_ori)
-            all_peaks.append([x, y])
-        return np.array(all_peaks)
 
 if __name__ == "__main__":
     hand_estimation = Hand('../model/hand_pose_model.pth')
@@ -81,6 +97,17 @@ if __name__ == "__main__":
     test_image = '../images/hand.jpg'
     oriImg = cv2.imread(test_image)  # B,G,R order
     peaks = hand_estimation(oriImg)
+
+    # one crop at a time vs all crops of a 16 frame clip together
+    crops = [oriImg] * 16
+    start = time.time()
+    single = [hand_estimation.batch_call([crop])[0] for crop in crops]
+    print(f"per crop: {time.time() - start:.2f}s")
+    start = time.time()
+    batched = hand_estimation.batch_call(crops)
+    print(f"batch_call: {time.time() - start:.2f}s")
+    for p1, p2 in zip(single, batched):
+        assert np.array_equal(p1, p2)
     canvas = util.draw_handpose(oriImg, peaks, True)
     cv2.imshow('', canvas)
     cv2.waitKey(0)
\ No newline at end of file
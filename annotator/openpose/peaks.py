@@ -0,0 +1,136 @@
+import numpy as np
+from numpy.lib.recfunctions import structured_to_unstructured
+from scipy import ndimage
+
+# one detected keypoint; `id` numbers the peaks of all parts of a frame consecutively
+PEAK_DTYPE = np.dtype([("x", np.int64), ("y", np.int64), ("score", np.float64), ("id", np.int64)])
+
+# 4-neighbourhood within a channel, channels never touch each other
+_CROSS = ndimage.generate_binary_structure(2, 1)[:, :, None]
+# 8-neighbourhood within a channel, like skimage's label(connectivity=2)
+_SQUARE = np.pad(np.ones((3, 3, 1), dtype=bool), ((0, 0), (0, 0), (1, 1)))
+
+
+def smooth_maps(maps, sigma=3):
+    # (H, W, C) maps, every channel filtered on its own; identical to calling gaussian_filter per channel
+    return ndimage.gaussian_filter(maps, sigma=(sigma, sigma, 0))
+
+
+def find_peaks(maps, threshold, sigma=3):
+    """
+    Local maxima above `threshold` of every channel of the smoothed (H, W, C) `maps`, in one pass.
+    Returns a list with a PEAK_DTYPE array per channel, peaks in row-major order within a channel and
+    numbered across channels.
+    """
+    smoothed = smooth_maps(maps, sigma)
+    # a peak is at least as large as its 4 neighbours, the border counting as 0
+    local_max = ndimage.maximum_filter(smoothed, footprint=_CROSS, mode="constant", cval=0) == smoothed
+    part, y, x = np.nonzero((local_max & (smoothed > threshold)).transpose(2, 0, 1))
+
+    peaks = np.empty(len(part), dtype=PEAK_DTYPE)
+    peaks["x"] = x
+    peaks["y"] = y
+    peaks["score"] = maps[y, x, part]
+    peaks["id"] = np.arange(len(part))
+    counts = np.bincount(part, minlength=maps.shape[2])
+    return np.split(peaks, np.cumsum(counts)[:-1])
+
+
+def find_region_peaks(maps, threshold, sigma=3):
+    """
+    A single peak per channel of the (H, W, C) `maps`: the maximum of the raw map within the connected
+    region of the smoothed map above `threshold` whose raw values sum highest. Returns a PEAK_DTYPE array
+    of length C, with x = y = 0 and id -1 for channels without any such region.
+    """
+    num_parts = maps.shape[2]
+    smoothed = smooth_maps(maps, sigma)
+    labels, num_labels = ndimage.label(smoothed > threshold, structure=_SQUARE)
+    sums = np.bincount(labels.ravel(), weights=maps.ravel(), minlength=num_labels + 1)
+    label_part = np.zeros(num_labels + 1, dtype=np.int64)
+    label_part[labels.ravel()] = np.tile(np.arange(num_parts), maps.shape[0] * maps.shape[1])
+
+    # best region per channel, labels are in raster order so ties go to the first region like argmax
+    best = np.zeros(num_parts, dtype=np.int64)
+    best_sum = np.full(num_parts, -np.inf)
+    for region in range(1, num_labels + 1):
+        if sums[region] > best_sum[label_part[region]]:
+            best_sum[label_part[region]] = sums[region]
+            best[label_part[region]] = region
+
+    masked = np.where(labels == best, maps, 0).reshape(-1, num_parts)
+    flat = masked.argmax(axis=0)
+    peaks = np.zeros(num_parts, dtype=PEAK_DTYPE)
+    found = best > 0
+    peaks["y"] = np.where(found, flat // maps.shape[1], 0)
+    peaks["x"] = np.where(found, flat % maps.shape[1], 0)
+    peaks["score"] = np.where(found, masked[flat, np.arange(num_parts)], 0)
+    peaks["id"] = np.where(found, np.arange(num_parts), -1)
+    return peaks
+
+
+def peaks_to_array(peaks):
+    # PEAK_DTYPE array -> (n, 4) float array of x, y, score, id
+    return structured_to_unstructured(peaks, dtype=np.float64).reshape(-1, 4)
+
+
+if __name__ == "__main__":
+    # compares with the per channel loops on random maps and times both:
+    # python -m annotator.openpose.peaks
+    import time
+
+    from skimage.measure import label
+
+    def loop_find_peaks(maps, threshold):
+        all_peaks = []
+        peak_counter = 0
+        for part in range(maps.shape[2]):
+            map_ori = maps[:, :, part]
+            one_heatmap = ndimage.gaussian_filter(map_ori, sigma=3)
+            map_left = np.zeros(one_heatmap.shape)
+            map_left[1:, :] = one_heatmap[:-1, :]
+            map_right = np.zeros(one_heatmap.shape)
+            map_right[:-1, :] = one_heatmap[1:, :]
+            map_up = np.zeros(one_heatmap.shape)
+            map_up[:, 1:] = one_heatmap[:, :-1]
+            map_down = np.zeros(one_heatmap.shape)
+            map_down[:, :-1] = one_heatmap[:, 1:]
+            peaks_binary = np.logical_and.reduce(
+                (one_heatmap >= map_left, one_heatmap >= map_right, one_heatmap >= map_up, one_heatmap >= map_down, one_heatmap > threshold))
+            peaks = list(zip(np.nonzero(peaks_binary)[1], np.nonzero(peaks_binary)[0]))
+            all_peaks.append([(x, y, map_ori[y, x], peak_counter + i) for i, (x, y) in enumerate(peaks)])
+            peak_counter += len(peaks)
+        return all_peaks
+
+    def loop_find_region_peaks(maps, threshold):
+        all_peaks = []
+        for part in range(maps.shape[2]):
+            map_ori = maps[:, :, part].copy()
+            binary = np.ascontiguousarray(ndimage.gaussian_filter(map_ori, sigma=3) > threshold, dtype=np.uint8)
+            if np.sum(binary) == 0:
+                all_peaks.append([0, 0])
+                continue
+            label_img, label_numbers = label(binary, return_num=True, connectivity=binary.ndim)
+            max_index = np.argmax([np.sum(map_ori[label_img == i]) for i in range(1, label_numbers + 1)]) + 1
+            map_ori[label_img != max_index] = 0
+            y, x = np.unravel_index(map_ori.argmax(), map_ori.shape)
+            all_peaks.append([x, y])
+        return np.array(all_peaks)
+
+    rng = np.random.default_rng(0)
+    maps = ndimage.gaussian_filter(rng.random((368, 368, 21)), sigma=(6, 6, 0)) * 8 - 3.7
+
+    start = time.perf_counter()
+    expected = loop_find_peaks(maps[:, :, :18], 0.1)
+    loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    peaks = find_peaks(maps[:, :, :18], 0.1)
+    assert [[tuple(p) for p in part.tolist()] for part in peaks] == [[tuple(np.array(p).tolist()) for p in part] for part in expected]
+    print(f"find_peaks: {sum(map(len, peaks))} peaks, {loop_time * 1000:.1f} ms per part -> {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    start = time.perf_counter()
+    expected = loop_find_region_peaks(maps, 0.05)
+    loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    peaks = find_region_peaks(maps, 0.05)
+    assert np.array_equal(np.stack([peaks["x"], peaks["y"]], axis=1), expected)
+    print(f"find_region_peaks: {loop_time * 1000:.1f} ms per part -> {(time.perf_counter() - start) * 1000:.1f} ms")
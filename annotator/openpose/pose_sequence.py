@@ -0,0 +1,80 @@
+"""
+Keypoint-native pose sequences.
+
+A `PoseSequence` keeps the per-frame `candidate` / `subset` arrays of `OpenposeDetector` for a whole motion
+clip, together with the frame size and frame rate they were detected at, and is stored as one small `.npz`
+file. Pose maps and foreground masks are rendered from it on demand at any resolution and frame rate.
+"""
+import cv2
+import numpy as np
+
+from .skeleton import draw_skeletons, pose_keypoints
+
+
+class PoseSequence:
+    def __init__(self, candidates, subsets, size, fps):
+        # candidates: (n, 4) x, y, score, id per frame; subsets: (people, 20) per frame, see Body.parse
+        self.candidates = [np.asarray(c, dtype=np.float32).reshape(-1, 4) for c in candidates]
+        self.subsets = [np.asarray(s, dtype=np.float32).reshape(-1, 20) for s in subsets]
+        self.size = tuple(int(x) for x in size)
+        self.fps = float(fps)
+
+    def __len__(self):
+        return len(self.candidates)
+
+    @classmethod
+    def from_detections(cls, poses, size, fps):
+        # `poses`: the pose dicts returned by OpenposeDetector for every frame of `size` (H, W)
+        return cls([pose["candidate"] for pose in poses], [pose["subset"] for pose in poses], size, fps)
+
+    def save(self, path):
+        # all frames concatenated, with per-frame row counts
+        np.savez_compressed(
+            path,
+            candidates=np.concatenate(self.candidates) if len(self) else np.zeros((0, 4), np.float32),
+            subsets=np.concatenate(self.subsets) if len(self) else np.zeros((0, 20), np.float32),
+            candidate_counts=np.array([len(c) for c in self.candidates], dtype=np.int32),
+            subset_counts=np.array([len(s) for s in self.subsets], dtype=np.int32),
+            size=np.array(self.size, dtype=np.int32),
+            fps=np.array(self.fps),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            candidates = np.split(data["candidates"], np.cumsum(data["candidate_counts"])[:-1])
+            subsets = np.split(data["subsets"], np.cumsum(data["subset_counts"])[:-1])
+            if len(data["candidate_counts"]) == 0:
+                candidates, subsets = [], []
+            return cls(candidates, subsets, tuple(data["size"]), float(data["fps"]))
+
+    def frame_indices(self, fps=None):
+        # frames shown at `fps`, each the latest detected frame at or before its timestamp
+        if fps is None or fps == self.fps:
+            return np.arange(len(self))
+        num_frames = int(len(self) / self.fps * fps)
+        return np.minimum((np.arange(num_frames) * self.fps / fps).astype(int), len(self) - 1)
+
+    def keypoints(self, fps=None):
+        # (people, 18, 2) x, y per frame in pixels of `self.size`, NaN for missing parts
+        return [pose_keypoints(self.candidates[i], self.subsets[i]) for i in self.frame_indices(fps)]
+
+    def render(self, size=None, fps=None):
+        # (f, H, W, 3) uint8 pose maps at `size` (H, W), the detection size by default
+        size = self.size if size is None else size
+        return draw_skeletons(self.keypoints(fps), size, source_size=self.size)
+
+    def control(self, size=None, fps=None):
+        # (f, 3, H, W) float32 in [0, 1], the layout of `pre_process_pose`
+        return (self.render(size, fps).astype(np.float32) / 255.0).transpose(0, 3, 1, 2)
+
+    def mask(self, size, fps=None, dilation=7):
+        """
+        (f, H, W) float32 foreground mask at `size`, e.g. the latent resolution: the rendered skeleton grown by
+        a `dilation` x `dilation` window. Matches thresholding the pose map, nearest-downsampling it and
+        thresholding its box blur at 0.01 like `get_mask_pose`, up to rasterizing directly at `size`.
+        """
+        maps = self.render(size, fps).max(axis=-1) > 0
+        kernel = np.ones((dilation, dilation), dtype=np.uint8)
+        masks = [cv2.dilate(m.astype(np.uint8), kernel) for m in maps]
+        return np.stack(masks).astype(np.float32) if masks else np.zeros((0, *size), np.float32)
@@ -0,0 +1,148 @@
+import math
+
+import cv2
+import numpy as np
+
+from .assembly import limbSeq
+
+colors = [[255, 0, 0], [255, 85, 0], [255, 170, 0], [255, 255, 0], [170, 255, 0], [85, 255, 0], [0, 255, 0], \
+          [0, 255, 85], [0, 255, 170], [0, 255, 255], [0, 170, 255], [0, 85, 255], [0, 0, 255], [85, 0, 255], \
+          [170, 0, 255], [255, 0, 255], [255, 0, 170], [255, 0, 85]]
+
+# every limb is blended over what is below it with this opacity
+LIMB_ALPHA = 0.6
+# limb colors premultiplied by their alpha
+_LIMB_COLORS = LIMB_ALPHA * np.array(colors[:17], dtype=np.float32)
+_LIMB_PARTS = np.array(limbSeq[:17]) - 1
+
+
+def pose_keypoints(candidate, subset):
+    # (people, 18, 2) x, y of the parts of every person, NaN where a part was not detected
+    keypoints = np.full((len(subset), 18, 2), np.nan)
+    index = subset[:, :18].astype(int)
+    found = index >= 0
+    keypoints[found] = candidate[index[found], :2]
+    return keypoints
+
+
+def draw_skeleton(canvas, keypoints, scale=(1.0, 1.0), stickwidth=4, radius=4):
+    """
+    Draws the (people, 18, 2) `keypoints`, multiplied by `scale` (x, y), on `canvas` like `draw_bodypose`.
+    Limbs are rasterized within their bounding boxes into a single premultiplied overlay and a single
+    transmittance map, and composited onto the canvas once; the result equals blending limb after limb up
+    to uint8 rounding.
+    """
+    scale = np.asarray(scale, dtype=np.float64)
+    for i in range(18):
+        for n in range(len(keypoints)):
+            x, y = keypoints[n, i] * scale
+            if np.isnan(x):
+                continue
+            cv2.circle(canvas, (int(x), int(y)), radius, colors[i], thickness=-1)
+
+    h, w = canvas.shape[:2]
+    overlay = None
+    for i in range(17):
+        for n in range(len(keypoints)):
+            points = keypoints[n, _LIMB_PARTS[i]] * scale
+            if np.isnan(points).any():
+                continue
+            if overlay is None:
+                overlay = np.zeros((h, w, 3), dtype=np.float32)
+                transmittance = np.ones((h, w, 1), dtype=np.float32)
+            X, Y = points[:, 0], points[:, 1]
+            length = ((Y[0] - Y[1]) ** 2 + (X[0] - X[1]) ** 2) ** 0.5
+            angle = math.degrees(math.atan2(Y[0] - Y[1], X[0] - X[1]))
+            polygon = cv2.ellipse2Poly((int(np.mean(X)), int(np.mean(Y))), (int(length / 2), stickwidth), int(angle), 0, 360, 1)
+
+            x0, y0 = np.maximum(polygon.min(axis=0), 0)
+            x1, y1 = np.minimum(polygon.max(axis=0) + 1, (w, h))
+            if x0 >= x1 or y0 >= y1:
+                continue
+            mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+            cv2.fillConvexPoly(mask, polygon - (x0, y0), 1)
+            mask = mask.astype(bool)
+            roi = overlay[y0:y1, x0:x1]
+            roi[mask] = roi[mask] * (1 - LIMB_ALPHA) + _LIMB_COLORS[i]
+            transmittance[y0:y1, x0:x1][mask] *= 1 - LIMB_ALPHA
+
+    if overlay is None:
+        return canvas
+    return np.clip(canvas * transmittance + overlay + 0.5, 0, 255).astype(np.uint8)
+
+
+def draw_skeletons(keypoints, size, source_size=None, stickwidth=4, radius=4):
+    """
+    Pose maps of a whole video: `keypoints` holds a (people, 18, 2) array per frame in pixels of
+    `source_size` (H, W), rendered on black (F, *size, 3) uint8 canvases of `size` (H, W). Stick width and
+    joint radius are scaled along with the keypoints, so the maps can be drawn straight at the resolution the
+    pipeline consumes instead of being resized afterwards.
+    """
+    height, width = size
+    source_size = size if source_size is None else source_size
+    scale = (width / source_size[1], height / source_size[0])
+    factor = min(scale)
+    stickwidth = max(1, int(round(stickwidth * factor)))
+    radius = max(1, int(round(radius * factor)))
+
+    canvases = np.zeros((len(keypoints), height, width, 3), dtype=np.uint8)
+    for canvas, frame_keypoints in zip(canvases, keypoints):
+        canvas[:] = draw_skeleton(canvas, frame_keypoints, scale, stickwidth, radius)
+    return canvases
+
+
+if __name__ == "__main__":
+    # compares with the per limb copy and blend of the previous draw_bodypose on a few synthetic people:
+    # python -m annotator.openpose.skeleton
+    import time
+
+    def blend_bodypose(canvas, candidate, subset):
+        stickwidth = 4
+        for i in range(18):
+            for n in range(len(subset)):
+                index = int(subset[n][i])
+                if index == -1:
+                    continue
+                x, y = candidate[index][0:2]
+                cv2.circle(canvas, (int(x), int(y)), 4, colors[i], thickness=-1)
+        for i in range(17):
+            for n in range(len(subset)):
+                index = subset[n][np.array(limbSeq[i]) - 1]
+                if -1 in index:
+                    continue
+                cur_canvas = canvas.copy()
+                Y = candidate[index.astype(int), 0]
+                X = candidate[index.astype(int), 1]
+                mX = np.mean(X)
+                mY = np.mean(Y)
+                length = ((X[0] - X[1]) ** 2 + (Y[0] - Y[1]) ** 2) ** 0.5
+                angle = math.degrees(math.atan2(X[0] - X[1], Y[0] - Y[1]))
+                polygon = cv2.ellipse2Poly((int(mY), int(mX)), (int(length / 2), stickwidth), int(angle), 0, 360, 1)
+                cv2.fillConvexPoly(cur_canvas, polygon, colors[i])
+                canvas = cv2.addWeighted(canvas, 0.4, cur_canvas, 0.6, 0)
+        return canvas
+
+    rng = np.random.default_rng(0)
+    num_frames, people = 16, 3
+    candidates, subsets = [], []
+    for _ in range(num_frames):
+        candidate = np.concatenate(
+            [rng.uniform(0, 512, (people * 18, 2)), rng.random((people * 18, 1)), np.arange(people * 18)[:, None]], axis=1
+        )
+        subset = np.concatenate([np.arange(people * 18).reshape(people, 18), np.zeros((people, 2))], axis=1)
+        subset[:, :18][rng.random((people, 18)) < 0.1] = -1
+        candidates.append(candidate)
+        subsets.append(subset)
+
+    start = time.perf_counter()
+    expected = [blend_bodypose(np.zeros((512, 512, 3), np.uint8), c, s) for c, s in zip(candidates, subsets)]
+    blend_time = time.perf_counter() - start
+    start = time.perf_counter()
+    keypoints = [pose_keypoints(c, s) for c, s in zip(candidates, subsets)]
+    rendered = draw_skeletons(keypoints, (512, 512))
+    render_time = time.perf_counter() - start
+    diff = np.abs(rendered.astype(int) - np.stack(expected).astype(int)).max()
+    print(f"{num_frames} frames: {blend_time * 1000:.1f} ms -> {render_time * 1000:.1f} ms, max abs diff {diff}")
+    start = time.perf_counter()
+    draw_skeletons(keypoints, (256, 256), source_size=(512, 512))
+    print(f"at 256x256: {(time.perf_counter() - start) * 1000:.1f} ms")
@@ -0,0 +1,210 @@
+"""
+Keyframe pose detection for smooth motion clips.
+
+The body network runs on keyframes only, every `stride` frames, and the keypoints of the frames in between
+are interpolated between the people matched across the two surrounding keyframes. Whenever two keyframes do
+not agree (different people or visible parts, too much motion, low confidence) the middle frame of the
+segment is detected as well, recursively, so fast or ambiguous motion falls back to per-frame detection.
+"""
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from .skeleton import pose_keypoints
+
+
+@dataclass
+class TemporalPoseStats:
+    num_frames: int = 0
+    detector_calls: int = 0
+    seconds: float = 0.0
+
+    @property
+    def calls_saved(self):
+        return self.num_frames - self.detector_calls
+
+    def __str__(self):
+        return (f"{self.detector_calls}/{self.num_frames} frames detected ({self.calls_saved} calls saved), "
+                f"{self.num_frames / max(self.seconds, 1e-9):.1f} frames/s")
+
+
+def _person_scores(candidate, subset):
+    # (people, 18) part scores, NaN where a part is missing
+    scores = np.full((len(subset), 18), np.nan)
+    index = subset[:, :18].astype(int)
+    found = index >= 0
+    scores[found] = candidate[index[found], 2]
+    return scores
+
+
+def _match_people(keypoints_a, keypoints_b):
+    """
+    Greedy one to one matching by mean distance over the parts visible in both poses; returns a list of
+    (a, b, distance) or None if the number of people or the visible parts differ.
+    """
+    if len(keypoints_a) != len(keypoints_b):
+        return None
+    visible_a = ~np.isnan(keypoints_a[..., 0])
+    visible_b = ~np.isnan(keypoints_b[..., 0])
+    distances = np.linalg.norm(keypoints_a[:, None] - keypoints_b[None], axis=-1)  # a b parts
+    shared = visible_a[:, None] & visible_b[None]
+    counts = shared.sum(axis=-1)
+    costs = np.where(shared, distances, 0).sum(axis=-1) / np.maximum(counts, 1)
+    costs[counts == 0] = np.inf
+    pairs = []
+    for _ in range(len(keypoints_a)):
+        a, b = np.unravel_index(np.argmin(costs), costs.shape)
+        if not np.isfinite(costs[a, b]) or not np.array_equal(visible_a[a], visible_b[b]):
+            return None
+        pairs.append((a, b, costs[a, b]))
+        costs[a, :] = np.inf
+        costs[:, b] = np.inf
+    return pairs
+
+
+def _person_height(keypoints):
+    y = keypoints[:, 1]
+    y = y[~np.isnan(y)]
+    return max(y.max() - y.min(), 1.0) if len(y) else 1.0
+
+
+class KeyframePoseDetector:
+    """
+    detect_fn: maps a list of frames to a list of (candidate, subset), e.g. `OpenposeDetector.batch_detect`.
+    stride: frames between keyframes; 1 detects every frame.
+    refine: detect the middle frame of any segment whose keyframes disagree, until segments are consistent.
+    max_motion: largest mean keypoint displacement per frame, relative to the person's height, that is still
+        interpolated.
+    min_score: lowest mean part score of a person at a keyframe that is still interpolated.
+    """
+
+    def __init__(self, detect_fn, stride=4, refine=True, max_motion=0.05, min_score=0.3):
+        self.detect_fn = detect_fn
+        self.stride = max(1, int(stride))
+        self.refine = refine
+        self.max_motion = max_motion
+        self.min_score = min_score
+        self.stats = TemporalPoseStats()
+
+    def _consistent(self, pose_a, pose_b, frames_apart):
+        keypoints_a, keypoints_b = pose_keypoints(*pose_a), pose_keypoints(*pose_b)
+        pairs = _match_people(keypoints_a, keypoints_b)
+        if pairs is None:
+            return None
+        scores_a, scores_b = _person_scores(*pose_a), _person_scores(*pose_b)
+        for a, b, distance in pairs:
+            if distance > self.max_motion * frames_apart * _person_height(keypoints_a[a]):
+                return None
+            if min(np.nanmean(scores_a[a]), np.nanmean(scores_b[b])) < self.min_score:
+                return None
+        return [(a, b) for a, b, _ in pairs]
+
+    def __call__(self, frames):
+        """
+        Returns (candidate, subset) for every frame, like `detect_fn(frames)`; `self.stats` counts the calls.
+        """
+        start = time.perf_counter()
+        num_frames = len(frames)
+        poses = [None] * num_frames
+        detected = set()
+
+        def detect(indices):
+            indices = [i for i in indices if i not in detected]
+            for i, pose in zip(indices, self.detect_fn([frames[i] for i in indices]) if indices else []):
+                poses[i] = pose
+                detected.add(i)
+
+        keyframes = sorted(set(range(0, num_frames, self.stride)) | {num_frames - 1}) if num_frames else []
+        detect(keyframes)
+        segments = list(zip(keyframes[:-1], keyframes[1:]))
+        matches = {}
+        while segments:
+            pending = []
+            for a, b in segments:
+                if b - a < 2:
+                    continue
+                match = self._consistent(poses[a], poses[b], b - a)
+                if match is not None or not self.refine:
+                    matches[a, b] = match
+                else:
+                    pending.append((a, b))
+            # the middle frames of all inconsistent segments are detected in one batch
+            detect([(a + b) // 2 for a, b in pending])
+            segments = [s for a, b in pending for s in ((a, (a + b) // 2), ((a + b) // 2, b))]
+
+        for (a, b), match in matches.items():
+            for i in range(a + 1, b):
+                if match is None:
+                    # only without `refine`: hold the nearest keyframe
+                    poses[i] = poses[a] if i - a <= b - i else poses[b]
+                else:
+                    poses[i] = interpolate_pose(poses[a], poses[b], match, (i - a) / (b - a))
+
+        self.stats.num_frames += num_frames
+        self.stats.detector_calls += len(detected)
+        self.stats.seconds += time.perf_counter() - start
+        return poses
+
+
+def interpolate_pose(pose_a, pose_b, match, weight):
+    # (candidate, subset) in between two poses with matched people (a, b), at `weight` from pose_a to pose_b
+    (candidate_a, subset_a), (candidate_b, subset_b) = pose_a, pose_b
+    keypoints_a, keypoints_b = pose_keypoints(candidate_a, subset_a), pose_keypoints(candidate_b, subset_b)
+    scores_a, scores_b = _person_scores(candidate_a, subset_a), _person_scores(candidate_b, subset_b)
+
+    candidate, subset = [], -1 * np.ones((len(match), 20))
+    for n, (a, b) in enumerate(match):
+        keypoints = (1 - weight) * keypoints_a[a] + weight * keypoints_b[b]
+        scores = (1 - weight) * scores_a[a] + weight * scores_b[b]
+        for part in np.nonzero(~np.isnan(keypoints[:, 0]))[0]:
+            subset[n, part] = len(candidate)
+            candidate.append([keypoints[part, 0], keypoints[part, 1], scores[part], len(candidate)])
+        subset[n, 18] = (1 - weight) * subset_a[a, 18] + weight * subset_b[b, 18]
+        subset[n, 19] = subset_a[a, 19]
+    return np.array(candidate).reshape(-1, 4), subset
+
+
+def keypoint_error(poses, reference):
+    """
+    Mean distance in pixels between the parts of `poses` and of the per-frame `reference` detections, people
+    matched greedily, and the fraction of frames whose people or visible parts disagree.
+    """
+    distances, mismatched = [], 0
+    for pose, ref in zip(poses, reference):
+        keypoints, ref_keypoints = pose_keypoints(*pose), pose_keypoints(*ref)
+        pairs = _match_people(keypoints, ref_keypoints)
+        if pairs is None:
+            mismatched += 1
+            continue
+        for a, b, _ in pairs:
+            distances.extend(np.linalg.norm(keypoints[a] - ref_keypoints[b], axis=-1)[~np.isnan(keypoints[a, :, 0])])
+    return (float(np.mean(distances)) if distances else 0.0), mismatched / max(len(poses), 1)
+
+
+if __name__ == "__main__":
+    # throughput report against per-frame detection on the bundled clips (or the clips given as arguments):
+    # python -m annotator.openpose.temporal [video ...]
+    import glob
+    import sys
+
+    import decord
+
+    from . import OpenposeDetector
+
+    detector = OpenposeDetector()
+    paths = sys.argv[1:] or sorted(glob.glob("__assets__/walk_*.mp4") + glob.glob("__assets__/run.mp4"))
+    for path in paths:
+        vr = decord.VideoReader(path)
+        frames = list(vr.get_batch(range(len(vr))).asnumpy())
+        start = time.perf_counter()
+        reference = detector.batch_detect(frames)
+        full_seconds = time.perf_counter() - start
+        print(f"{path}: {len(frames)} frames, per-frame detection {len(frames) / full_seconds:.1f} frames/s")
+        for stride in (2, 4, 8):
+            for refine in (False, True):
+                keyframe_detector = KeyframePoseDetector(detector.batch_detect, stride=stride, refine=refine)
+                poses = keyframe_detector(frames)
+                error, mismatched = keypoint_error(poses, reference)
+                print(f"  stride={stride} refine={refine!s:5s}: {keyframe_detector.stats}, "
+                      f"keypoint error {error:.2f}px, {mismatched:.0%} frames with other people/parts")
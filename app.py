@@ -3,24 +3,10 @@ import gradio as gr
 from text_to_animation.model import ControlAnimationModel
 from webui.app_control_animation import create_demo as create_demo_animation
 import argparse
+import atexit
 import os
 import jax.numpy as jnp
 
-huggingspace_name = os.environ.get("SPACE_AUTHOR_NAME")
-on_huggingspace = huggingspace_name if huggingspace_name is not None else False
-
-model = ControlAnimationModel(dtype=jnp.float16)
-
-parser = argparse.ArgumentParser()
-parser.add_argument(
-    "--public_access",
-    action="store_true",
-    help="if enabled, the app can be access from a public url",
-    default=False,
-)
-args = parser.parse_args()
-
-
 title = """
 <div style="text-align: center; max-width: 1200px; margin: 20px auto;">
 <h1 style="font-weight: 900; font-size: 3rem; margin: 0rem">Control Animation</h1>
@@ -42,21 +28,143 @@ notice = """
 </p>
 """
 
-with gr.Blocks(css="style.css") as demo:
-    gr.Markdown(title)
-    gr.Markdown(description)
 
-    if on_huggingspace:
-        gr.HTML(notice)
-
-    with gr.Tab("Control Animation"):
-        create_demo_animation(model)
+if __name__ == "__main__":
+    # the pose detection workers are spawned processes, which import this module again
+    huggingspace_name = os.environ.get("SPACE_AUTHOR_NAME")
+    on_huggingspace = huggingspace_name if huggingspace_name is not None else False
 
-if on_huggingspace:
-    demo.queue(max_size=20)
-    demo.launch(debug=True)
-else:
-    _, _, link = demo.queue(api_open=False).launch(
-        file_directories=["temporal"], share=args.public_access, debug=True
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--public_access",
+        action="store_true",
+        help="if enabled, the app can be access from a public url",
+        default=False,
+    )
+    parser.add_argument(
+        "--warmup",
+        action="store_true",
+        help="if enabled, compile the generation functions for the served shape buckets at startup",
+        default=False,
+    )
+    parser.add_argument(
+        "--compilation_cache_dir",
+        type=str,
+        help="directory where compiled XLA executables are persisted across restarts",
+        default=os.environ.get("JAX_COMPILATION_CACHE_DIR"),
+    )
+    parser.add_argument(
+        "--prewarm_control_cache",
+        action="store_true",
+        help="if enabled, decode the bundled motion clips into the on-disk control map cache at startup",
+        default=False,
+    )
+    parser.add_argument(
+        "--prewarm_videos",
+        nargs="*",
+        help="with --prewarm_control_cache, further control videos to decode (and detect the poses of, with "
+        "--detect_poses) at startup",
+        default=[],
+    )
+    parser.add_argument(
+        "--no_frame_parallel",
+        action="store_true",
+        help="if enabled, every device generates the whole video instead of its share of the frames",
+        default=False,
+    )
+    parser.add_argument(
+        "--max_batch",
+        type=int,
+        help="if above 1, concurrent requests of the same shape bucket are generated together, up to this many",
+        default=1,
+    )
+    parser.add_argument(
+        "--max_batch_wait",
+        type=float,
+        help="seconds a request waits for others of its shape bucket before its batch is generated anyway",
+        default=0.5,
+    )
+    parser.add_argument(
+        "--detect_poses",
+        action="store_true",
+        help="if enabled, run the pose detector on control videos other than the bundled motions",
+        default=False,
+    )
+    parser.add_argument(
+        "--pose_workers",
+        type=int,
+        help="with --detect_poses, worker processes the pose detector runs in, 0 runs it in the app process",
+        default=0,
+    )
+    parser.add_argument(
+        "--pose_keyframe_stride",
+        type=int,
+        help="with --detect_poses, detect every n-th frame only and interpolate the poses in between",
+        default=1,
     )
-    print(link)
+    parser.add_argument(
+        "--no_pose_refine",
+        action="store_true",
+        help="if enabled, keyframes that disagree are interpolated anyway instead of detecting frames in between",
+        default=False,
+    )
+    parser.add_argument(
+        "--pose_max_motion",
+        type=float,
+        help="largest keypoint motion per frame, relative to the person's height, that is still interpolated",
+        default=0.05,
+    )
+    parser.add_argument(
+        "--pose_min_score",
+        type=float,
+        help="lowest mean part score of a person at a keyframe that is still interpolated",
+        default=0.3,
+    )
+    args = parser.parse_args()
+
+    model = ControlAnimationModel(dtype=jnp.float16, compilation_cache_dir=args.compilation_cache_dir)
+
+    # stops the batch scheduler and the pose detection workers
+    atexit.register(model.close)
+
+    if args.no_frame_parallel:
+        model.frame_parallel = False
+
+    if args.detect_poses:
+        model.enable_pose_detection(
+            num_workers=args.pose_workers,
+            keyframe_stride=args.pose_keyframe_stride,
+            refine=not args.no_pose_refine,
+            max_motion=args.pose_max_motion,
+            min_score=args.pose_min_score,
+        )
+
+    if args.prewarm_control_cache:
+        print(f"Control map cache size: {model.prewarm_control_cache(video_paths=args.prewarm_videos) / 2**20:.1f} MiB")
+
+    if args.max_batch > 1:
+        model.enable_batching(max_batch=args.max_batch, max_wait=args.max_batch_wait, report=True)
+
+    if args.warmup:
+        print(f"Warm shape buckets: {model.warmup(cache_dir=args.compilation_cache_dir)}")
+
+    with gr.Blocks(css="style.css") as demo:
+        gr.Markdown(title)
+        gr.Markdown(description)
+
+        if on_huggingspace:
+            gr.HTML(notice)
+
+        with gr.Tab("Control Animation"):
+            create_demo_animation(model)
+
+    # requests have to be in flight together to be batched; Gradio 3 has no per-event concurrency limit, the
+    # model lock runs initial frames, model swaps and video batches one at a time
+    if on_huggingspace:
+        demo.queue(concurrency_count=args.max_batch, max_size=20)
+        demo.launch(debug=True)
+    else:
+        _, _, link = demo.queue(concurrency_count=args.max_batch, api_open=False).launch(
+            file_directories=["temporal"], share=args.public_access, debug=True
+        )
+        print(link)
@@ -0,0 +1,210 @@
+"""
+Cross-request batching of video generation.
+
+`BatchScheduler` sits in front of a `ControlAnimationModel`: requests that fall into the same shape bucket (and
+so the same compiled `_p_generate` configuration) within `max_wait` seconds of the oldest waiting one are
+stacked along the batch axis and generated in one call, and every caller gets its own video back. Requests of
+other buckets keep waiting in arrival order for the next batch.
+"""
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Dict, Tuple
+
+from text_to_animation.models.token_merging_flax import MAX_MERGING_RATIO
+from text_to_animation.pipelines.compilation_cache import ShapeBucket
+
+
+@dataclass
+class BatchStats:
+    requests: int = 0
+    batches: int = 0
+    # requests repeated to fill a batch up to a compiled batch size
+    padding: int = 0
+    queueing_seconds: float = 0.0
+    max_queueing_seconds: float = 0.0
+
+    @property
+    def mean_batch_size(self):
+        return self.requests / max(self.batches, 1)
+
+    @property
+    def mean_queueing_seconds(self):
+        return self.queueing_seconds / max(self.requests, 1)
+
+    def __str__(self):
+        return (f"{self.requests} requests in {self.batches} batches (mean batch size {self.mean_batch_size:.2f}, "
+                f"{self.padding} padding), queueing delay mean {self.mean_queueing_seconds * 1000:.0f} ms, "
+                f"max {self.max_queueing_seconds * 1000:.0f} ms")
+
+
+@dataclass(eq=False)
+class _Request:
+    bucket: ShapeBucket
+    # (controlnet_video, prompt, n_prompt, seed)
+    args: Tuple
+    config: Dict[str, Any]
+    # the model's RegistryEntry when the request came in, a later `set_model` does not change its pipeline
+    entry: Any
+    arrival: float
+    future: Future = field(default_factory=Future)
+
+
+def _compiled_batch_size(batch_size, max_batch):
+    # the next power of two, at most `max_batch`
+    size = 1
+    while size < batch_size:
+        size *= 2
+    return min(size, max_batch)
+
+
+def compiled_batch_sizes(max_batch):
+    # every batch size of 2 or more the scheduler runs batched: 2, 4, ... and `max_batch`
+    return sorted({_compiled_batch_size(n, max_batch) for n in range(2, max_batch + 1)})
+
+
+class BatchScheduler:
+    """
+    model: a ControlAnimationModel, only called from the scheduler's worker thread and under its lock. Every
+        request runs with the pipeline that was current when it was submitted.
+    max_batch: most requests generated in one call. Batches are filled up to the next power of two (at most
+        `max_batch`) by repeating their last request, so a bucket compiles at most log2(max_batch) + 1 batch
+        sizes; single requests take the regular unbatched path.
+    max_wait: seconds the oldest waiting request waits for others of its bucket before its batch runs anyway.
+    report: print the batch size and queueing delays of every batch.
+
+        scheduler = BatchScheduler(model, max_batch=4, max_wait=0.5)
+        video = scheduler.submit(controlnet_video, prompt, n_prompt, seed).result()
+    """
+
+    def __init__(self, model, max_batch: int = 4, max_wait: float = 0.5, report: bool = False):
+        self.model = model
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max_wait
+        self.report = report
+        self.stats = BatchStats()
+        self._pending = []
+        self._condition = threading.Condition()
+        self._closed = False
+        self._worker = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+        self._worker.start()
+
+    @property
+    def batch_sizes(self):
+        return compiled_batch_sizes(self.max_batch)
+
+    def submit(self, controlnet_video, prompt, n_prompt, seed, chunk_size=8, merging_ratio=0.0) -> Future:
+        """
+        Queues a `generate_video_from_frame` request; the future resolves to its (frames, h, w, 3) video.
+        """
+        # the static configuration as `_generate_video` keys it
+        config = dict(num_inference_steps=50, t0=44, t1=47, chunk_size=chunk_size, merging_ratio=round(min(float(merging_ratio), MAX_MERGING_RATIO), 2))
+        bucket = self.model.place_request(controlnet_video, **config).bucket
+        entry = self.model.current_entry()
+        request = _Request(bucket, (controlnet_video, prompt, n_prompt, seed), config, entry, time.monotonic())
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The batch scheduler is closed.")
+            self._pending.append(request)
+            self._condition.notify()
+        return request.future
+
+    @staticmethod
+    def _same_batch(request, first):
+        return request.bucket == first.bucket and request.entry.pipe is first.entry.pipe
+
+    def _next_batch(self):
+        # the requests of the oldest request's bucket and model, once `max_batch` of them are waiting or at its deadline
+        with self._condition:
+            while not self._pending and not self._closed:
+                self._condition.wait()
+            if not self._pending:
+                return None
+            first = self._pending[0]
+            deadline = first.arrival + self.max_wait
+            while not self._closed:
+                waiting = sum(self._same_batch(request, first) for request in self._pending)
+                remaining = deadline - time.monotonic()
+                if waiting >= self.max_batch or remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = [request for request in self._pending if self._same_batch(request, first)][:self.max_batch]
+            self._pending = [request for request in self._pending if request not in batch]
+            return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._run(batch)
+
+    def _run(self, batch):
+        start = time.monotonic()
+        delays = [start - request.arrival for request in batch]
+        size = _compiled_batch_size(len(batch), self.max_batch)
+        self.stats.requests += len(batch)
+        self.stats.batches += 1
+        self.stats.padding += size - len(batch)
+        self.stats.queueing_seconds += sum(delays)
+        self.stats.max_queueing_seconds = max(self.stats.max_queueing_seconds, *delays)
+        config = dict(batch[0].config, entry=batch[0].entry)
+        try:
+            # the other requests of the model wait, e.g. initial frames or a model swap
+            with self.model.lock:
+                if size == 1:
+                    videos = [self.model._generate_video(*batch[0].args, **config)]
+                else:
+                    args = [request.args for request in batch] + [batch[-1].args] * (size - len(batch))
+                    videos = self.model._generate_video_batch(args, **config)
+                # videos come out request after request, the padding ones are never decoded
+                for request, video in zip(batch, videos):
+                    request.future.set_result(video)
+        except Exception as e:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+        if self.report:
+            print(f"Batch of {len(batch)} ({size} compiled) for {batch[0].bucket}: queueing delay max "
+                  f"{max(delays) * 1000:.0f} ms, generated in {time.monotonic() - start:.1f}s; {self.stats}")
+
+    def close(self):
+        # finishes the running batch, the requests still waiting fail
+        with self._condition:
+            self._closed = True
+            pending, self._pending = self._pending, []
+            self._condition.notify_all()
+        for request in pending:
+            request.future.set_exception(RuntimeError("The batch scheduler was closed."))
+        self._worker.join()
+
+
+if __name__ == "__main__":
+    # latency and throughput of concurrent requests on a bundled motion clip, batched against one at a time:
+    # python -m text_to_animation.batch_scheduler [num_requests]
+    import sys
+    from concurrent.futures import ThreadPoolExecutor
+
+    import jax.numpy as jnp
+
+    import utils.utils as utils
+    from text_to_animation.model import ControlAnimationModel
+
+    num_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    model = ControlAnimationModel(dtype=jnp.float16)
+    model.set_model("runwayml/stable-diffusion-v1-5")
+    _, control, _ = utils.prepare_control_video("__assets__/walk_01.mp4", 512, model.dtype, output_fps=4, cache=model.control_cache)
+    control = control[:8]
+    for max_batch in (1, num_requests):
+        scheduler = BatchScheduler(model, max_batch=max_batch, max_wait=1.0)
+        for _ in range(2):
+            # the first round compiles the batch sizes
+            scheduler.stats = BatchStats()
+            start = time.monotonic()
+            with ThreadPoolExecutor(num_requests) as pool:
+                list(pool.map(lambda seed: scheduler.submit(control, "a robot", "", seed).result(), range(num_requests)))
+            elapsed = time.monotonic() - start
+        scheduler.close()
+        print(f"max_batch={max_batch}: {num_requests} requests in {elapsed:.1f}s "
+              f"({num_requests / elapsed * 60:.1f} videos/min), {scheduler.stats}")
@@ -1,6 +1,8 @@
 import torch
 from enum import Enum
 import gc
+import itertools
+import threading
 import numpy as np
 import jax.numpy as jnp
 import jax
@@ -29,8 +31,18 @@ from diffusers import FlaxControlNetModel
 from text_to_animation.pipelines.text_to_video_pipeline_flax import (
     FlaxTextToVideoPipeline,
 )
+from text_to_animation.pipelines.compilation_cache import DEFAULT_BUCKETS, enable_persistent_compilation_cache
+from text_to_animation.pipelines.shape_buckets import DEFAULT_SHAPES, ShapeBucketer
+from text_to_animation.model_registry import ModelRegistry, RegistryEntry, registry_key
+from text_to_animation.batch_scheduler import BatchScheduler
+from text_to_animation.models.token_merging_flax import MAX_MERGING_RATIO
 
 import utils.utils as utils
+from utils.control_map_cache import (
+    ControlMapCache,
+    DEFAULT_CACHE_DIR as DEFAULT_CONTROL_CACHE_DIR,
+    DEFAULT_MAX_BYTES as DEFAULT_CONTROL_CACHE_MAX_BYTES,
+)
 import utils.gradio_utils as gradio_utils
 import os
 
@@ -50,27 +62,86 @@ def replicate_devices(array):
 
 
 class ControlAnimationModel:
-    def __init__(self, dtype, **kwargs):
+    def __init__(
+        self,
+        dtype,
+        max_resident_models: int = 1,
+        max_host_bytes: int = None,
+        max_device_bytes: int = None,
+        control_cache_dir: str = None,
+        control_cache_max_bytes: int = None,
+        shape_buckets=DEFAULT_SHAPES,
+        frame_parallel: bool = None,
+        compilation_cache_dir: str = None,
+        **kwargs,
+    ):
         self.dtype = dtype
+        # every loaded pipeline gets its own CompilationCache, persisted to this directory when set
+        self.compilation_cache_dir = compilation_cache_dir
         self.rng = jax.random.PRNGKey(0)
         self.pipe = None
         self.model_type = None
 
         self.states = {}
         self.model_name = ""
+        self.model_key = None
+        self.registry = ModelRegistry(
+            max_entries=max_resident_models,
+            max_host_bytes=max_host_bytes,
+            max_device_bytes=max_device_bytes,
+        )
+        self.control_cache = ControlMapCache(
+            cache_dir=control_cache_dir or DEFAULT_CONTROL_CACHE_DIR,
+            max_bytes=control_cache_max_bytes or DEFAULT_CONTROL_CACHE_MAX_BYTES,
+        )
+        # requests are padded to a few canonical (H, W, frames) shapes, None compiles every exact shape
+        self.bucketer = ShapeBucketer(shape_buckets) if shape_buckets else None
+        # split the frames of a video across the devices instead of generating it on every one of them,
+        # by default whenever there is more than one
+        self.frame_parallel = jax.device_count() > 1 if frame_parallel is None else frame_parallel
+        self.batch_scheduler = None
+        # held while the model is swapped and while anything runs on the devices, requests are served
+        # concurrently when batching is enabled
+        self.lock = threading.RLock()
+        # arguments of `prepare_control_video` for videos other than the bundled motions, see
+        # `enable_pose_detection`
+        self.pose_detection = None
+        self.pose_executor = None
 
     def set_model(
         self,
         model_id: str,
+        controlnet_id: str = "fusing/stable-diffusion-v1-5-controlnet-openpose",
         **kwargs,
     ):
-        if hasattr(self, "pipe") and self.pipe is not None:
-            del self.pipe
-            self.pipe = None
-        gc.collect()
+        key = registry_key(model_id, self.dtype, controlnet_id)
+        with self.lock:
+            if key != self.model_key:
+                # drop our references so an evicted pipeline can actually be freed
+                self.pipe = None
+                self.params = None
+                self.p_params = None
+                gc.collect()
+
+            # back-to-back requests for a resident checkpoint are a registry hit and skip loading
+            entry = self.registry.get_or_load(
+                key, lambda: self._load_model(model_id, controlnet_id)
+            )
+
+            self.pipe = entry.pipe
+            self.params = entry.params
+            self.p_params = entry.p_params
+            self.model_name = model_id
+            self.model_key = key
 
+    def current_entry(self) -> RegistryEntry:
+        # the pipeline and params of the current model, still usable after a later `set_model` swapped it out
+        with self.lock:
+            return RegistryEntry(pipe=self.pipe, params=self.params, p_params=self.p_params)
+
+    def _load_model(self, model_id: str, controlnet_id: str) -> RegistryEntry:
         controlnet, controlnet_params = FlaxControlNetModel.from_pretrained(
-            "fusing/stable-diffusion-v1-5-controlnet-openpose",
+            controlnet_id,
             from_pt=True,
             dtype=jnp.float16,
         )
@@ -82,8 +153,13 @@ class ControlAnimationModel:
         feature_extractor = CLIPFeatureExtractor.from_pretrained(
             model_id, subfolder="feature_extractor"
         )
+        # attention falls back to chunked kernels only for layers exceeding the memory budget
         unet, unet_params = FlaxUNet2DConditionModel.from_pretrained(
-            model_id, subfolder="unet", from_pt=True, dtype=self.dtype
+            model_id,
+            subfolder="unet",
+            from_pt=True,
+            dtype=self.dtype,
+            use_memory_efficient_attention=True,
         )
         unet_vanilla = VanillaFlaxUNet2DConditionModel.from_config(
             model_id, subfolder="unet", from_pt=True, dtype=self.dtype
@@ -94,7 +170,7 @@ class ControlAnimationModel:
         text_encoder = FlaxCLIPTextModel.from_pretrained(
             model_id, subfolder="text_encoder", from_pt=True, dtype=self.dtype
         )
-        self.pipe = FlaxTextToVideoPipeline(
+        pipe = FlaxTextToVideoPipeline(
             vae=vae,
             text_encoder=text_encoder,
             tokenizer=tokenizer,
@@ -105,15 +181,88 @@ class ControlAnimationModel:
             safety_checker=None,
             feature_extractor=feature_extractor,
         )
-        self.params = {
+        params = {
             "unet": unet_params,
             "vae": vae_params,
             "scheduler": scheduler_state,
             "controlnet": controlnet_params,
             "text_encoder": text_encoder.params,
         }
-        self.p_params = jax_utils.replicate(self.params)
-        self.model_name = model_id
+        p_params = jax_utils.replicate(params)
+        # executables are compiled per pipeline, also for pipelines reloaded after an eviction
+        pipe.enable_compilation_cache(self.compilation_cache_dir)
+        return RegistryEntry(pipe=pipe, params=params, p_params=p_params)
+
+    def prewarm_control_cache(self, resolution: int = 512, output_fps: int = 4, video_paths=()):
+        # pose maps of every bundled motion and of `video_paths`, so that no request decodes these clips
+        utils.prewarm_control_cache(
+            self.control_cache, gradio_utils.MOTION_VIDEOS, resolution=resolution, output_fps=output_fps
+        )
+        for video_path in video_paths:
+            self._prepare_control_video(video_path, resolution, output_fps=output_fps)
+        return self.control_cache.size
+
+    def enable_pose_detection(
+        self,
+        num_workers: int = 0,
+        keyframe_stride: int = 1,
+        refine: bool = True,
+        max_motion: float = 0.05,
+        min_score: float = 0.3,
+    ):
+        """
+        Detect the poses of control videos other than the bundled motions, which are rendered poses already.
+        With `num_workers` > 0 the detector runs in a `pose_executor` of that many worker processes, created
+        once here and stopped by `close`. `keyframe_stride` > 1 detects every `keyframe_stride`-th frame only
+        and interpolates the others, detecting more frames where keyframes disagree (`refine`), move more than
+        `max_motion` or score below `min_score`, see annotator/openpose/temporal.py.
+        """
+        if self.pose_executor is not None:
+            self.pose_executor.shutdown()
+        self.pose_executor = utils.pose_executor(num_workers) if num_workers > 0 else None
+        self.pose_detection = dict(
+            apply_pose_detect=True,
+            executor=self.pose_executor,
+            pose_keyframe_stride=keyframe_stride,
+            pose_keyframe_kwargs=dict(refine=refine, max_motion=max_motion, min_score=min_score),
+        )
+
+    def _prepare_control_video(self, video_path, resolution, output_fps=4):
+        # decoded motion clips and their pose maps are memory-mapped from the control map cache
+        detect = self.pose_detection is not None and video_path not in gradio_utils.MOTION_VIDEOS
+        return utils.prepare_control_video(
+            video_path,
+            resolution,
+            self.dtype,
+            output_fps=output_fps,
+            cache=self.control_cache,
+            **(self.pose_detection if detect else {}),
+        )
+
+    def close(self):
+        # stops the batch scheduler and the pose detection workers
+        if self.batch_scheduler is not None:
+            self.batch_scheduler.close()
+            self.batch_scheduler = None
+        if self.pose_executor is not None:
+            self.pose_executor.shutdown()
+            self.pose_executor = None
+
+    def registry_stats(self):
+        return self.registry.stats()
+
+    def enable_batching(self, max_batch: int = 4, max_wait: float = 0.5, report: bool = False):
+        """
+        Route `generate_video_from_frame` through a `BatchScheduler`, which generates concurrent requests of the
+        same shape bucket together, up to `max_batch` of them collected for at most `max_wait` seconds.
+        """
+        if self.batch_scheduler is not None:
+            self.batch_scheduler.close()
+        self.batch_scheduler = BatchScheduler(self, max_batch=max_batch, max_wait=max_wait, report=report)
+        return self.batch_scheduler
+
+    def batch_stats(self):
+        return None if self.batch_scheduler is None else self.batch_scheduler.stats
 
     def generate_initial_frames(
         self,
@@ -125,51 +274,87 @@ class ControlAnimationModel:
         resolution: int = 512,
         model_id: str = "runwayml/stable-diffusion-v1-5",
     ) -> List[Image.Image]:
-        self.set_model(model_id=model_id)
+        # one request at a time: the model is not swapped under it and candidates of concurrent requests do
+        # not compete for device memory
+        with self.lock:
+            self.set_model(model_id=model_id)
 
-        video_path = gradio_utils.motion_to_video_path(video_path)
+            video_path = gradio_utils.motion_to_video_path(video_path)
 
-        added_prompt = "high quality, best quality, HD, clay stop-motion, claymation, HQ, masterpiece, art, smooth"
-        prompts = added_prompt + ", " + prompt
+            added_prompt = "high quality, best quality, HD, clay stop-motion, claymation, HQ, masterpiece, art, smooth"
+            prompts = added_prompt + ", " + prompt
 
-        added_n_prompt = "longbody, lowres, bad anatomy, bad hands, missing fingers, extra digit, fewer difits, cropped, worst quality, low quality, deformed body, bloated, ugly"
-        negative_prompts = added_n_prompt + ", " + n_prompt
+            added_n_prompt = "longbody, lowres, bad anatomy, bad hands, missing fingers, extra digit, fewer difits, cropped, worst quality, low quality, deformed body, bloated, ugly"
+            negative_prompts = added_n_prompt + ", " + n_prompt
 
-        video, fps = utils.prepare_video(
-            video_path, resolution, None, self.dtype, False, output_fps=4
-        )
-        control = utils.pre_process_pose(video, apply_pose_detect=False)
-
-        # seeds = [seed for seed in jax.random.randint(self.rng, [num_imgs], 0, 65536)]
-        prngs = [jax.random.PRNGKey(seed)] * num_imgs
-        images = self.pipe.generate_starting_frames(
-            params=self.p_params,
-            prngs=prngs,
-            controlnet_image=control,
-            prompt=prompts,
-            neg_prompt=negative_prompts,
-        )
+            video, control, fps = self._prepare_control_video(video_path, resolution)
+
+            # only the first control frame is used, padded to the spatial bucket of the video
+            placement = self.place_request(control)
+
+            # one key per candidate is split from the seed inside the pipeline
+            images = self.pipe.generate_starting_frames(
+                params=self.p_params,
+                prng_seed=jax.random.PRNGKey(seed),
+                num_imgs=num_imgs,
+                controlnet_image=placement.pad(np.asarray(control[:1]))[:1],
+                prompt=prompts,
+                neg_prompt=negative_prompts,
+            )
+
+            images = [placement.crop(np.array(images[i])) for i in range(images.shape[0])]
 
-        images = [np.array(images[i]) for i in range(images.shape[0])]
+            return video, images
 
-        return video, images
+    def generate_video_from_frame(self, controlnet_video, prompt, n_prompt, seed, chunk_size=8, merging_ratio=0.0):
+        if self.batch_scheduler is not None:
+            # waits for the batch of this request, the video is complete when it returns
+            frames = self.batch_scheduler.submit(
+                controlnet_video, prompt, n_prompt, seed, chunk_size=chunk_size, merging_ratio=merging_ratio
+            ).result()
+            return utils.create_gif(frames, 4, path=None, watermark=None, background=True)
+        with self.lock:
+            frames = self._generate_video(
+                controlnet_video, prompt, n_prompt, seed, chunk_size=chunk_size, merging_ratio=merging_ratio, stream=True
+            )
+            # frames are quantized and written while the rest of the video is still being decoded
+            return utils.create_gif(frames, 4, path=None, watermark=None, background=True)
 
-    def generate_video_from_frame(self, controlnet_video, prompt, n_prompt, seed):
-        # generate a video using the seed provided
+    def _generate_video(
+        self,
+        controlnet_video,
+        prompt,
+        n_prompt,
+        seed,
+        num_inference_steps: int = 50,
+        t0: int = 44,
+        t1: int = 47,
+        chunk_size: int = None,
+        merging_ratio: float = 0.0,
+        decode_chunk_size: int = 4,
+        stream: bool = False,
+        frame_parallel: bool = None,
+        entry: RegistryEntry = None,
+    ):
+        # generate a video using the seed provided, with the pipeline of `entry` (see `current_entry`) or the
+        # current one
+        entry = entry or self.current_entry()
         prng_seed = jax.random.PRNGKey(seed)
-        len_vid = controlnet_video.shape[0]
+        # static argument of the pmapped generation, keep it a plain (rounded) float; ratios above the
+        # maximum merge as much as it does and share its executable
+        merging_ratio = round(min(float(merging_ratio), MAX_MERGING_RATIO), 2)
+        placement = self.place_request(
+            controlnet_video,
+            num_inference_steps=num_inference_steps,
+            t0=t0,
+            t1=t1,
+            chunk_size=chunk_size,
+            merging_ratio=merging_ratio,
+        )
+        chunk_size = placement.bucket.chunk_size
+        controlnet_video = placement.pad(np.asarray(controlnet_video))
         # print(f"Generating video from prompt {'<aardman> style '+ prompt}, with {controlnet_video.shape[0]} frames and prng seed {seed}")
-        added_prompt = "high quality, best quality, HD, clay stop-motion, claymation, HQ, masterpiece, art, smooth"
-        prompts = added_prompt + ", " + prompt
-
-        added_n_prompt = "longbody, lowres, bad anatomy, bad hands, missing fingers, extra digit, fewer difits, cropped, worst quality, low quality, deformed body, bloated, ugly"
-        negative_prompts = added_n_prompt + ", " + n_prompt
-        
-        # prompt_ids = self.pipe.prepare_text_inputs(["aardman style "+ prompt]*len_vid)
-        # n_prompt_ids = self.pipe.prepare_text_inputs([neg_prompt]*len_vid)
-        
-        prompt_ids = self.pipe.prepare_text_inputs([prompts]*len_vid)
-        n_prompt_ids = self.pipe.prepare_text_inputs([negative_prompts]*len_vid)
+        prompt_ids, n_prompt_ids = self._video_prompt_ids(entry.pipe, prompt, n_prompt)
         prng = replicate_devices(prng_seed) #jax.random.split(prng, jax.device_count())
         image = replicate_devices(controlnet_video)
         prompt_ids = replicate_devices(prompt_ids)
@@ -177,14 +362,206 @@ class ControlAnimationModel:
         motion_field_strength_x = replicate_devices(jnp.array(3))
         motion_field_strength_y = replicate_devices(jnp.array(4))
         smooth_bg_strength = replicate_devices(jnp.array(0.8))
-        vid = (self.pipe(image=image,
+        output = entry.pipe(image=image,
                         prompt_ids=prompt_ids,
                         neg_prompt_ids=n_prompt_ids, 
-                        params=self.p_params,
+                        params=entry.p_params,
                         prng_seed=prng,
+                        num_inference_steps=num_inference_steps,
                         jit = True,
                         smooth_bg_strength=smooth_bg_strength,
                         motion_field_strength_x=motion_field_strength_x,
                         motion_field_strength_y=motion_field_strength_y,
-                        ).images)[0]
-        return utils.create_gif(np.array(vid), 4, path=None, watermark=None)
+                        t0=t0,
+                        t1=t1,
+                        chunk_size=chunk_size,
+                        merging_ratio=merging_ratio,
+                        decode_chunk_size=decode_chunk_size,
+                        stream=True,
+                        frame_parallel=self.frame_parallel if frame_parallel is None else frame_parallel,
+                        )
+        if output is None:
+            # compile-only warm-up run
+            return None
+        # frames are decoded a few at a time, with frame parallelism the frames of the devices are already
+        # put in order, otherwise every device holds the same video; padding is cropped away
+        frames = placement.crop_frames(frame[0] for frame in output)
+        if stream:
+            return frames
+        return np.stack(list(frames))
+
+    def _video_prompt_ids(self, pipe, prompt, n_prompt):
+        added_prompt = "high quality, best quality, HD, clay stop-motion, claymation, HQ, masterpiece, art, smooth"
+        prompts = added_prompt + ", " + prompt
+
+        added_n_prompt = "longbody, lowres, bad anatomy, bad hands, missing fingers, extra digit, fewer difits, cropped, worst quality, low quality, deformed body, bloated, ugly"
+        negative_prompts = added_n_prompt + ", " + n_prompt
+
+        # prompt_ids = self.pipe.prepare_text_inputs(["aardman style "+ prompt]*len_vid)
+        # n_prompt_ids = self.pipe.prepare_text_inputs([neg_prompt]*len_vid)
+
+        # the pipeline broadcasts a single prompt row across all frames
+        return pipe.prepare_text_inputs([prompts]), pipe.prepare_text_inputs([negative_prompts])
+
+    def _generate_video_batch(
+        self,
+        requests,
+        num_inference_steps: int = 50,
+        t0: int = 44,
+        t1: int = 47,
+        chunk_size: int = None,
+        merging_ratio: float = 0.0,
+        decode_chunk_size: int = 4,
+        frame_parallel: bool = None,
+        entry: RegistryEntry = None,
+    ):
+        """
+        Generates the videos of `requests`, (controlnet_video, prompt, n_prompt, seed) tuples that fall into the
+        same shape bucket, in one call, and yields the (frames, h, w, 3) video of each request in order. Uses the
+        pipeline of `entry` (see `current_entry`), the current one by default.
+        """
+        entry = entry or self.current_entry()
+        merging_ratio = round(min(float(merging_ratio), MAX_MERGING_RATIO), 2)
+        placements = [
+            self.place_request(
+                controlnet_video,
+                num_inference_steps=num_inference_steps,
+                t0=t0,
+                t1=t1,
+                chunk_size=chunk_size,
+                merging_ratio=merging_ratio,
+            )
+            for controlnet_video, _, _, _ in requests
+        ]
+        if len({placement.bucket for placement in placements}) > 1:
+            raise ValueError("The requests of a batch have to fall into the same shape bucket.")
+        chunk_size = placements[0].bucket.chunk_size
+        # requests are stacked along the batch axis behind the device axis
+        image = np.stack([placement.pad(np.asarray(request[0])) for placement, request in zip(placements, requests)])
+        prompt_ids, n_prompt_ids = zip(*(self._video_prompt_ids(entry.pipe, prompt, n_prompt) for _, prompt, n_prompt, _ in requests))
+        prng = jnp.stack([jax.random.PRNGKey(seed) for _, _, _, seed in requests])
+        batch_size = len(requests)
+        output = entry.pipe(image=replicate_devices(image),
+                        prompt_ids=replicate_devices(np.stack(prompt_ids)),
+                        neg_prompt_ids=replicate_devices(np.stack(n_prompt_ids)),
+                        params=entry.p_params,
+                        prng_seed=replicate_devices(prng),
+                        num_inference_steps=num_inference_steps,
+                        jit=True,
+                        smooth_bg_strength=replicate_devices(jnp.full(batch_size, 0.8)),
+                        motion_field_strength_x=replicate_devices(jnp.full(batch_size, 3)),
+                        motion_field_strength_y=replicate_devices(jnp.full(batch_size, 4)),
+                        t0=t0,
+                        t1=t1,
+                        chunk_size=chunk_size,
+                        merging_ratio=merging_ratio,
+                        decode_chunk_size=decode_chunk_size,
+                        stream=True,
+                        frame_parallel=self.frame_parallel if frame_parallel is None else frame_parallel,
+                        batched=True,
+                        )
+        if output is None:
+            # compile-only warm-up run
+            return
+        for request, frames in itertools.groupby(output, key=lambda item: item[0]):
+            yield np.stack(list(placements[request].crop_frames(frame[0] for _, frame in frames)))
+
+    def place_request(self, controlnet_video, chunk_size=None, **config):
+        """
+        The shape bucket (and placement within it) of a (f, c, h, w) control video; the exact shape when
+        bucketing is disabled. `config` holds the other static ShapeBucket fields of the request.
+        """
+        num_frames, _, height, width = controlnet_video.shape
+        bucketer = self.bucketer or ShapeBucketer([(height, width, num_frames)])
+        video_length = bucketer.place(height, width, num_frames).bucket.video_length
+        if chunk_size is not None and int(chunk_size) >= video_length:
+            # a single window covers the whole video, share the executable of the unchunked path
+            chunk_size = None
+        elif chunk_size is not None:
+            chunk_size = int(chunk_size)
+        return bucketer.place(height, width, num_frames, chunk_size=chunk_size, **config)
+
+    def warmup(
+        self,
+        buckets=None,
+        num_imgs: int = 4,
+        cache_dir: str = None,
+        model_id: str = "runwayml/stable-diffusion-v1-5",
+        batch_sizes=None,
+    ):
+        """
+        Lower and compile `_p_generate` (and the initial frame generation) for every shape bucket we
+        serve, so that requests falling into a warm bucket never wait for XLA. `model_id` is loaded first
+        and every model resident in the registry is warmed, each in its own compilation cache; models
+        loaded later compile on their first requests. With `cache_dir` set the executables are also
+        persisted on disk and reused by restarted workers. `batch_sizes` are the batched executables
+        compiled per bucket as well, by default those the batch scheduler runs when batching is enabled.
+        """
+        with self.lock:
+            if cache_dir is not None:
+                # persisted by jax for the executables of every pipeline
+                enable_persistent_compilation_cache(cache_dir)
+                self.compilation_cache_dir = cache_dir
+            self.set_model(model_id=model_id)
+            if buckets is None and self.bucketer is None:
+                buckets = DEFAULT_BUCKETS
+            elif buckets is None:
+                # every canonical shape with the default configuration of the UI, as `_generate_video` keys it
+                buckets = [
+                    self.place_request(np.empty((f, 3, h, w), dtype=np.float32), chunk_size=8).bucket
+                    for h, w, f in self.bucketer.shapes
+                ]
+            if batch_sizes is None:
+                batch_sizes = self.batch_scheduler.batch_sizes if self.batch_scheduler is not None else ()
+            for entry in self.registry.entries():
+                self._warmup_entry(entry, buckets, num_imgs, batch_sizes)
+            return self.warm_buckets()
+
+    def _warmup_entry(self, entry, buckets, num_imgs, batch_sizes):
+        cache = entry.pipe.enable_compilation_cache(self.compilation_cache_dir)
+        warmed_resolutions = set()
+        for bucket in buckets:
+            if cache.is_warm(bucket):
+                continue
+            with cache.compile_only():
+                if (bucket.height, bucket.width) not in warmed_resolutions:
+                    control = np.zeros((1, 3, bucket.height, bucket.width), dtype=np.float32)
+                    entry.pipe.generate_starting_frames(
+                        params=entry.p_params,
+                        prng_seed=jax.random.PRNGKey(0),
+                        num_imgs=num_imgs,
+                        controlnet_image=control,
+                        prompt="",
+                        neg_prompt="",
+                        num_inference_steps=bucket.num_inference_steps,
+                    )
+                    warmed_resolutions.add((bucket.height, bucket.width))
+                video = np.zeros(
+                    (bucket.video_length, 3, bucket.height, bucket.width), dtype=np.float32
+                )
+                self._generate_video(
+                    video, "", "", 0,
+                    num_inference_steps=bucket.num_inference_steps,
+                    t0=bucket.t0,
+                    t1=bucket.t1,
+                    chunk_size=bucket.chunk_size,
+                    merging_ratio=bucket.merging_ratio,
+                    entry=entry,
+                )
+                for batch_size in batch_sizes:
+                    list(self._generate_video_batch(
+                        [(video, "", "", 0)] * batch_size,
+                        num_inference_steps=bucket.num_inference_steps,
+                        t0=bucket.t0,
+                        t1=bucket.t1,
+                        chunk_size=bucket.chunk_size,
+                        merging_ratio=bucket.merging_ratio,
+                        entry=entry,
+                    ))
+            cache.mark_warm(bucket)
+
+    def warm_buckets(self):
+        # the buckets compiled for the current model
+        if self.pipe is None or self.pipe.compilation_cache is None:
+            return set()
+        return set(self.pipe.compilation_cache.warm_buckets)
@@ -0,0 +1,142 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Hashable, Optional
+import threading
+
+import jax
+import jax.numpy as jnp
+
+
+def tree_nbytes(tree) -> int:
+    # total size in bytes of every array leaf of a params pytree
+    return int(sum(getattr(leaf, "nbytes", 0) for leaf in jax.tree_util.tree_leaves(tree)))
+
+
+def registry_key(model_id: str, dtype, controlnet_id: str):
+    return (model_id, jnp.dtype(dtype).name, controlnet_id)
+
+
+@dataclass
+class RegistryEntry:
+    pipe: Any
+    params: Dict
+    p_params: Dict
+    host_bytes: int = 0
+    device_bytes: int = 0
+
+
+@dataclass
+class RegistryStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    host_bytes: int = 0
+    device_bytes: int = 0
+    resident: list = field(default_factory=list)
+
+
+class ModelRegistry:
+    """
+    Keeps loaded pipelines and their (replicated) params resident across calls, keyed by
+    (model_id, dtype, controlnet_id). Least recently used entries are evicted once
+    `max_entries`, `max_host_bytes` or `max_device_bytes` would be exceeded. The most recently
+    loaded entry is never evicted, even if it alone exceeds the budget.
+    """
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = 1,
+        max_host_bytes: Optional[int] = None,
+        max_device_bytes: Optional[int] = None,
+    ):
+        self.max_entries = max_entries
+        self.max_host_bytes = max_host_bytes
+        self.max_device_bytes = max_device_bytes
+        self._entries: "OrderedDict[Hashable, RegistryEntry]" = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def host_bytes(self):
+        return sum(entry.host_bytes for entry in self._entries.values())
+
+    @property
+    def device_bytes(self):
+        return sum(entry.device_bytes for entry in self._entries.values())
+
+    def entries(self):
+        # the resident entries, least recently used first
+        with self._lock:
+            return list(self._entries.values())
+
+    def get(self, key) -> Optional[RegistryEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def get_or_load(self, key, loader: Callable[[], RegistryEntry]) -> RegistryEntry:
+        with self._lock:
+            entry = self.get(key)
+            if entry is not None:
+                self.hits += 1
+                return entry
+            self.misses += 1
+            # make room before loading so that the old weights are released first
+            self._evict(reserve_entries=1)
+            entry = loader()
+            if not entry.host_bytes:
+                entry.host_bytes = tree_nbytes(entry.params)
+            if not entry.device_bytes:
+                entry.device_bytes = tree_nbytes(entry.p_params)
+            self._entries[key] = entry
+            self._evict()
+            return entry
+
+    def evict(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self.evictions += len(self._entries)
+            self._entries.clear()
+
+    def _over_budget(self, reserve_entries=0):
+        n = len(self._entries) + reserve_entries
+        if self.max_entries is not None and n > self.max_entries:
+            return True
+        if self.max_host_bytes is not None and self.host_bytes > self.max_host_bytes:
+            return True
+        if self.max_device_bytes is not None and self.device_bytes > self.max_device_bytes:
+            return True
+        return False
+
+    def _evict(self, reserve_entries=0):
+        # never evict the most recently used entry after a load
+        keep = 0 if reserve_entries else 1
+        while len(self._entries) > keep and self._over_budget(reserve_entries):
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> RegistryStats:
+        with self._lock:
+            return RegistryStats(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                host_bytes=self.host_bytes,
+                device_bytes=self.device_bytes,
+                resident=list(self._entries.keys()),
+            )
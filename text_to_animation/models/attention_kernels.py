@@ -0,0 +1,146 @@
+# Attention kernel selection for the cross-frame attention layers.
+#
+# Every attention layer of the UNet has a static shape, so the choice between dense einsum attention and
+# chunked memory-efficient attention (https://arxiv.org/abs/2112.05682), and its chunk sizes, is made once
+# per shape at trace time and cached.
+
+import functools
+from dataclasses import dataclass
+from typing import Optional
+
+import flax.linen as nn
+import jax.numpy as jnp
+
+from diffusers.models.attention_flax import jax_memory_efficient_attention
+
+# peak bytes the attention weights of a single layer (or of a single chunk) may take
+DEFAULT_ATTENTION_MEMORY_BUDGET = 1 << 30
+
+# attention weights, their softmax and the exponentials of the chunked kernel live at the same time
+_LIVE_WEIGHT_COPIES = 3
+
+_memory_budget = DEFAULT_ATTENTION_MEMORY_BUDGET
+
+
+@dataclass(frozen=True)
+class AttentionKernel:
+    # "dense" or "chunked"; chunk sizes are only used by the chunked kernel
+    kind: str = "dense"
+    query_chunk_size: Optional[int] = None
+    key_chunk_size: Optional[int] = None
+
+    def __str__(self):
+        if self.kind == "dense":
+            return "dense"
+        return f"chunked(q={self.query_chunk_size}, k={self.key_chunk_size})"
+
+
+def set_attention_memory_budget(budget_bytes: int):
+    """
+    Sets the memory budget used by `select_attention_kernel`. Takes effect for layers traced afterwards,
+    i.e. already compiled generation functions keep their kernels.
+    """
+    global _memory_budget
+    _memory_budget = int(budget_bytes)
+
+
+def get_attention_memory_budget() -> int:
+    return _memory_budget
+
+
+def _divisors(n):
+    # jax_memory_efficient_attention needs chunk sizes dividing the sequence lengths
+    small = [d for d in range(1, int(n**0.5) + 1) if n % d == 0]
+    return sorted(set(small + [n // d for d in small]), reverse=True)
+
+
+def attention_weights_bytes(batch_heads, query_len, key_len, dtype) -> int:
+    return _LIVE_WEIGHT_COPIES * batch_heads * query_len * key_len * jnp.dtype(dtype).itemsize
+
+
+@functools.lru_cache(maxsize=None)
+def _select(query_len, key_len, batch_heads, dtype_name, memory_budget):
+    if attention_weights_bytes(batch_heads, query_len, key_len, dtype_name) <= memory_budget:
+        return AttentionKernel("dense")
+    # fewest scan steps first: the longest key chunk, then the longest query chunk that fits
+    for key_chunk_size in _divisors(key_len):
+        for query_chunk_size in _divisors(query_len):
+            if attention_weights_bytes(batch_heads, query_chunk_size, key_chunk_size, dtype_name) <= memory_budget:
+                return AttentionKernel("chunked", query_chunk_size, key_chunk_size)
+    return AttentionKernel("chunked", 1, 1)
+
+
+def select_attention_kernel(query_len, key_len, batch_heads, dtype, memory_budget=None) -> AttentionKernel:
+    """
+    Picks the kernel for attention of `batch_heads` heads (batch times heads) with `query_len` queries and
+    `key_len` keys. Dense attention is used whenever its weights fit in `memory_budget` bytes, otherwise the
+    chunked kernel with the largest chunks that do. Decisions are cached per shape, dtype and budget.
+    """
+    memory_budget = _memory_budget if memory_budget is None else memory_budget
+    return _select(int(query_len), int(key_len), int(batch_heads), jnp.dtype(dtype).name, int(memory_budget))
+
+
+def attend(query_states, key_states, value_states, scale, kernel: AttentionKernel):
+    """
+    query_states: (b * heads, query_len, dim_head), key_states / value_states: (b * heads, key_len, dim_head),
+    laid out like `reshape_heads_to_batch_dim`. Returns (b * heads, query_len, dim_head).
+    """
+    if kernel.kind == "chunked":
+        # jax_memory_efficient_attention expects (seq, heads, dim) and scales by dim_head**-0.5 itself
+        hidden_states = jax_memory_efficient_attention(
+            query_states.transpose(1, 0, 2),
+            key_states.transpose(1, 0, 2),
+            value_states.transpose(1, 0, 2),
+            query_chunk_size=kernel.query_chunk_size,
+            key_chunk_size=kernel.key_chunk_size,
+        )
+        return hidden_states.transpose(1, 0, 2)
+
+    # compute attentions
+    attention_scores = jnp.einsum("b i d, b j d->b i j", query_states, key_states)
+    attention_scores = attention_scores * scale
+    attention_probs = nn.softmax(attention_scores, axis=2)
+
+    # attend to values
+    return jnp.einsum("b i j, b j d -> b i d", attention_probs, value_states)
+
+
+if __name__ == "__main__":
+    # sweep the kernels of the SD 1.5 UNet self-attention shapes (8 frames with CFG, frames folded into the
+    # queries by the cross-frame attention) on the current backend, CPU by default:
+    # JAX_PLATFORMS=cpu python -m text_to_animation.models.attention_kernels
+    import time
+
+    import jax
+
+    video_length, heads, dim_head = 8, 8, 40
+    budgets = [1 << 26, 1 << 28, 1 << 30]
+    key = jax.random.PRNGKey(0)
+
+    for tokens in [64 * 64, 32 * 32, 16 * 16, 8 * 8]:
+        batch_heads, query_len = 2 * heads, video_length * tokens
+        q = jax.random.normal(key, (batch_heads, query_len, dim_head))
+        kv = jax.random.normal(key, (batch_heads, tokens, dim_head))
+        candidates = {AttentionKernel("dense")}
+        candidates |= {select_attention_kernel(query_len, tokens, batch_heads, q.dtype, budget) for budget in budgets}
+        candidates |= {
+            AttentionKernel("chunked", query_chunk_size, tokens)
+            for query_chunk_size in (tokens // 64, tokens // 16, tokens // 4, tokens)
+            if query_chunk_size > 0
+        }
+        print(f"tokens={tokens} queries={query_len} selected: "
+              + ", ".join(f"{budget >> 20}MiB -> {select_attention_kernel(query_len, tokens, batch_heads, q.dtype, budget)}"
+                          for budget in budgets))
+        for kernel in sorted(candidates, key=str):
+            fn = jax.jit(functools.partial(attend, scale=dim_head**-0.5, kernel=kernel))
+            compiled = fn.lower(q, kv, kv).compile()
+            try:
+                memory = compiled.memory_analysis().temp_size_in_bytes / 2**20
+            except Exception:
+                memory = float("nan")
+            jax.block_until_ready(compiled(q, kv, kv))
+            start = time.perf_counter()
+            for _ in range(3):
+                jax.block_until_ready(compiled(q, kv, kv))
+            elapsed = (time.perf_counter() - start) / 3 * 1000
+            print(f"  {str(kernel):28s} {elapsed:9.2f} ms, temp memory {memory:8.1f} MiB")
@@ -22,7 +22,10 @@ import jax.numpy as jnp
 from einops import repeat
 
 # from diffusers.models.attention_flax import FlaxBasicTransformerBlock
-from diffusers.models.attention_flax import FlaxFeedForward, jax_memory_efficient_attention
+from diffusers.models.attention_flax import FlaxFeedForward
+
+from .attention_kernels import AttentionKernel, attend, select_attention_kernel
+from .token_merging_flax import frame_shared_merge_fns
 
 def rearrange_3(array, f): 
     F, D, C = array.shape
@@ -32,6 +35,11 @@ def rearrange_4(array):
     B, F, D, C = array.shape
     return jnp.reshape(array, (B * F, D, C))
 
+def anchor_frames(array, batch_size):
+    # (batch_size * video_length, D, C) -> frame 0 of every batch element (batch_size, D, C), video_length
+    video_length = 1 if array.shape[0] < batch_size else array.shape[0] // batch_size
+    return rearrange_3(array, video_length)[:, 0], video_length
+
 class FlaxCrossFrameAttention(nn.Module):
     r"""
     A Flax multi-head attention module as described in: https://arxiv.org/abs/1706.03762
@@ -46,7 +54,8 @@ class FlaxCrossFrameAttention(nn.Module):
         dropout (:obj:`float`, *optional*, defaults to 0.0):
             Dropout rate
         use_memory_efficient_attention (`bool`, *optional*, defaults to `False`):
-            enable memory efficient attention https://arxiv.org/abs/2112.05682
+            enable memory efficient attention https://arxiv.org/abs/2112.05682, chunked only when dense
+            attention would exceed the budget of `attention_kernels.set_attention_memory_budget`
         dtype (:obj:`jnp.dtype`, *optional*, defaults to jnp.float32):
             Parameters `dtype`
         batch_size: The number that represents actual batch size, other than the frames.
@@ -94,64 +103,35 @@ class FlaxCrossFrameAttention(nn.Module):
 
     def __call__(self, hidden_states, context=None, deterministic=True):
         is_cross_attention = context is not None
-        context = hidden_states if context is None else context
+        frames, seq_len, _ = hidden_states.shape
         query_proj = self.query(hidden_states)
-        key_proj = self.key(context)
-        value_proj = self.value(context)
-
-        # Sparse Attention
-        if not is_cross_attention:
-            video_length = 1 if key_proj.shape[0] < self.batch_size else key_proj.shape[0] // self.batch_size
-            first_frame_index = [0] * video_length
 
-            # rearrange keys to have batch and frames in the 1st and 2nd dims respectively
-            key_proj = rearrange_3(key_proj, video_length)
-            key_proj = key_proj[:, first_frame_index]
-            # rearrange values to have batch and frames in the 1st and 2nd dims respectively
-            value_proj = rearrange_3(value_proj, video_length)
-            value_proj = value_proj[:, first_frame_index]
-
-            # rearrange back to original shape
-            key_proj = rearrange_4(key_proj)
-            value_proj = rearrange_4(value_proj)
+        if is_cross_attention:
+            key_proj = self.key(context)
+            value_proj = self.value(context)
+        else:
+            # Sparse Attention: every frame attends to frame 0 of its batch element, so keys/values are
+            # only projected for the anchor frames and the queries of all frames are folded into the
+            # sequence dimension to attend to the same (unrepeated) keys/values
+            anchor, video_length = anchor_frames(hidden_states, self.batch_size)
+            key_proj = self.key(anchor)
+            value_proj = self.value(anchor)
+            query_proj = query_proj.reshape(frames // video_length, video_length * seq_len, -1)
 
         query_states = self.reshape_heads_to_batch_dim(query_proj)
         key_states = self.reshape_heads_to_batch_dim(key_proj)
         value_states = self.reshape_heads_to_batch_dim(value_proj)
 
         if self.use_memory_efficient_attention:
-            query_states = query_states.transpose(1, 0, 2)
-            key_states = key_states.transpose(1, 0, 2)
-            value_states = value_states.transpose(1, 0, 2)
-
-            # this if statement create a chunk size for each layer of the unet
-            # the chunk size is equal to the query_length dimension of the deepest layer of the unet
-
-            flatten_latent_dim = query_states.shape[-3]
-            if flatten_latent_dim % 64 == 0:
-                query_chunk_size = int(flatten_latent_dim / 64)
-            elif flatten_latent_dim % 16 == 0:
-                query_chunk_size = int(flatten_latent_dim / 16)
-            elif flatten_latent_dim % 4 == 0:
-                query_chunk_size = int(flatten_latent_dim / 4)
-            else:
-                query_chunk_size = int(flatten_latent_dim)
-
-            hidden_states = jax_memory_efficient_attention(
-                query_states, key_states, value_states, query_chunk_size=query_chunk_size, key_chunk_size=4096 * 4
+            # dense or chunked attention, with chunk sizes fitting the memory budget of this layer's shape
+            kernel = select_attention_kernel(
+                query_states.shape[1], key_states.shape[1], query_states.shape[0], query_states.dtype
             )
-
-            hidden_states = hidden_states.transpose(1, 0, 2)
         else:
-            # compute attentions
-            attention_scores = jnp.einsum("b i d, b j d->b i j", query_states, key_states)
-            attention_scores = attention_scores * self.scale
-            attention_probs = nn.softmax(attention_scores, axis=2)
-
-            # attend to values
-            hidden_states = jnp.einsum("b i j, b j d -> b i d", attention_probs, value_states)
+            kernel = AttentionKernel("dense")
+        hidden_states = attend(query_states, key_states, value_states, self.scale, kernel)
 
-        hidden_states = self.reshape_batch_dim_to_heads(hidden_states)
+        hidden_states = self.reshape_batch_dim_to_heads(hidden_states).reshape(frames, seq_len, -1)
         hidden_states = self.proj_attn(hidden_states)
         return hidden_states
 
@@ -205,7 +185,8 @@ class FlaxLoRACrossFrameAttention(nn.Module):
         dropout (:obj:`float`, *optional*, defaults to 0.0):
             Dropout rate
         use_memory_efficient_attention (`bool`, *optional*, defaults to `False`):
-            enable memory efficient attention https://arxiv.org/abs/2112.05682
+            enable memory efficient attention https://arxiv.org/abs/2112.05682, chunked only when dense
+            attention would exceed the budget of `attention_kernels.set_attention_memory_budget`
         dtype (:obj:`jnp.dtype`, *optional*, defaults to jnp.float32):
             Parameters `dtype`
         batch_size: The number that represents actual batch size, other than the frames.
@@ -259,66 +240,30 @@ class FlaxLoRACrossFrameAttention(nn.Module):
 
     def __call__(self, hidden_states, context=None, deterministic=True, scale=1.):
         is_cross_attention = context is not None
-        context = hidden_states if context is None else context
+        frames, seq_len, _ = hidden_states.shape
         query_proj = self.query(hidden_states) + scale * self.to_q_lora(hidden_states)
-        key_proj = self.key(context) + scale * self.to_k_lora(context)
-        value_proj = self.value(context) + scale * self.to_v_lora(context)
 
-        # Sparse Attention
         if not is_cross_attention:
-            video_length = 1 if key_proj.shape[0] < self.batch_size else key_proj.shape[0] // self.batch_size
-            first_frame_index = [0] * video_length
-            #first frame ==> previous frame
-            previous_frame_index = jnp.array([0] + list(range(video_length - 1)))
-
-            # rearrange keys to have batch and frames in the 1st and 2nd dims respectively
-            key_proj = rearrange_3(key_proj, video_length)
-            key_proj = key_proj[:, first_frame_index]
-            # rearrange values to have batch and frames in the 1st and 2nd dims respectively
-            value_proj = rearrange_3(value_proj, video_length)
-            value_proj = value_proj[:, first_frame_index]
-
-            # rearrange back to original shape
-            key_proj = rearrange_4(key_proj)
-            value_proj = rearrange_4(value_proj)
+            # Sparse Attention against the anchor frame keys/values only, see `FlaxCrossFrameAttention`
+            context, video_length = anchor_frames(hidden_states, self.batch_size)
+            query_proj = query_proj.reshape(frames // video_length, video_length * seq_len, -1)
+        key_proj = self.key(context) + scale * self.to_k_lora(context)
+        value_proj = self.value(context) + scale * self.to_v_lora(context)
 
         query_states = self.reshape_heads_to_batch_dim(query_proj)
         key_states = self.reshape_heads_to_batch_dim(key_proj)
         value_states = self.reshape_heads_to_batch_dim(value_proj)
 
         if self.use_memory_efficient_attention:
-            query_states = query_states.transpose(1, 0, 2)
-            key_states = key_states.transpose(1, 0, 2)
-            value_states = value_states.transpose(1, 0, 2)
-
-            # this if statement create a chunk size for each layer of the unet
-            # the chunk size is equal to the query_length dimension of the deepest layer of the unet
-
-            flatten_latent_dim = query_states.shape[-3]
-            if flatten_latent_dim % 64 == 0:
-                query_chunk_size = int(flatten_latent_dim / 64)
-            elif flatten_latent_dim % 16 == 0:
-                query_chunk_size = int(flatten_latent_dim / 16)
-            elif flatten_latent_dim % 4 == 0:
-                query_chunk_size = int(flatten_latent_dim / 4)
-            else:
-                query_chunk_size = int(flatten_latent_dim)
-
-            hidden_states = jax_memory_efficient_attention(
-                query_states, key_states, value_states, query_chunk_size=query_chunk_size, key_chunk_size=4096 * 4
+            # dense or chunked attention, with chunk sizes fitting the memory budget of this layer's shape
+            kernel = select_attention_kernel(
+                query_states.shape[1], key_states.shape[1], query_states.shape[0], query_states.dtype
             )
-
-            hidden_states = hidden_states.transpose(1, 0, 2)
         else:
-            # compute attentions
-            attention_scores = jnp.einsum("b i d, b j d->b i j", query_states, key_states)
-            attention_scores = attention_scores * self.scale
-            attention_probs = nn.softmax(attention_scores, axis=2)
-
-            # attend to values
-            hidden_states = jnp.einsum("b i j, b j d -> b i d", attention_probs, value_states)
+            kernel = AttentionKernel("dense")
+        hidden_states = attend(query_states, key_states, value_states, self.scale, kernel)
 
-        hidden_states = self.reshape_batch_dim_to_heads(hidden_states)
+        hidden_states = self.reshape_batch_dim_to_heads(hidden_states).reshape(frames, seq_len, -1)
         hidden_states = self.proj_attn(hidden_states) + scale * self.to_out_lora(hidden_states)
         return hidden_states
 
@@ -343,6 +288,9 @@ class FlaxBasicTransformerBlock(nn.Module):
             Parameters `dtype`
         use_memory_efficient_attention (`bool`, *optional*, defaults to `False`):
             enable memory efficient attention https://arxiv.org/abs/2112.05682
+        merging_ratio (:obj:`float`, *optional*, defaults to 0.0):
+            Ratio of self-attention tokens merged with token merging (ToMe) https://arxiv.org/abs/2210.09461,
+            only in blocks of at least `MIN_MERGING_TOKENS` tokens
     """
     dim: int
     n_heads: int
@@ -351,6 +299,7 @@ class FlaxBasicTransformerBlock(nn.Module):
     only_cross_attention: bool = False
     dtype: jnp.dtype = jnp.float32
     use_memory_efficient_attention: bool = False
+    merging_ratio: float = 0.0
 
     def setup(self):
 
@@ -374,6 +323,11 @@ class FlaxBasicTransformerBlock(nn.Module):
 
         if self.only_cross_attention:
             hidden_states = self.attn1(self.norm1(hidden_states), context, deterministic=deterministic)
+        elif self.merging_ratio > 0:
+            # merge indices are shared across frames, so frame 0 tokens still match every frame's queries;
+            # blocks below MIN_MERGING_TOKENS tokens are not merged
+            merge, unmerge = frame_shared_merge_fns(hidden_states, self.merging_ratio, self.attn1.batch_size)
+            hidden_states = unmerge(self.attn1(merge(self.norm1(hidden_states)), deterministic=deterministic))
         else:
             hidden_states = self.attn1(self.norm1(hidden_states), deterministic=deterministic)
         hidden_states = hidden_states + residual
@@ -486,6 +440,8 @@ class FlaxCrossFrameTransformer2DModel(nn.Module):
             Parameters `dtype`
         use_memory_efficient_attention (`bool`, *optional*, defaults to `False`):
             enable memory efficient attention https://arxiv.org/abs/2112.05682
+        merging_ratio (:obj:`float`, *optional*, defaults to 0.0):
+            Ratio of self-attention tokens merged with token merging (ToMe) https://arxiv.org/abs/2210.09461
     """
     in_channels: int
     n_heads: int
@@ -496,6 +452,7 @@ class FlaxCrossFrameTransformer2DModel(nn.Module):
     only_cross_attention: bool = False
     dtype: jnp.dtype = jnp.float32
     use_memory_efficient_attention: bool = False
+    merging_ratio: float = 0.0
 
     def setup(self):
         self.norm = nn.GroupNorm(num_groups=32, epsilon=1e-5)
@@ -521,6 +478,7 @@ class FlaxCrossFrameTransformer2DModel(nn.Module):
                 only_cross_attention=self.only_cross_attention,
                 dtype=self.dtype,
                 use_memory_efficient_attention=self.use_memory_efficient_attention,
+                merging_ratio=self.merging_ratio,
             )
             for _ in range(self.depth)
         ]
@@ -656,3 +614,34 @@ class FlaxLoRACrossFrameTransformer2DModel(nn.Module):
 
         hidden_states = hidden_states + residual
         return hidden_states
+
+
+if __name__ == "__main__":
+    # parity of the sparse cross-frame attention against projecting and repeating frame 0 keys/values
+    # for every frame: python -m text_to_animation.models.cross_frame_attention_flax
+    import numpy as np
+
+    def repeated_anchor_attention(params, hidden_states, heads, batch_size=2):
+        params = params["params"]
+        frames, seq_len, _ = hidden_states.shape
+        video_length = frames // batch_size
+        query_proj = hidden_states @ params["to_q"]["kernel"]
+        key_proj = rearrange_4(rearrange_3(hidden_states @ params["to_k"]["kernel"], video_length)[:, [0] * video_length])
+        value_proj = rearrange_4(rearrange_3(hidden_states @ params["to_v"]["kernel"], video_length)[:, [0] * video_length])
+        split = lambda x: x.reshape(frames, seq_len, heads, -1)
+        q, k, v = split(query_proj), split(key_proj), split(value_proj)
+        scores = jnp.einsum("bihd,bjhd->bhij", q, k) * q.shape[-1] ** -0.5
+        out = jnp.einsum("bhij,bjhd->bihd", nn.softmax(scores, axis=-1), v).reshape(frames, seq_len, -1)
+        return out @ params["to_out_0"]["kernel"] + params["to_out_0"]["bias"]
+
+    key = jax.random.PRNGKey(0)
+    for video_length, seq_len, dim, heads in [(8, 256, 320, 8), (16, 64, 640, 8)]:
+        hidden_states = jax.random.normal(key, (2 * video_length, seq_len, dim))
+        for efficient in (False, True):
+            attn = FlaxCrossFrameAttention(dim, heads, dim // heads, use_memory_efficient_attention=efficient)
+            params = attn.init(key, hidden_states)
+            expected = repeated_anchor_attention(params, hidden_states, heads)
+            actual = attn.apply(params, hidden_states)
+            err = np.abs(np.asarray(expected) - np.asarray(actual)).max()
+            print(f"frames={video_length} tokens={seq_len} memory_efficient={efficient}: max abs err {err:.2e}")
+            assert np.allclose(expected, actual, atol=1e-4), err
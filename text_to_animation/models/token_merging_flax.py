@@ -0,0 +1,146 @@
+# Token Merging (ToMe, https://arxiv.org/abs/2210.09461) for the cross-frame self-attention, following
+# the bipartite soft matching of https://github.com/dbolya/tomesd.
+#
+# Merge indices are computed on the anchor frame of every video and shared by all of its frames, so that
+# the merged frame 0 keys/values used by the cross-frame attention line up with every frame's queries.
+
+import jax
+import jax.numpy as jnp
+
+
+def bipartite_soft_matching(metric, r: int):
+    """
+    metric: (b, n, c). Splits the tokens into alternating src (even) / dst (odd) sets and picks the `r`
+    src tokens most similar to a dst token. Returns the (unmerged src, merged src, their dst) indices.
+    """
+    metric = metric / jnp.linalg.norm(metric, axis=-1, keepdims=True).clip(1e-6)
+    a, b = metric[:, ::2], metric[:, 1::2]
+    scores = jnp.einsum("bic,bjc->bij", a, b)
+
+    node_max = scores.max(axis=-1)
+    node_idx = scores.argmax(axis=-1)
+    edge_idx = jnp.argsort(-node_max, axis=-1)
+
+    unm_idx = edge_idx[:, r:]
+    src_idx = edge_idx[:, :r]
+    dst_idx = jnp.take_along_axis(node_idx, src_idx, axis=-1)
+    return unm_idx, src_idx, dst_idx
+
+
+def _merge(x, unm_idx, src_idx, dst_idx):
+    src, dst = x[:, ::2], x[:, 1::2]
+    unm = jnp.take_along_axis(src, unm_idx[..., None], axis=1)
+    src = jnp.take_along_axis(src, src_idx[..., None], axis=1)
+
+    def reduce_mean(dst, src, dst_idx):
+        total = dst.astype(jnp.float32).at[dst_idx].add(src.astype(jnp.float32))
+        count = jnp.ones(dst.shape[:1], dtype=jnp.float32).at[dst_idx].add(1.0)
+        return (total / count[:, None]).astype(dst.dtype)
+
+    dst = jax.vmap(reduce_mean)(dst, src, dst_idx)
+    return jnp.concatenate([unm, dst], axis=1)
+
+
+def _unmerge(x, n, unm_idx, src_idx, dst_idx):
+    unm_len = unm_idx.shape[1]
+    unm, dst = x[:, :unm_len], x[:, unm_len:]
+    src = jnp.take_along_axis(dst, dst_idx[..., None], axis=1)
+
+    def scatter(dst, unm, src, unm_idx, src_idx):
+        out = jnp.zeros((n, x.shape[-1]), dtype=x.dtype)
+        out = out.at[1::2].set(dst)
+        out = out.at[2 * unm_idx].set(unm)
+        out = out.at[2 * src_idx].set(src)
+        return out
+
+    return jax.vmap(scatter)(dst, unm, src, unm_idx, src_idx)
+
+
+# bipartite matching merges one half of the tokens into the other, larger ratios merge as many as 0.5
+MAX_MERGING_RATIO = 0.5
+
+# like ToMe for SD, only the self-attention of the high resolution blocks is merged (64x64 and 32x32 latents
+# at 512x512): they hold nearly all of the attention cost, while the few tokens of the lower resolutions each
+# carry more of the image and their savings barely show in the UNet
+MIN_MERGING_TOKENS = 1024
+
+
+def frame_shared_merge_fns(x, ratio: float, batch_size: int = 2, min_tokens: int = MIN_MERGING_TOKENS):
+    """
+    x: (batch_size * video_length, n, c), laid out like the input of `FlaxCrossFrameAttention`.
+    Returns `merge` / `unmerge` functions that drop `int(n * ratio)` tokens (at most half of them),
+    with matching computed on frame 0 of every video and reused for its other frames. Inputs of fewer
+    than `min_tokens` tokens are left unmerged.
+    """
+    total, n, _ = x.shape
+    r = min(int(n * ratio), (n + 1) // 2)
+    if r <= 0 or n < min_tokens:
+        return (lambda y: y), (lambda y: y)
+
+    video_length = 1 if total < batch_size else total // batch_size
+    anchors = x.reshape(total // video_length, video_length, *x.shape[1:])[:, 0]
+    indices = bipartite_soft_matching(jax.lax.stop_gradient(anchors), r)
+    unm_idx, src_idx, dst_idx = (jnp.repeat(idx, video_length, axis=0) for idx in indices)
+
+    def merge(y):
+        return _merge(y, unm_idx, src_idx, dst_idx)
+
+    def unmerge(y):
+        return _unmerge(y, n, unm_idx, src_idx, dst_idx)
+
+    return merge, unmerge
+
+
+if __name__ == "__main__":
+    # throughput / memory of the self-attention of every SD 1.5 resolution at 512x512 for `video_length`
+    # frames with CFG, unmerged and merged at the largest ratio regardless of `MIN_MERGING_TOKENS`, and of
+    # the highest resolution transformer block at increasing merging ratios, with the memory efficient
+    # attention the model uses, on the current backend:
+    # python -m text_to_animation.models.token_merging_flax [video_length]
+    import sys
+    import time
+
+    from .cross_frame_attention_flax import FlaxBasicTransformerBlock, FlaxCrossFrameAttention
+
+    def measure(fn, *args):
+        compiled = jax.jit(fn).lower(*args).compile()
+        try:
+            memory = compiled.memory_analysis().temp_size_in_bytes / 2**20
+        except Exception:
+            memory = float("nan")
+        jax.block_until_ready(compiled(*args))
+        start = time.perf_counter()
+        for _ in range(5):
+            jax.block_until_ready(compiled(*args))
+        return (time.perf_counter() - start) / 5, memory
+
+    frames, heads = 2 * (int(sys.argv[1]) if len(sys.argv) > 1 else 8), 8
+    key = jax.random.PRNGKey(0)
+    for tokens, dim in [(64 * 64, 320), (32 * 32, 640), (16 * 16, 1280), (8 * 8, 1280)]:
+        hidden_states = jax.random.normal(key, (frames, tokens, dim))
+        attn = FlaxCrossFrameAttention(dim, heads, dim // heads, use_memory_efficient_attention=True)
+        params = attn.init(key, hidden_states)
+        results = []
+        for ratio in (0.0, MAX_MERGING_RATIO):
+
+            def self_attention(params, x, ratio=ratio):
+                merge, unmerge = frame_shared_merge_fns(x, ratio, min_tokens=0)
+                return unmerge(attn.apply(params, merge(x)))
+
+            results.append(measure(self_attention, params, hidden_states))
+        (plain, plain_memory), (merged, merged_memory) = results
+        print(f"tokens={tokens:5d}: unmerged {plain * 1000:8.2f} ms {plain_memory:7.1f} MiB, merged "
+              f"{merged * 1000:8.2f} ms {merged_memory:7.1f} MiB, speedup {plain / merged:5.2f}x")
+
+    tokens, dim = 64 * 64, 320
+    hidden_states = jax.random.normal(key, (frames, tokens, dim))
+    context = jax.random.normal(key, (frames, 77, 768))
+    params = FlaxBasicTransformerBlock(dim, heads, dim // heads, use_memory_efficient_attention=True).init(
+        key, hidden_states, context
+    )
+    for ratio in [0.0, 0.1, 0.2, 0.3, 0.4, 0.5]:
+        block = FlaxBasicTransformerBlock(
+            dim, heads, dim // heads, use_memory_efficient_attention=True, merging_ratio=ratio
+        )
+        elapsed, memory = measure(block.apply, params, hidden_states, context)
+        print(f"block ratio={ratio:.1f}: {frames / elapsed:8.2f} frames/s, temp memory {memory:8.1f} MiB")
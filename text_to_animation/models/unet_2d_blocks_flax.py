@@ -38,6 +38,8 @@ class FlaxCrossAttnDownBlock2D(nn.Module):
             Whether to add downsampling layer before each final output
         use_memory_efficient_attention (`bool`, *optional*, defaults to `False`):
             enable memory efficient attention https://arxiv.org/abs/2112.05682
+        merging_ratio (:obj:`float`, *optional*, defaults to 0.0):
+            Ratio of self-attention tokens merged with token merging (ToMe)
         dtype (:obj:`jnp.dtype`, *optional*, defaults to jnp.float32):
             Parameters `dtype`
     """
@@ -50,6 +52,7 @@ class FlaxCrossAttnDownBlock2D(nn.Module):
     use_linear_projection: bool = False
     only_cross_attention: bool = False
     use_memory_efficient_attention: bool = False
+    merging_ratio: float = 0.0
     dtype: jnp.dtype = jnp.float32
 
     def setup(self):
@@ -75,6 +78,7 @@ class FlaxCrossAttnDownBlock2D(nn.Module):
                 use_linear_projection=self.use_linear_projection,
                 only_cross_attention=self.only_cross_attention,
                 use_memory_efficient_attention=self.use_memory_efficient_attention,
+                merging_ratio=self.merging_ratio,
                 dtype=self.dtype,
             )
             attentions.append(attn_block)
@@ -256,6 +260,8 @@ class FlaxCrossAttnUpBlock2D(nn.Module):
             Whether to add upsampling layer before each final output
         use_memory_efficient_attention (`bool`, *optional*, defaults to `False`):
             enable memory efficient attention https://arxiv.org/abs/2112.05682
+        merging_ratio (:obj:`float`, *optional*, defaults to 0.0):
+            Ratio of self-attention tokens merged with token merging (ToMe)
         dtype (:obj:`jnp.dtype`, *optional*, defaults to jnp.float32):
             Parameters `dtype`
     """
@@ -269,6 +275,7 @@ class FlaxCrossAttnUpBlock2D(nn.Module):
     use_linear_projection: bool = False
     only_cross_attention: bool = False
     use_memory_efficient_attention: bool = False
+    merging_ratio: float = 0.0
     dtype: jnp.dtype = jnp.float32
 
     def setup(self):
@@ -295,6 +302,7 @@ class FlaxCrossAttnUpBlock2D(nn.Module):
                 use_linear_projection=self.use_linear_projection,
                 only_cross_attention=self.only_cross_attention,
                 use_memory_efficient_attention=self.use_memory_efficient_attention,
+                merging_ratio=self.merging_ratio,
                 dtype=self.dtype,
             )
             attentions.append(attn_block)
@@ -481,6 +489,8 @@ class FlaxUNetCrossAttnMidBlock2D(nn.Module):
             Number of attention heads of each spatial transformer block
         use_memory_efficient_attention (`bool`, *optional*, defaults to `False`):
             enable memory efficient attention https://arxiv.org/abs/2112.05682
+        merging_ratio (:obj:`float`, *optional*, defaults to 0.0):
+            Ratio of self-attention tokens merged with token merging (ToMe)
         dtype (:obj:`jnp.dtype`, *optional*, defaults to jnp.float32):
             Parameters `dtype`
     """
@@ -490,6 +500,7 @@ class FlaxUNetCrossAttnMidBlock2D(nn.Module):
     attn_num_head_channels: int = 1
     use_linear_projection: bool = False
     use_memory_efficient_attention: bool = False
+    merging_ratio: float = 0.0
     dtype: jnp.dtype = jnp.float32
 
     def setup(self):
@@ -513,6 +524,7 @@ class FlaxUNetCrossAttnMidBlock2D(nn.Module):
                 depth=1,
                 use_linear_projection=self.use_linear_projection,
                 use_memory_efficient_attention=self.use_memory_efficient_attention,
+                merging_ratio=self.merging_ratio,
                 dtype=self.dtype,
             )
             attentions.append(attn_block)
@@ -95,6 +95,9 @@ class FlaxUNet2DConditionModel(nn.Module, FlaxModelMixin, ConfigMixin):
         freq_shift (`int`, *optional*, defaults to 0): The frequency shift to apply to the time embedding.
         use_memory_efficient_attention (`bool`, *optional*, defaults to `False`):
             enable memory efficient attention https://arxiv.org/abs/2112.05682
+        merging_ratio (`float`, *optional*, defaults to 0.0):
+            Ratio of self-attention tokens merged with token merging (ToMe) https://arxiv.org/abs/2210.09461.
+            The higher the more compression (less memory and faster inference).
 
     """
 
@@ -119,6 +122,7 @@ class FlaxUNet2DConditionModel(nn.Module, FlaxModelMixin, ConfigMixin):
     flip_sin_to_cos: bool = True
     freq_shift: int = 0
     use_memory_efficient_attention: bool = False
+    merging_ratio: float = 0.0
 
     def init_weights(self, rng: jax.random.KeyArray) -> FrozenDict:
         # init input tensors
@@ -178,6 +182,7 @@ class FlaxUNet2DConditionModel(nn.Module, FlaxModelMixin, ConfigMixin):
                     use_linear_projection=self.use_linear_projection,
                     only_cross_attention=only_cross_attention[i],
                     use_memory_efficient_attention=self.use_memory_efficient_attention,
+                    merging_ratio=self.merging_ratio,
                     dtype=self.dtype,
                 )
             else:
@@ -200,6 +205,7 @@ class FlaxUNet2DConditionModel(nn.Module, FlaxModelMixin, ConfigMixin):
             attn_num_head_channels=attention_head_dim[-1],
             use_linear_projection=self.use_linear_projection,
             use_memory_efficient_attention=self.use_memory_efficient_attention,
+            merging_ratio=self.merging_ratio,
             dtype=self.dtype,
         )
 
@@ -228,6 +234,7 @@ class FlaxUNet2DConditionModel(nn.Module, FlaxModelMixin, ConfigMixin):
                     use_linear_projection=self.use_linear_projection,
                     only_cross_attention=only_cross_attention[i],
                     use_memory_efficient_attention=self.use_memory_efficient_attention,
+                    merging_ratio=self.merging_ratio,
                     dtype=self.dtype,
                 )
             else:
@@ -0,0 +1,137 @@
+import contextlib
+import os
+import threading
+from dataclasses import dataclass
+from typing import Iterable, Optional, Sequence
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from diffusers.utils import logging
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+
+@dataclass(frozen=True)
+class ShapeBucket:
+    # one static configuration of `_p_generate`; a change in any field means a new XLA compile
+    height: int = 512
+    width: int = 512
+    video_length: int = 8
+    num_inference_steps: int = 50
+    t0: int = 44
+    t1: int = 47
+    chunk_size: Optional[int] = 8
+    merging_ratio: float = 0.0
+
+
+DEFAULT_BUCKETS = (ShapeBucket(),)
+
+
+def enable_persistent_compilation_cache(cache_dir: str):
+    """
+    Persist compiled XLA executables to `cache_dir` so that a restarted worker loads them from disk
+    instead of recompiling the UNet+ControlNet loop.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    try:
+        jax.config.update("jax_compilation_cache_dir", cache_dir)
+        # cache everything, the denoising loop is always worth it
+        jax.config.update("jax_persistent_cache_min_compile_time_secs", 0)
+    except (AttributeError, KeyError):
+        # older jax releases only expose the experimental entry point
+        from jax.experimental.compilation_cache import compilation_cache as cc
+
+        cc.initialize_cache(cache_dir)
+
+
+def _aval_signature(tree):
+    leaves, treedef = jax.tree_util.tree_flatten(tree)
+    return treedef, tuple((np.shape(x), jnp.result_type(x).name) for x in leaves)
+
+
+def _signature(fn, args, static_argnums):
+    parts = [getattr(fn, "__name__", repr(fn))]
+    for i, arg in enumerate(args):
+        if i in static_argnums:
+            # the pipeline is hashed by identity by pmap as well
+            parts.append(("static", id(arg) if i == 0 else arg))
+        else:
+            parts.append(_aval_signature(arg))
+    return tuple(parts)
+
+
+class CompilationCache:
+    """
+    Ahead-of-time compiled executables of the pmapped generation functions, keyed by the static
+    arguments and the shapes/dtypes of the sharded inputs.
+
+    `warm_buckets` lists the `ShapeBucket`s that were compiled by a warm-up run. Calls whose inputs
+    do not match a compiled executable fall back to the regular (lazily compiled) pmap.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None):
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            enable_persistent_compilation_cache(cache_dir)
+        self._executables = {}
+        self._lock = threading.Lock()
+        # compile-only mode is per thread, requests served while another thread warms up run normally
+        self._local = threading.local()
+        self.warm_buckets = set()
+
+    def is_warm(self, bucket: ShapeBucket) -> bool:
+        return bucket in self.warm_buckets
+
+    def mark_warm(self, bucket: ShapeBucket):
+        self.warm_buckets.add(bucket)
+
+    def __len__(self):
+        return len(self._executables)
+
+    @property
+    def compiling_only(self) -> bool:
+        return getattr(self._local, "compile_only", False)
+
+    @contextlib.contextmanager
+    def compile_only(self):
+        # inside this context `call` compiles the executable and returns None instead of running it, in the
+        # current thread only
+        previous = self.compiling_only
+        self._local.compile_only = True
+        try:
+            yield self
+        finally:
+            self._local.compile_only = previous
+
+    def compile(self, fn, args: Sequence, static_argnums: Iterable[int]):
+        static_argnums = tuple(static_argnums)
+        key = _signature(fn, args, static_argnums)
+        with self._lock:
+            executable = self._executables.get(key)
+        if executable is None:
+            executable = fn.lower(*args).compile()
+            with self._lock:
+                self._executables[key] = executable
+        return executable
+
+    def call(self, fn, args: Sequence, static_argnums: Iterable[int]):
+        static_argnums = tuple(static_argnums)
+        if self.compiling_only:
+            self.compile(fn, args, static_argnums)
+            return None
+        key = _signature(fn, args, static_argnums)
+        with self._lock:
+            executable = self._executables.get(key)
+        if executable is None:
+            return fn(*args)
+        dynamic_args = [arg for i, arg in enumerate(args) if i not in static_argnums]
+        try:
+            return executable(*dynamic_args)
+        except TypeError as e:
+            # e.g. weak-typed or committed inputs that differ from the warm-up run
+            logger.warning(f"Compiled executable rejected inputs, falling back to pmap: {e}")
+            with self._lock:
+                self._executables.pop(key, None)
+            return fn(*args)
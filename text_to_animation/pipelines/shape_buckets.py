@@ -0,0 +1,139 @@
+"""
+Shape bucketing for the generation functions.
+
+Every distinct (height, width, frames) of a control video is a new static shape for `_p_generate`, i.e. a
+new XLA compile. `ShapeBucketer` maps each request onto one of a small set of canonical shapes instead: the
+control video is centered on a black canvas of the bucket size (scaled down first if it does not fit, i.e.
+letterboxed), padded with black control frames up to the bucket length, and the generated frames are cropped
+and scaled back to the real size afterwards. Cross-frame attention only attends to the first frame, so the
+padded frames do not influence the real ones; they are dropped from the output.
+"""
+from dataclasses import dataclass
+from typing import Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from .compilation_cache import ShapeBucket
+
+# (height, width, frames); `prepare_video` scales the longer side to the resolution and rounds both to 64
+DEFAULT_SHAPES = tuple(
+    (height, width, frames)
+    for frames in (8, 16)
+    for height, width in ((512, 512), (512, 384), (384, 512), (512, 320), (320, 512))
+)
+
+# latent pixels are 8x8 image pixels, offsets and scaled sizes stay aligned to them
+_ALIGNMENT = 8
+
+
+def _align(x):
+    return max(_ALIGNMENT, int(x) // _ALIGNMENT * _ALIGNMENT)
+
+
+def _align_offset(x):
+    return int(x) // _ALIGNMENT * _ALIGNMENT
+
+
+@dataclass(frozen=True)
+class BucketPlacement:
+    # where a request of `height` x `width` x `num_frames` sits inside its bucket
+    bucket: ShapeBucket
+    height: int
+    width: int
+    num_frames: int
+    # size of the (possibly scaled) content and its offset inside the bucket
+    content_height: int
+    content_width: int
+    top: int
+    left: int
+
+    @property
+    def letterboxed(self) -> bool:
+        return (self.content_height, self.content_width) != (self.height, self.width)
+
+    @property
+    def frame_mask(self) -> np.ndarray:
+        # True for the real frames of the bucket, False for padding
+        return np.arange(self.bucket.video_length) < self.num_frames
+
+    def pad(self, video: np.ndarray) -> np.ndarray:
+        """
+        video: (f, c, h, w) control frames of the request. Returns (bucket frames, c, H, W), the content
+        centered on black and followed by black frames.
+        """
+        b = self.bucket
+        f = min(len(video), b.video_length)
+        out = np.zeros((b.video_length, video.shape[1], b.height, b.width), dtype=video.dtype)
+        content = np.asarray(video[:f])
+        if self.letterboxed:
+            content = np.stack([
+                cv2.resize(frame.transpose(1, 2, 0), (self.content_width, self.content_height), interpolation=cv2.INTER_AREA)
+                .reshape(self.content_height, self.content_width, -1)
+                .transpose(2, 0, 1)
+                for frame in content
+            ])
+        out[:f, :, self.top:self.top + self.content_height, self.left:self.left + self.content_width] = content
+        return out
+
+    def crop(self, frame: np.ndarray) -> np.ndarray:
+        # (H, W, c) generated bucket frame -> (h, w, c) frame of the request
+        frame = np.asarray(frame)[self.top:self.top + self.content_height, self.left:self.left + self.content_width]
+        if self.letterboxed:
+            frame = cv2.resize(frame, (self.width, self.height), interpolation=cv2.INTER_LINEAR)
+        return frame
+
+    def crop_frames(self, frames):
+        # the real frames of an iterable of generated bucket frames, cropped; lazy for streamed frames
+        for i, frame in enumerate(frames):
+            if i >= self.num_frames:
+                break
+            yield self.crop(frame)
+
+
+class ShapeBucketer:
+    """
+    shapes: the canonical (height, width, frames), with height and width multiples of 8. A request fitting
+    into one or more of them goes to the one with the fewest pixels times frames. A request larger than all
+    buckets of sufficient length is letterboxed into the one that keeps the most of its resolution, and a
+    request longer than every bucket keeps its own length.
+    """
+
+    def __init__(self, shapes: Sequence[Tuple[int, int, int]] = DEFAULT_SHAPES):
+        self.shapes = sorted(set(tuple(int(x) for x in shape) for shape in shapes), key=lambda s: (s[0] * s[1] * s[2], s))
+
+    def buckets(self, **config):
+        # all canonical shapes as ShapeBuckets with the remaining static configuration, e.g. for warm-up
+        return [ShapeBucket(height=h, width=w, video_length=f, **config) for h, w, f in self.shapes]
+
+    def place(self, height: int, width: int, num_frames: int, **config) -> BucketPlacement:
+        """
+        `config`: the other ShapeBucket fields of the request (num_inference_steps, t0, t1, chunk_size,
+        merging_ratio).
+        """
+        long_enough = [s for s in self.shapes if s[2] >= num_frames]
+        if not long_enough:
+            # longer than every bucket: its own length (a new compile), the spatial bucket as usual
+            long_enough = [(h, w, num_frames) for h, w, _ in self.shapes]
+        fitting = [s for s in long_enough if s[0] >= height and s[1] >= width]
+        if fitting:
+            shape, scale = fitting[0], 1.0
+        else:
+            # letterbox: the largest scale at which the content fits, the smallest such bucket
+            scale, shape = max(
+                ((min(s[0] / height, s[1] / width), s) for s in long_enough),
+                key=lambda item: (item[0], -(item[1][0] * item[1][1] * item[1][2])),
+            )
+        bucket_height, bucket_width, frames = shape
+        content_height = height if scale == 1.0 else min(_align(height * scale), bucket_height)
+        content_width = width if scale == 1.0 else min(_align(width * scale), bucket_width)
+        return BucketPlacement(
+            bucket=ShapeBucket(height=bucket_height, width=bucket_width, video_length=frames, **config),
+            height=height,
+            width=width,
+            num_frames=num_frames,
+            content_height=content_height,
+            content_width=content_width,
+            top=_align_offset((bucket_height - content_height) // 2),
+            left=_align_offset((bucket_width - content_width) // 2),
+        )
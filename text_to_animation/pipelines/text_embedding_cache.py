@@ -0,0 +1,50 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def ids_digest(ids) -> str:
+    # content address of a batch of token ids, independent of how the array was produced
+    ids = np.ascontiguousarray(np.asarray(ids).astype(np.int32))
+    h = hashlib.sha1(ids.tobytes())
+    h.update(str(ids.shape).encode())
+    return h.hexdigest()
+
+
+class TextEmbeddingCache:
+    """
+    LRU cache mapping tokenized prompt ids to CLIP text embeddings, so that fixed prompts
+    (e.g. the quality prefix and the negative prompt) are only encoded once per pipeline.
+    """
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_encode(self, ids, encode_fn):
+        key = ids_digest(ids)
+        with self._lock:
+            embeds = self._entries.get(key)
+            if embeds is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return embeds
+            self.misses += 1
+        embeds = encode_fn(ids)
+        with self._lock:
+            self._entries[key] = embeds
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return embeds
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
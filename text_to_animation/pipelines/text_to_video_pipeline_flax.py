@@ -22,6 +22,10 @@ from diffusers.utils import PIL_INTERPOLATION, logging, replace_example_docstrin
 from diffusers.pipelines.pipeline_flax_utils import FlaxDiffusionPipeline
 from diffusers.pipelines.stable_diffusion import FlaxStableDiffusionPipelineOutput
 from diffusers.pipelines.stable_diffusion.safety_checker_flax import FlaxStableDiffusionSafetyChecker
+from .compilation_cache import CompilationCache
+from .text_embedding_cache import TextEmbeddingCache
+from .vae_decoding import decode_latents, pad_chunks
+from .warping import AffineMotionField, as_motion_field, grid_sample
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 """
 Text2Video-Zero:
@@ -135,6 +139,19 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
             feature_extractor=feature_extractor,
         )
         self.vae_scale_factor = 2 ** (len(self.vae.config.block_out_channels) - 1)
+        self.compilation_cache = None
+        self.text_embedding_cache = TextEmbeddingCache()
+
+    def enable_compilation_cache(self, cache_dir: Optional[str] = None):
+        # ahead-of-time compiled executables for the pmapped functions, optionally persisted on disk
+        if self.compilation_cache is None:
+            self.compilation_cache = CompilationCache(cache_dir)
+        return self.compilation_cache
+
+    def _run_pmapped(self, fn, args, static_argnums):
+        if self.compilation_cache is None:
+            return fn(*args)
+        return self.compilation_cache.call(fn, args, static_argnums)
 
     def DDPM_forward(self, params, prng, x0, t0, tMax, shape, text_embeddings):
         if x0 is None:
@@ -147,8 +164,10 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
             return xt
         
     def DDIM_backward(self, params, num_inference_steps, timesteps, skip_t, t0, t1, do_classifier_free_guidance, text_embeddings, latents_local,
-                        guidance_scale, controlnet_image=None, controlnet_conditioning_scale=None):
+                        guidance_scale, controlnet_image=None, controlnet_conditioning_scale=None, merging_ratio=0.0):
         scheduler_state = self.scheduler.set_timesteps(params["scheduler"], num_inference_steps)
+        # token merging changes the module config, the params are shared
+        unet = self.unet.clone(merging_ratio=merging_ratio) if merging_ratio > 0 else self.unet
         f = latents_local.shape[2]
         latents_local = rearrange(latents_local, "b c f h w -> (b f) c h w")
         latents = latents_local.copy()
@@ -165,7 +184,8 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
                 scheduler_state, latent_model_input, timestep=t
             )
             f = latents.shape[0]
-            te = jnp.stack([text_embeddings[0, :, :]]*f + [text_embeddings[-1,:,:]]*f)
+            # [uncond] * f + [cond] * f
+            te = jnp.repeat(text_embeddings[jnp.array([0, -1])], f, axis=0)
             timestep = jnp.broadcast_to(t, latent_model_input.shape[0])
             if controlnet_image is not None:
                 down_block_res_samples, mid_block_res_sample = self.controlnet.apply(
@@ -178,7 +198,7 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
                     return_dict=False,
                 )
                 # predict the noise residual
-                noise_pred = self.unet.apply(
+                noise_pred = unet.apply(
                     {"params": params["unet"]},
                     jnp.array(latent_model_input),
                     jnp.array(timestep, dtype=jnp.int32),
@@ -187,7 +207,7 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
                     mid_block_additional_residual=mid_block_res_sample,
                 ).sample
             else:
-                noise_pred = self.unet.apply(
+                noise_pred = unet.apply(
                     {"params": params["unet"]},
                     jnp.array(latent_model_input),
                     jnp.array(timestep, dtype=jnp.int32),
@@ -228,46 +248,58 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
             res["x_t1_1"] = x_t1_1.copy()
         return res
     
+    def DDIM_backward_chunked(self, params, num_inference_steps, timesteps, skip_t, do_classifier_free_guidance, text_embeddings, latents_local,
+                              guidance_scale, controlnet_video, controlnet_conditioning_scale, chunk_size, merging_ratio=0.0):
+        # denoise windows of `chunk_size` frames that all start with the anchor frame 0, so that the
+        # cross-frame attention still attends to it, and stitch the windows back together.
+        # Windows run one after the other in a `lax.map`, so peak memory follows `chunk_size`
+        # instead of the video length.
+        video_length = latents_local.shape[2]
+        if chunk_size < 2:
+            raise ValueError(f"`chunk_size` has to be at least 2 (anchor frame + 1) but is {chunk_size}.")
+        frames_per_window = chunk_size - 1
+        # the last frame is repeated so that every window has the same (compiled) shape
+        frame_ids, num_windows = pad_chunks(np.arange(1, video_length), frames_per_window)
+        windows = np.concatenate(
+            [np.zeros((num_windows, 1), dtype=np.int32), frame_ids.reshape(num_windows, frames_per_window)], axis=1
+        )
+
+        def denoise_window(window):
+            controlnet_image = controlnet_video[window]
+            return self.DDIM_backward(params, num_inference_steps=num_inference_steps, timesteps=timesteps, skip_t=skip_t, t0=-1, t1=-1,
+                                      do_classifier_free_guidance=do_classifier_free_guidance,
+                                      text_embeddings=text_embeddings, latents_local=latents_local[:, :, window], guidance_scale=guidance_scale,
+                                      controlnet_image=jnp.concatenate([controlnet_image] * 2),
+                                      controlnet_conditioning_scale=controlnet_conditioning_scale,
+                                      merging_ratio=merging_ratio)["x0"]
+
+        x0_windows = jax.lax.map(denoise_window, jnp.asarray(windows, dtype=jnp.int32)) # n b c k h w
+        x0 = jnp.zeros(latents_local.shape, dtype=x0_windows.dtype)
+        x0 = x0.at[:, :, 0].set(x0_windows[0, :, :, 0])
+        x0 = x0.at[:, :, windows[:, 1:].reshape(-1)].set(rearrange(x0_windows[:, :, :, 1:], "n b c k h w -> b c (n k) h w"))
+        return x0
+
     def warp_latents_independently(self, latents, reference_flow):
-        _, _, H, W = reference_flow.shape
         b, _, f, h, w = latents.shape
         assert b == 1
-        coords0 = coords_grid(f, H, W)
-        coords_t0 = coords0 + reference_flow
-        coords_t0 = coords_t0.at[:, 0].set(coords_t0[:, 0] * w / W)
-        coords_t0 = coords_t0.at[:, 1].set(coords_t0[:, 1] * h / H)
-        f, c, _, _ = coords_t0.shape
-        coords_t0 = jax.image.resize(coords_t0, (f, c, h, w), "linear")
-        coords_t0 = rearrange(coords_t0, 'f c h w -> f h w c')
+        # same sampling as torch's grid_sample(mode="nearest", padding_mode="reflection")
+        coords_t0 = as_motion_field(reference_flow).grid((h, w))
         latents_0 = rearrange(latents[0], 'c f h w -> f  c  h w')
-        warped = grid_sample(latents_0, coords_t0, "mirror")
+        warped = grid_sample(latents_0, coords_t0, mode="nearest", padding_mode="reflection")
         warped = rearrange(warped, '(b f) c h w -> b c f h w', f=f)
         return warped
 
     def warp_vid_independently(self, vid, reference_flow):
-        _, _, H, W = reference_flow.shape
         f, _, h, w = vid.shape
-        coords0 = coords_grid(f, H, W)
-        coords_t0 = coords0 + reference_flow
-        coords_t0 = coords_t0.at[:, 0].set(coords_t0[:, 0] * w / W)
-        coords_t0 = coords_t0.at[:, 1].set(coords_t0[:, 1] * h / H)
-        f, c, _, _ = coords_t0.shape
-        coords_t0 = jax.image.resize(coords_t0, (f, c, h, w), "linear")
-        coords_t0 = rearrange(coords_t0, 'f c h w -> f h w c')
-        # latents_0 = rearrange(vid, 'c f h w -> f  c  h w')
-        warped = grid_sample(vid, coords_t0, "zeropad")
-        # warped = rearrange(warped, 'f c h w -> b c f h w', f=f)
+        coords_t0 = as_motion_field(reference_flow).grid((h, w))
+        warped = grid_sample(vid, coords_t0, mode="nearest", padding_mode="zeros")
         return warped
     
     def create_motion_field(self, motion_field_strength_x, motion_field_strength_y, frame_ids, video_length, latents):
-        reference_flow = jnp.zeros(
-            (video_length-1, 2, 512, 512), dtype=latents.dtype)    
-        for fr_idx, frame_id in enumerate(frame_ids):
-            reference_flow = reference_flow.at[fr_idx, 0, :,
-                           :].set(motion_field_strength_x*(frame_id))
-            reference_flow = reference_flow.at[fr_idx, 1, :,
-                           :].set(motion_field_strength_y*(frame_id))
-        return reference_flow
+        # a global translation per frame, evaluated analytically at whatever resolution is warped
+        return AffineMotionField.translation(
+            motion_field_strength_x, motion_field_strength_y, frame_ids, reference_size=(512, 512), dtype=latents.dtype
+        )
     
     def create_motion_field_and_warp_latents(self, motion_field_strength_x, motion_field_strength_y, frame_ids, video_length, latents):
         motion_field = self.create_motion_field(motion_field_strength_x=motion_field_strength_x,
@@ -295,6 +327,9 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
                            t1: int = 47,
                            controlnet_image=None,
                            controlnet_conditioning_scale=0,
+                           chunk_size: Optional[int] = None,
+                           merging_ratio: float = 0.0,
+                           frame_axis: Optional[str] = None,
                            ):
         frame_ids = list(range(video_length))
         # Prepare timesteps
@@ -363,14 +398,31 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
             # initial_mask_warped = rearrange(initial_mask_warped, "(b f) c h w -> b c f h w", b=batch_size)
             mask = (1 - M_FG[:,:,1:]) * initial_mask_warped
             x_t1 = x_t1.at[:,:,1:].set( (1 - mask) * x_t1[:,:,1:] + mask * (initial_bg_warped * smooth_bg_strength + (1 - smooth_bg_strength) * bgs))
-            
-        ddim_res = self.DDIM_backward(params, num_inference_steps=num_inference_steps, timesteps=timesteps, skip_t=t1, t0=-1, t1=-1, do_classifier_free_guidance=do_classifier_free_guidance,
+
+        if frame_axis is not None:
+            # frame-parallel: everything up to here is identical on every device, from here on each device only
+            # denoises the anchor frame (recomputing its cross-frame keys/values) and its share of the others
+            windows = frame_parallel_windows(video_length, jax.lax.psum(1, frame_axis))
+            window = jnp.asarray(windows, dtype=jnp.int32)[jax.lax.axis_index(frame_axis)]
+            x_t1 = x_t1[:, :, window]
+            controlnet_video = controlnet_video[window]
+            controlnet_image = jnp.concatenate([controlnet_video]*2)
+            video_length = windows.shape[1]
+
+        if chunk_size is None or chunk_size >= video_length:
+            ddim_res = self.DDIM_backward(params, num_inference_steps=num_inference_steps, timesteps=timesteps, skip_t=t1, t0=-1, t1=-1, do_classifier_free_guidance=do_classifier_free_guidance,
+                                                text_embeddings=text_embeddings, latents_local=x_t1, guidance_scale=guidance_scale,
+                                                controlnet_image=controlnet_image, controlnet_conditioning_scale=controlnet_conditioning_scale,
+                                                merging_ratio=merging_ratio,
+                                         )
+            x0 = ddim_res["x0"]
+            del ddim_res
+        else:
+            x0 = self.DDIM_backward_chunked(params, num_inference_steps=num_inference_steps, timesteps=timesteps, skip_t=t1, do_classifier_free_guidance=do_classifier_free_guidance,
                                             text_embeddings=text_embeddings, latents_local=x_t1, guidance_scale=guidance_scale,
-                                            controlnet_image=controlnet_image, controlnet_conditioning_scale=controlnet_conditioning_scale,
-                                     )
+                                            controlnet_video=controlnet_video, controlnet_conditioning_scale=controlnet_conditioning_scale,
+                                            chunk_size=chunk_size, merging_ratio=merging_ratio)
         
-        x0 = ddim_res["x0"]
-        del ddim_res
         del x_t1
         del x_t1_1
         del x_t1_k
@@ -394,7 +446,8 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
                 scheduler_state, latent_model_input, timestep=t
             )
             f = latents.shape[0]
-            te = jnp.stack([text_embeddings[0, :, :]]*f + [text_embeddings[-1,:,:]]*f)
+            # [uncond] * f + [cond] * f
+            te = jnp.repeat(text_embeddings[jnp.array([0, -1])], f, axis=0)
             timestep = jnp.broadcast_to(t, latent_model_input.shape[0])
             if controlnet_image is not None:
                 down_block_res_samples, mid_block_res_sample = self.controlnet.apply(
@@ -447,7 +500,8 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
 
     def generate_starting_frames(self,
                                 params,
-                                prngs: list, #list of prngs for each img
+                                prng_seed: jax.random.KeyArray,
+                                num_imgs: int,
                                 prompt,
                                 neg_prompt,
                                 controlnet_image,
@@ -457,68 +511,64 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
                                 t0: int = 44,
                                 t1: int = 47,
                                 controlnet_conditioning_scale=1.,
+                                decode_chunk_size: Optional[int] = None,
                                 ):
-
+        """
+        Generates `num_imgs` candidate first frames conditioned on `controlnet_image[0]` in one compiled call.
+        Every candidate gets its own key split from `prng_seed`; candidates are sharded across the devices
+        and padded up to a multiple of the device count.
+        """
         height, width = controlnet_image.shape[-2:]
         if height % 64 != 0 or width % 64 != 0:
             raise ValueError(f"`height` and `width` have to be divisible by 64 but are {height} and {width}.")
 
-        shape = (self.unet.in_channels, height //
-        self.vae_scale_factor, width // self.vae_scale_factor) # c h w
-        # scale the initial noise by the standard deviation required by the scheduler
-
-        # print(f"Generating {len(prngs)} first frames with prompt {prompt}, for {num_inference_steps} steps. PRNG seeds are: {prngs}")
-
-        latents = jnp.stack([jax.random.normal(prng, shape) for prng in prngs]) # b c h w
-        latents = latents * params["scheduler"].init_noise_sigma
-
-        timesteps = params["scheduler"].timesteps
-        timesteps_ddpm = [981, 961, 941, 921, 901, 881, 861, 841, 821, 801, 781, 761, 741, 721,
-                            701, 681, 661, 641, 621, 601, 581, 561, 541, 521, 501, 481, 461, 441,
-                            421, 401, 381, 361, 341, 321, 301, 281, 261, 241, 221, 201, 181, 161,
-                            141, 121, 101,  81,  61,  41,  21,   1]
-        timesteps_ddpm.reverse()
-        t0 = timesteps_ddpm[t0]
-        t1 = timesteps_ddpm[t1]
+        # split for the requested count only, so candidates do not depend on the number of devices
+        num_devices = jax.device_count()
+        per_device = -(-num_imgs // num_devices)
+        prngs = jax.random.split(prng_seed, num_imgs)
+        prngs = jnp.concatenate([prngs, jnp.repeat(prngs[-1:], per_device * num_devices - num_imgs, axis=0)])
 
         # get prompt text embeddings
-        prompt_ids = shard(self.prepare_text_inputs(prompt))
-
-        # prompt_embeds = jax.pmap( lambda prompt_ids, params:  )(prompt_ids, params)
-
-        @jax.pmap
-        def prepare_text(params, prompt_ids, uncond_input):
-            prompt_embeds = self.text_encoder(prompt_ids, params=params["text_encoder"])[0]
-            negative_prompt_embeds = self.text_encoder(uncond_input, params=params["text_encoder"])[0]
-            text_embeddings = jnp.concatenate([negative_prompt_embeds, prompt_embeds])
-            return text_embeddings
+        prompt_ids = replicate_devices(self.prepare_text_inputs(prompt))
 
         # TODO: currently it is assumed `do_classifier_free_guidance = guidance_scale > 1.0`
         # implement this conditional `do_classifier_free_guidance = guidance_scale > 1.0`
         batch_size = 1
         max_length = prompt_ids.shape[-1]
         if neg_prompt is None:
-            uncond_input = shard(self.tokenizer(
+            uncond_input = replicate_devices(self.tokenizer(
                 [""] * batch_size, padding="max_length", max_length=max_length, return_tensors="np"
             ).input_ids)
         else:
-            neg_prompt_ids = self.prepare_text_inputs(neg_prompt)
-            uncond_input = shard(neg_prompt_ids)
-
-        text_embeddings = prepare_text(params, prompt_ids, uncond_input)
-
-        controlnet_image = shard(jnp.stack([controlnet_image[0]] * len(prngs) * 2))
+            uncond_input = replicate_devices(self.prepare_text_inputs(neg_prompt))
 
-        timesteps = shard(jnp.array(timesteps))
-        guidance_scale = shard(jnp.array(guidance_scale))
-        controlnet_conditioning_scale = shard(jnp.array(controlnet_conditioning_scale))
+        text_embeddings = jnp.concatenate([
+            self.encode_text_cached(params, uncond_input),
+            self.encode_text_cached(params, prompt_ids),
+        ], axis=1)
 
-        #latent is shape # b c h w
-        # vmap_gen_start_frame = jax.vmap(lambda latent: p_generate_starting_frames(self, num_inference_steps, params, timesteps, text_embeddings, shard(latent[None]), guidance_scale, controlnet_image, controlnet_conditioning_scale))
-        # decoded_latents = vmap_gen_start_frame(latents)
-        decoded_latents = p_generate_starting_frames(self, num_inference_steps, params, timesteps, text_embeddings, shard(latents), guidance_scale, controlnet_image, controlnet_conditioning_scale)
-        # print(f"shape output: {decoded_latents.shape}")
-        return unshard(decoded_latents)#[:, 0]
+        decoded_latents = self._run_pmapped(
+            p_generate_starting_frames,
+            (
+                self,
+                num_inference_steps,
+                params,
+                # `params` are replicated, so are the scheduler timesteps
+                params["scheduler"].timesteps,
+                text_embeddings,
+                shard(prngs),
+                replicate_devices(jnp.array(guidance_scale)),
+                # a single copy of the control image per device, broadcast to the candidates on device
+                replicate_devices(jnp.asarray(controlnet_image[0])),
+                replicate_devices(jnp.array(controlnet_conditioning_scale)),
+                decode_chunk_size,
+            ),
+            _P_GENERATE_STARTING_FRAMES_STATIC_ARGNUMS,
+        )
+        if decoded_latents is None:
+            # compile-only warm-up run
+            return None
+        return unshard(decoded_latents)[:num_imgs]
 
     def generate_video(
         self,
@@ -539,6 +589,10 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
         motion_field_strength_y: float = 4,
         t0: int = 44,
         t1: int = 47,
+        chunk_size: Optional[int] = None,
+        merging_ratio: float = 0.0,
+        decode_chunk_size: Optional[int] = None,
+        vae_tile_size: Optional[int] = None,
     ):
         r"""
         Function invoked when calling the pipeline for generation.
@@ -572,6 +626,18 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
             jit (`bool`, defaults to `False`):
                 Whether to run `pmap` versions of the generation and safety scoring functions. NOTE: This argument
                 exists because `__call__` is not yet end-to-end pmap-able. It will be removed in a future release.
+            chunk_size (`int`, *optional*):
+                Number of frames denoised at once, including the anchor first frame every window attends to.
+                Reduce for lower memory usage. By default all frames are denoised in a single batch.
+            merging_ratio (`float`, *optional*, defaults to 0.0):
+                Ratio of self-attention tokens merged with token merging (ToMe) while denoising the video frames.
+                Higher ratios are faster and use less memory at some cost in detail; 0 disables merging. At most
+                half of the tokens can be merged, ratios above 0.5 behave like 0.5.
+            decode_chunk_size (`int`, *optional*):
+                Number of frames decoded by the VAE at once. By default all frames are decoded together.
+            vae_tile_size (`int`, *optional*):
+                Decode in overlapping spatial tiles of this many latent pixels (8 image pixels each), blended
+                together. Lowers the VAE memory peak at high resolutions. Untiled by default.
         Examples:
         Returns:
             [`~pipelines.stable_diffusion.FlaxStableDiffusionPipelineOutput`] or `tuple`:
@@ -605,7 +671,7 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
                 # Assume sharded
                 controlnet_conditioning_scale = controlnet_conditioning_scale[:, None]
         if jit:
-            images = _p_generate(
+            images = self._run_pmapped(_p_generate, (
                 self,
                 replicate_devices(prompt_ids),
                 replicate_devices(image),
@@ -622,7 +688,15 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
                 replicate_devices(motion_field_strength_y),
                 t0,
                 t1,
-            )
+                chunk_size,
+                merging_ratio,
+                decode_chunk_size,
+                vae_tile_size,
+                "frames",
+            ), _P_GENERATE_STATIC_ARGNUMS)
+            if images is None:
+                # compile-only warm-up run
+                return None
         else:
             images = self._generate(
                 prompt_ids,
@@ -640,6 +714,10 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
                 motion_field_strength_y,
                 t0,
                 t1,
+                chunk_size,
+                merging_ratio,
+                decode_chunk_size,
+                vae_tile_size,
             )
         if self.safety_checker is not None:
             safety_params = params["safety_checker"]
@@ -661,6 +739,63 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
             return (images, has_nsfw_concept)
         return FlaxStableDiffusionPipelineOutput(images=images, nsfw_content_detected=has_nsfw_concept)
 
+    def encode_text_cached(self, params, prompt_ids):
+        # `params` are replicated and `prompt_ids` sharded, the fixed quality prefix and negative
+        # prompt are only pushed through the text encoder the first time they are seen
+        return self.text_embedding_cache.get_or_encode(
+            prompt_ids, lambda ids: _p_encode_text(self, params, ids)
+        )
+
+    def decode_stream(self, params, latents, decode_chunk_size: int = 4, vae_tile_size: Optional[int] = None):
+        """
+        Decodes sharded latents `(num_devices, frames, c, h, w)` (`output_type="latent"`) micro-batch by
+        micro-batch and yields the frames `(num_devices, height, width, 3)` in [0, 1] as they become ready, so
+        that consumers can start writing while the rest of the video is still being decoded.
+        """
+        num_frames = latents.shape[1]
+        latents, _ = pad_chunks(latents, decode_chunk_size, axis=1)
+        chunks = (latents[:, i:i + decode_chunk_size] for i in range(0, num_frames, decode_chunk_size))
+        # dispatch the next micro-batch before waiting on the current one
+        pending = self._decode_latents_chunk(params, next(chunks), vae_tile_size)
+        for start in range(0, num_frames, decode_chunk_size):
+            current = pending
+            if start + decode_chunk_size < num_frames:
+                pending = self._decode_latents_chunk(params, next(chunks), vae_tile_size)
+            frames = np.asarray(current)
+            for i in range(min(decode_chunk_size, num_frames - start)):
+                yield frames[:, i]
+
+    def _decode_latents_chunk(self, params, latents, vae_tile_size: Optional[int] = None):
+        # one (num_devices, frames, c, h, w) micro-batch of `decode_stream`, through the compilation cache;
+        # the latents of the denoising loop are always float32
+        return self._run_pmapped(_p_decode_latents, (self, params, latents, vae_tile_size), _P_DECODE_LATENTS_STATIC_ARGNUMS)
+
+    def decode_batch_stream(
+        self,
+        params,
+        latents,
+        video_length: int,
+        frame_parallel: bool = False,
+        decode_chunk_size: int = 4,
+        vae_tile_size: Optional[int] = None,
+    ):
+        """
+        Decodes the sharded latents of a batch of requests `(num_devices, batch_size, frames, c, h, w)` like
+        `decode_stream`, request after request, and yields `(request index, frames)` with the frames of
+        `decode_stream`, or with `frame_parallel` the (1, height, width, 3) frames of the video in order.
+        """
+        num_devices, batch_size, num_frames = latents.shape[:3]
+        frames = self.decode_stream(
+            params, latents.reshape(num_devices, batch_size * num_frames, *latents.shape[3:]), decode_chunk_size, vae_tile_size
+        )
+        for request in range(batch_size):
+            request_frames = (next(frames) for _ in range(num_frames))
+            if frame_parallel:
+                # the padding frames of the windows are decoded but dropped, keep the stream aligned
+                request_frames = frame_parallel_order(list(request_frames), video_length)
+            for frame in request_frames:
+                yield request, frame
+
     def prepare_text_inputs(self, prompt: Union[str, List[str]]):
         if not isinstance(prompt, (str, list)):
             raise ValueError(f"`prompt` has to be of type `str` or `list` but is {type(prompt)}")
@@ -723,23 +858,30 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
         motion_field_strength_y: float = 12,
         t0: int = 44,
         t1: int = 47,
+        chunk_size: Optional[int] = None,
+        merging_ratio: float = 0.0,
+        decode_chunk_size: Optional[int] = None,
+        vae_tile_size: Optional[int] = None,
+        output_type: str = "frames",
+        frame_axis: Optional[str] = None,
     ):
         height, width = image.shape[-2:]
         video_length = image.shape[0]
         if height % 64 != 0 or width % 64 != 0:
             raise ValueError(f"`height` and `width` have to be divisible by 64 but are {height} and {width}.")
         # get prompt text embeddings
-        prompt_embeds = self.text_encoder(prompt_ids, params=params["text_encoder"])[0]
+        # every frame shares the same prompt and the denoising loop only reads the first
+        # unconditional and the last conditional row, so encode one row each and broadcast it
+        prompt_embeds = self.text_encoder(prompt_ids[-1:], params=params["text_encoder"])[0]
         # TODO: currently it is assumed `do_classifier_free_guidance = guidance_scale > 1.0`
         # implement this conditional `do_classifier_free_guidance = guidance_scale > 1.0`
-        batch_size = prompt_ids.shape[0]
         max_length = prompt_ids.shape[-1]
         if neg_prompt_ids is None:
             uncond_input = self.tokenizer(
-                [""] * batch_size, padding="max_length", max_length=max_length, return_tensors="np"
+                [""], padding="max_length", max_length=max_length, return_tensors="np"
             ).input_ids
         else:
-            uncond_input = neg_prompt_ids
+            uncond_input = neg_prompt_ids[:1]
         negative_prompt_embeds = self.text_encoder(uncond_input, params=params["text_encoder"])[0]
         context = jnp.concatenate([negative_prompt_embeds, prompt_embeds])
         image = jnp.concatenate([image] * 2)
@@ -751,14 +893,17 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
                                           xT=xT, smooth_bg_strength=smooth_bg_strength, t0=t0, t1=t1,
                                           motion_field_strength_x=motion_field_strength_x,
                                           motion_field_strength_y=motion_field_strength_y,
-                                          controlnet_conditioning_scale=controlnet_conditioning_scale
+                                          controlnet_conditioning_scale=controlnet_conditioning_scale,
+                                          chunk_size=chunk_size,
+                                          merging_ratio=merging_ratio,
+                                          frame_axis=frame_axis,
                                           )
-        # scale and decode the image latents with vae
-        latents = 1 / self.vae.config.scaling_factor * latents
         latents = rearrange(latents, "b c f h w -> (b f) c h w")
-        video = self.vae.apply({"params": params["vae"]}, latents, method=self.vae.decode).sample
-        video = (video / 2 + 0.5).clip(0, 1).transpose(0, 2, 3, 1)
-        return video
+        if output_type == "latent":
+            # decoded separately, e.g. streamed by `decode_stream`
+            return latents
+        # scale and decode the image latents with vae
+        return decode_latents(self.vae, params["vae"], latents, decode_chunk_size, vae_tile_size)
     
     @replace_example_docstring(EXAMPLE_DOC_STRING)
     def __call__(
@@ -780,6 +925,13 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
         motion_field_strength_y: float = 4,
         t0: int = 44,
         t1: int = 47,
+        chunk_size: Optional[int] = None,
+        merging_ratio: float = 0.0,
+        decode_chunk_size: Optional[int] = None,
+        vae_tile_size: Optional[int] = None,
+        stream: bool = False,
+        frame_parallel: bool = False,
+        batched: bool = False,
     ):
         r"""
         Function invoked when calling the pipeline for generation.
@@ -813,6 +965,31 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
             jit (`bool`, defaults to `False`):
                 Whether to run `pmap` versions of the generation and safety scoring functions. NOTE: This argument
                 exists because `__call__` is not yet end-to-end pmap-able. It will be removed in a future release.
+            chunk_size (`int`, *optional*):
+                Number of frames denoised at once, including the anchor first frame every window attends to.
+                Reduce for lower memory usage. By default all frames are denoised in a single batch.
+            merging_ratio (`float`, *optional*, defaults to 0.0):
+                Ratio of self-attention tokens merged with token merging (ToMe) while denoising the video frames.
+                Higher ratios are faster and use less memory at some cost in detail; 0 disables merging. At most
+                half of the tokens can be merged, ratios above 0.5 behave like 0.5.
+            decode_chunk_size (`int`, *optional*):
+                Number of frames decoded by the VAE at once. By default all frames are decoded together.
+            vae_tile_size (`int`, *optional*):
+                Decode in overlapping spatial tiles of this many latent pixels (8 image pixels each), blended
+                together. Lowers the VAE memory peak at high resolutions. Untiled by default.
+            stream (`bool`, defaults to `False`):
+                Return a generator yielding the decoded frames `(num_devices, height, width, 3)` one at a time,
+                decoded `decode_chunk_size` (default 4) frames at a time, instead of the output. Requires `jit`;
+                the safety checker is not applied.
+            frame_parallel (`bool`, defaults to `False`):
+                Split the frames of a single video across the devices instead of generating the same video on
+                every one of them. Each device denoises the anchor first frame and every `num_devices`-th other
+                frame; the output holds the one video, `(1, frames, height, width, 3)`. Requires `jit`.
+            batched (`bool`, defaults to `False`):
+                The per-device inputs hold several requests of the same shape stacked along a leading axis,
+                `(num_devices, batch_size, ...)`, which are generated in a single call. Returns a generator of
+                `(request index, frames)`, the frames laid out like with `stream`, request after request.
+                Requires `stream`.
         Examples:
         Returns:
             [`~pipelines.stable_diffusion.FlaxStableDiffusionPipelineOutput`] or `tuple`:
@@ -836,8 +1013,23 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
             if len(prompt_ids.shape) > 2:
                 # Assume sharded
                 controlnet_conditioning_scale = controlnet_conditioning_scale[:, None]
+        if batched:
+            # one value per request
+            guidance_scale = jnp.broadcast_to(guidance_scale, prompt_ids.shape[:2])
+            controlnet_conditioning_scale = jnp.broadcast_to(controlnet_conditioning_scale, prompt_ids.shape[:2])
+        if batched and not stream:
+            raise ValueError("`batched=True` requires `stream=True`.")
+        if stream and not jit:
+            raise ValueError("`stream=True` requires `jit=True`.")
+        if frame_parallel and not jit:
+            raise ValueError("`frame_parallel=True` requires `jit=True`.")
         if jit:
-            images = _p_generate(
+            video_length = image.shape[-4]
+            if batched:
+                p_generate = _p_generate_batch_frames if frame_parallel else _p_generate_batch
+            else:
+                p_generate = _p_generate_frames if frame_parallel else _p_generate
+            images = self._run_pmapped(p_generate, (
                 self,
                 prompt_ids,
                 image,
@@ -854,7 +1046,28 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
                 motion_field_strength_y,
                 t0,
                 t1,
-            )
+                chunk_size,
+                merging_ratio,
+                # decoding happens in `decode_stream` when streaming, keep a single executable for it
+                None if stream else decode_chunk_size,
+                None if stream else vae_tile_size,
+                "latent" if stream else "frames",
+            ), _P_GENERATE_STATIC_ARGNUMS)
+            if images is None:
+                # compile-only warm-up run; the micro-batches of `decode_stream` are compiled as well
+                if stream:
+                    latents_shape = (image.shape[0], decode_chunk_size or 4, self.unet.in_channels,
+                                     height // self.vae_scale_factor, width // self.vae_scale_factor)
+                    self._decode_latents_chunk(params, jnp.zeros(latents_shape, dtype=jnp.float32), vae_tile_size)
+                return None
+            if batched:
+                return self.decode_batch_stream(params, images, video_length, frame_parallel, decode_chunk_size or 4, vae_tile_size)
+            if stream and frame_parallel:
+                return frame_parallel_order(self.decode_stream(params, images, decode_chunk_size or 4, vae_tile_size), video_length)
+            if stream:
+                return self.decode_stream(params, images, decode_chunk_size or 4, vae_tile_size)
+            if frame_parallel:
+                images = np.stack(list(frame_parallel_order(np.swapaxes(np.asarray(images), 0, 1), video_length)), axis=1)
         else:
             images = self._generate(
                 prompt_ids,
@@ -872,6 +1085,10 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
                 motion_field_strength_y,
                 t0,
                 t1,
+                chunk_size,
+                merging_ratio,
+                decode_chunk_size,
+                vae_tile_size,
             )
         if self.safety_checker is not None:
             safety_params = params["safety_checker"]
@@ -894,12 +1111,15 @@ class FlaxTextToVideoPipeline(FlaxDiffusionPipeline):
         return FlaxStableDiffusionPipelineOutput(images=images, nsfw_content_detected=has_nsfw_concept)
 
 
-# Static argnums are pipe, num_inference_steps. A change would trigger recompilation.
+# Static argnums are pipe, num_inference_steps, t0, t1, chunk_size, merging_ratio, decode_chunk_size,
+# vae_tile_size, output_type. A change would trigger recompilation.
 # Non-static args are (sharded) input tensors mapped over their first dimension (hence, `0`).
+_P_GENERATE_STATIC_ARGNUMS = (0, 5, 14, 15, 16, 17, 18, 19, 20)
+_P_GENERATE_IN_AXES = (None, 0, 0, 0, 0, None, 0, 0, 0, 0, 0, 0, 0, 0, None, None, None, None, None, None, None)
 @partial(
     jax.pmap,
-    in_axes=(None, 0, 0, 0, 0, None, 0, 0, 0, 0, 0, 0, 0, 0, None, None),
-    static_broadcasted_argnums=(0, 5, 14, 15)
+    in_axes=_P_GENERATE_IN_AXES,
+    static_broadcasted_argnums=_P_GENERATE_STATIC_ARGNUMS
 )
 def _p_generate(
     pipe,
@@ -918,6 +1138,11 @@ def _p_generate(
     motion_field_strength_y,
     t0,
     t1,
+    chunk_size,
+    merging_ratio,
+    decode_chunk_size,
+    vae_tile_size,
+    output_type,
 ):
     return pipe._generate(
         prompt_ids,
@@ -935,47 +1160,120 @@ def _p_generate(
         motion_field_strength_y,
         t0,
         t1,
+        chunk_size,
+        merging_ratio,
+        decode_chunk_size,
+        vae_tile_size,
+        output_type,
     )
+
+# pmap axis the frames of a video are split over by `_p_generate_frames`
+FRAME_AXIS = "frames"
+@partial(
+    jax.pmap,
+    axis_name=FRAME_AXIS,
+    in_axes=_P_GENERATE_IN_AXES,
+    static_broadcasted_argnums=_P_GENERATE_STATIC_ARGNUMS
+)
+def _p_generate_frames(pipe, *args):
+    # `_p_generate` with the same (replicated) inputs, but every device only denoises and decodes the frames
+    # of its window of `frame_parallel_windows`, (window length, ...) per device
+    return pipe._generate(*args, frame_axis=FRAME_AXIS)
+
+
+# arguments of `_generate` (after the pipe) holding one entry per request in batched generation
+_GENERATE_BATCHED_ARGNUMS = (0, 1, 3, 5, 7, 8, 10, 11, 12)
+def _generate_batch(pipe, args, frame_axis=None):
+    # `pipe._generate` vmapped over the requests stacked along the first axis of the batched arguments
+    def generate(*batched_args):
+        request_args = list(args)
+        for i, arg in zip(_GENERATE_BATCHED_ARGNUMS, batched_args):
+            request_args[i] = arg
+        return pipe._generate(*request_args, frame_axis=frame_axis)
+    return jax.vmap(generate)(*(args[i] for i in _GENERATE_BATCHED_ARGNUMS))
+
+@partial(
+    jax.pmap,
+    in_axes=_P_GENERATE_IN_AXES,
+    static_broadcasted_argnums=_P_GENERATE_STATIC_ARGNUMS
+)
+def _p_generate_batch(pipe, *args):
+    # `_p_generate` for a batch of requests of the same shape, (batch_size, ...) per device
+    return _generate_batch(pipe, args)
+
+@partial(
+    jax.pmap,
+    axis_name=FRAME_AXIS,
+    in_axes=_P_GENERATE_IN_AXES,
+    static_broadcasted_argnums=_P_GENERATE_STATIC_ARGNUMS
+)
+def _p_generate_batch_frames(pipe, *args):
+    # `_p_generate_frames` for a batch of requests of the same shape, (batch_size, window length, ...) per device
+    return _generate_batch(pipe, args, frame_axis=FRAME_AXIS)
+
+@partial(jax.pmap, static_broadcasted_argnums=(0,))
+def _p_encode_text(pipe, params, prompt_ids):
+    return pipe.text_encoder(prompt_ids, params=params["text_encoder"])[0]
+
+_P_DECODE_LATENTS_STATIC_ARGNUMS = (0, 3)
+@partial(jax.pmap, static_broadcasted_argnums=_P_DECODE_LATENTS_STATIC_ARGNUMS)
+def _p_decode_latents(pipe, params, latents, vae_tile_size):
+    return decode_latents(pipe.vae, params["vae"], latents, vae_tile_size=vae_tile_size)
+
 @partial(jax.pmap, static_broadcasted_argnums=(0,))
 def _p_get_has_nsfw_concepts(pipe, features, params):
     return pipe._get_has_nsfw_concepts(features, params)
 
+_P_GENERATE_STARTING_FRAMES_STATIC_ARGNUMS = (0, 1, 9)
 @partial(
 jax.pmap,
-in_axes=(None, None, 0, 0, 0, 0, 0, 0, 0),
-static_broadcasted_argnums=(0, 1)
+in_axes=(None, None, 0, 0, 0, 0, 0, 0, 0, None),
+static_broadcasted_argnums=_P_GENERATE_STARTING_FRAMES_STATIC_ARGNUMS
 )
-def p_generate_starting_frames(pipe, num_inference_steps, params, timesteps, text_embeddings, latents, guidance_scale, controlnet_image, controlnet_conditioning_scale):
-    #  perform ∆t backward steps by stable diffusion
-    # delta_t_diffusion = jax.vmap(lambda latent : self.DDIM_backward(params, num_inference_steps=num_inference_steps, timesteps=timesteps, skip_t=1000, t0=t0, t1=t1, do_classifier_free_guidance=do_classifier_free_guidance,
-    #                                     text_embeddings=text_embeddings, latents_local=latent, guidance_scale=guidance_scale,
-    #                                     controlnet_image=controlnet_image, controlnet_conditioning_scale=controlnet_conditioning_scale))
-    # ddim_res = delta_t_diffusion(latents)
-    # latents = ddim_res["x0"] #output is  i b c f h w
-
-    # DDPM forward for more motion freedom
-    # ddpm_fwd = jax.vmap(lambda prng, latent: self.DDPM_forward(params=params, prng=prng, x0=latent, t0=t0,
-    #                 tMax=t1, shape=shape, text_embeddings=text_embeddings))
-    # latents = ddpm_fwd(stacked_prngs, latents)
-    # main backward diffusion
-    # denoise_first_frame = lambda latent : self.DDIM_backward(params, num_inference_steps=num_inference_steps, timesteps=timesteps, skip_t=100000, t0=-1, t1=-1, do_classifier_free_guidance=do_classifier_free_guidance,
-    #                                     text_embeddings=text_embeddings, latents_local=latent, guidance_scale=guidance_scale,
-    #                                     controlnet_image=controlnet_image, controlnet_conditioning_scale=controlnet_conditioning_scale)
-    # latents = rearrange(latents, 'i b c f h w -> (i b) c f h w')
-    # ddim_res = denoise_first_frame(latents)
+def p_generate_starting_frames(pipe, num_inference_steps, params, timesteps, text_embeddings, prngs, guidance_scale, controlnet_image, controlnet_conditioning_scale, decode_chunk_size):
+    # candidate latents of this device from their keys in one call, b c h w
+    height, width = controlnet_image.shape[-2:]
+    shape = (pipe.unet.in_channels, height // pipe.vae_scale_factor, width // pipe.vae_scale_factor)
+    latents = jax.vmap(lambda prng: jax.random.normal(prng, shape))(prngs)
+    latents = latents * params["scheduler"].init_noise_sigma
+    # [uncond] * b + [cond] * b all share the same control image
+    controlnet_image = jnp.broadcast_to(controlnet_image, (2 * latents.shape[0], *controlnet_image.shape))
+
     latents = pipe.denoise_latent(params, num_inference_steps=num_inference_steps, timesteps=timesteps, do_classifier_free_guidance=True,
                                         text_embeddings=text_embeddings, latents=latents, guidance_scale=guidance_scale,
                                         controlnet_image=controlnet_image, controlnet_conditioning_scale=controlnet_conditioning_scale)
-    # latents = rearrange(ddim_res["x0"], 'i b c f h w -> (i b) c f h w') #output is  i b c f h w
 
-    # scale and decode the image latents with vae
-    latents = 1 / pipe.vae.config.scaling_factor * latents
-    # latents = rearrange(latents, "b c h w -> (b f) c h w")
-    imgs = pipe.vae.apply({"params": params["vae"]}, latents, method=pipe.vae.decode).sample
-    imgs = (imgs / 2 + 0.5).clip(0, 1).transpose(0, 2, 3, 1)
-    return imgs
+    # scale and decode the image latents with vae, `decode_chunk_size` candidates at a time
+    return decode_latents(pipe.vae, params["vae"], latents, decode_chunk_size)
 
 
+def frame_parallel_windows(video_length: int, num_devices: int):
+    """
+    The frames each device denoises in frame-parallel generation, (num_devices, window length): the anchor
+    frame 0, whose keys/values every frame attends to, followed by every `num_devices`-th frame from 1 + the
+    device index. Position i >= 1 of the windows holds consecutive frames across the devices, so the frames
+    can be streamed in order. The last frame is repeated so that every window has the same (compiled) shape.
+    """
+    frame_ids, frames_per_device = pad_chunks(np.arange(1, video_length), num_devices)
+    return np.concatenate(
+        [np.zeros((num_devices, 1), dtype=np.int32), frame_ids.reshape(frames_per_device, num_devices).T], axis=1
+    ).astype(np.int32)
+
+
+def frame_parallel_order(window_frames, video_length: int):
+    """
+    window_frames: iterable over the window positions of `frame_parallel_windows`, (num_devices, ...) each.
+    Yields the frames of the video in order as (1, ...), the layout of a single device's output.
+    """
+    emitted = 0
+    for position, frames in enumerate(window_frames):
+        # every device denoised the anchor frame, keep the one of the first
+        for frame in frames[:1] if position == 0 else frames:
+            if emitted == video_length:
+                return
+            yield frame[None]
+            emitted += 1
+
 
 def unshard(x: jnp.ndarray):
     # einops.rearrange(x, 'd b ... -> (d b) ...')
@@ -1000,38 +1298,6 @@ def prepare_latents(params, prng, batch_size, num_channels_latents, height, widt
     latents = latents * params["scheduler"].init_noise_sigma
     return latents
 
-def coords_grid(batch, ht, wd):
-    coords = jnp.meshgrid(jnp.arange(ht), jnp.arange(wd), indexing="ij")
-    coords = jnp.stack(coords[::-1], axis=0)
-    return coords[None].repeat(batch, 0)
-
-def adapt_pos_mirror(x, y, W, H):
-  #adapt the position, with mirror padding
-  x_w_mirror = ((x + W - 1) % (2*(W - 1))) - W + 1
-  x_adapted = jnp.where(x_w_mirror > 0, x_w_mirror, - (x_w_mirror))
-  y_w_mirror = ((y + H - 1) % (2*(H - 1))) - H + 1
-  y_adapted = jnp.where(y_w_mirror > 0, y_w_mirror, - (y_w_mirror))
-  return y_adapted, x_adapted
-
-def safe_get_zeropad(img, x,y,W,H):
-  return jnp.where((x < W) & (x > 0) & (y < H) & (y > 0), img[y,x], 0.)
-
-def safe_get_mirror(img, x,y,W,H):
-  return img[adapt_pos_mirror(x,y,W,H)]
-
-@partial(jax.vmap, in_axes=(0, 0, None))
-@partial(jax.vmap, in_axes=(0, None, None))
-@partial(jax.vmap, in_axes=(None,0, None))
-@partial(jax.vmap, in_axes=(None, 0, None))
-def grid_sample(latents, grid, method):
-    # this is an alternative to torch.functional.nn.grid_sample in jax
-    # this implementation is following the algorithm described @ https://pytorch.org/docs/stable/generated/torch.nn.functional.grid_sample.html
-    # but with coordinates scaled to the size of the image
-    if method == "mirror":
-      return safe_get_mirror(latents, jnp.array(grid[0], dtype=jnp.int16), jnp.array(grid[1], dtype=jnp.int16), latents.shape[0], latents.shape[1])
-    else: #default is zero padding
-      return safe_get_zeropad(latents, jnp.array(grid[0], dtype=jnp.int16), jnp.array(grid[1], dtype=jnp.int16), latents.shape[0], latents.shape[1])
-
 def bandw_vid(vid, threshold):
   vid = jnp.max(vid, axis=1)
   return jnp.where(vid > threshold, 1, 0)
@@ -1048,4 +1314,49 @@ def get_mask_pose(vid):
   vid = jax.image.resize(vid, (l, h//8, w//8), "nearest")
   vid=bandw_vid(mean_blur(vid, 7)[:,None], threshold=0.01)
   return vid/(jnp.max(vid) + 1e-4)
-  #return jax.image.resize(vid/(jnp.max(vid) + 1e-4), (l, h, w), "nearest")
\ No newline at end of file
+  #return jax.image.resize(vid/(jnp.max(vid) + 1e-4), (l, h, w), "nearest")
+
+if __name__ == "__main__":
+    # frame-parallel against single-device denoising of a stand-in UNet (cross-frame attention applied for a
+    # few steps, frame 0 the anchor), on CPU with forced host devices:
+    # XLA_FLAGS=--xla_force_host_platform_device_count=4 python -m text_to_animation.pipelines.text_to_video_pipeline_flax
+    import time
+
+    from ..models.cross_frame_attention_flax import FlaxCrossFrameAttention
+
+    num_devices = jax.device_count()
+    if num_devices == 1:
+        logger.warning("Only one device, set XLA_FLAGS=--xla_force_host_platform_device_count=N to split frames.")
+    steps, seq_len, dim, heads = 8, 256, 320, 8
+    attn = FlaxCrossFrameAttention(dim, heads, dim // heads)
+    attn_params = attn.init(jax.random.PRNGKey(0), jnp.zeros((2, seq_len, dim)))
+
+    def denoise(x):
+        # x: ((b f), tokens, dim) with b = 2 for classifier-free guidance, like the attention input of the UNet
+        return jax.lax.fori_loop(0, steps, lambda _, x: x + attn.apply(attn_params, x), x)
+
+    def denoise_window(x):
+        # the split of `text_to_video_zero` with `frame_axis`
+        windows = frame_parallel_windows(x.shape[0] // 2, jax.lax.psum(1, FRAME_AXIS))
+        window = jnp.asarray(windows, dtype=jnp.int32)[jax.lax.axis_index(FRAME_AXIS)]
+        x = rearrange(rearrange(x, "(b f) n c -> b f n c", b=2)[:, window], "b f n c -> (b f) n c")
+        return rearrange(denoise(x), "(b f) n c -> f b n c", b=2)
+
+    single = jax.jit(denoise)
+    sharded = jax.pmap(denoise_window, axis_name=FRAME_AXIS)
+    for video_length in (8, 16, 24):
+        x = jax.random.normal(jax.random.PRNGKey(video_length), (2 * video_length, seq_len, dim))
+        replicated = replicate_devices(x)
+        single(x).block_until_ready()
+        sharded(replicated).block_until_ready()
+        start = time.perf_counter()
+        expected = np.asarray(single(x).block_until_ready())
+        single_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        windows = np.swapaxes(np.asarray(sharded(replicated).block_until_ready()), 0, 1)
+        sharded_seconds = time.perf_counter() - start
+        actual = rearrange(np.concatenate(list(frame_parallel_order(windows, video_length))), "f b n c -> (b f) n c")
+        err = np.abs(expected - actual).max()
+        print(f"frames={video_length} devices={num_devices}: single {single_seconds:.3f}s, "
+              f"frame-parallel {sharded_seconds:.3f}s ({single_seconds / sharded_seconds:.2f}x), max abs err {err:.2e}")
+        assert np.allclose(expected, actual, atol=1e-4), err
@@ -0,0 +1,112 @@
+"""
+Memory-bounded VAE decoding.
+
+The VAE decoder is one of the largest activation peaks of the pipeline at 512x512. `decode_latents` decodes
+frames in micro-batches (one after the other in a `lax.map`) and optionally in overlapping spatial tiles
+that are blended back together, so peak memory follows the micro-batch and tile size instead of the
+video length and resolution.
+"""
+from functools import partial
+from itertools import product
+from typing import Optional
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+
+def pad_chunks(x, chunk_size, axis=0):
+    """
+    Repeats the last entry of `x` (a NumPy or JAX array) along `axis` until it splits into chunks of
+    `chunk_size`, so that every micro-batch has the same (compiled) shape. Returns the padded array and the
+    number of chunks.
+    """
+    length = x.shape[axis]
+    num_chunks = -(-length // chunk_size)
+    padding = num_chunks * chunk_size - length
+    if padding:
+        xp = np if isinstance(x, np.ndarray) else jnp
+        last = xp.take(x, np.array([length - 1]), axis=axis)
+        x = xp.concatenate([x, xp.repeat(last, padding, axis=axis)], axis=axis)
+    return x, num_chunks
+
+
+def _decode(vae, vae_params, latents):
+    # n c h w latents -> n c H W images in [-1, 1]
+    return vae.apply({"params": vae_params}, latents, method=vae.decode).sample
+
+
+def _tile_starts(size, tile_size, tile_overlap):
+    if size <= tile_size:
+        return [0]
+    # the last tile is shifted back to end at the border, overlapping its neighbour a bit more
+    return list(range(0, size - tile_size, tile_size - tile_overlap)) + [size - tile_size]
+
+
+def _blend_ramp(length, overlap, ramp_start, ramp_end):
+    weights = np.ones(length, dtype=np.float32)
+    ramp = (np.arange(overlap, dtype=np.float32) + 0.5) / overlap
+    if ramp_start:
+        weights[:overlap] = ramp
+    if ramp_end:
+        weights[length - overlap:] = ramp[::-1]
+    return weights
+
+
+def _decode_tiled(vae, vae_params, latents, tile_size, tile_overlap):
+    n, _, h, w = latents.shape
+    th, tw = min(tile_size, h), min(tile_size, w)
+    ys, xs = _tile_starts(h, th, tile_overlap), _tile_starts(w, tw, tile_overlap)
+    positions = list(product(ys, xs))
+    tiles = jnp.stack([latents[:, :, y:y + th, x:x + tw] for y, x in positions])
+    # tiles are decoded one after the other as well
+    decoded = jax.lax.map(partial(_decode, vae, vae_params), tiles)  # t n c TH TW
+    scale = decoded.shape[-1] // tw
+
+    out = jnp.zeros((n, decoded.shape[2], h * scale, w * scale), dtype=jnp.float32)
+    norm = np.zeros((h * scale, w * scale), dtype=np.float32)
+    for tile, (y, x) in zip(decoded, positions):
+        weight = np.outer(
+            _blend_ramp(th * scale, tile_overlap * scale, y > 0, y + th < h),
+            _blend_ramp(tw * scale, tile_overlap * scale, x > 0, x + tw < w),
+        )
+        ys_, xs_ = slice(y * scale, (y + th) * scale), slice(x * scale, (x + tw) * scale)
+        out = out.at[:, :, ys_, xs_].add(tile.astype(jnp.float32) * weight)
+        norm[ys_, xs_] += weight
+    return (out / norm).astype(decoded.dtype)
+
+
+def decode_latents(
+    vae,
+    vae_params,
+    latents,
+    decode_chunk_size: Optional[int] = None,
+    vae_tile_size: Optional[int] = None,
+    vae_tile_overlap: int = 8,
+):
+    """
+    latents: (n, c, h, w) as produced by the denoising loop. Returns images (n, H, W, 3) in [0, 1].
+
+    decode_chunk_size: number of frames decoded at once, all of them by default.
+    vae_tile_size: decode in spatial tiles of this many latent pixels, overlapping by `vae_tile_overlap`
+        latent pixels that are linearly blended. Untiled by default.
+    """
+    latents = 1 / vae.config.scaling_factor * latents
+    h, w = latents.shape[-2:]
+    if vae_tile_size is not None and vae_tile_size < max(h, w):
+        if not 0 < vae_tile_overlap < vae_tile_size:
+            raise ValueError(
+                f"`vae_tile_overlap` has to be in (0, {vae_tile_size}) but is {vae_tile_overlap}."
+            )
+        decode = partial(_decode_tiled, vae, vae_params, tile_size=vae_tile_size, tile_overlap=vae_tile_overlap)
+    else:
+        decode = partial(_decode, vae, vae_params)
+
+    n = latents.shape[0]
+    if decode_chunk_size is None or decode_chunk_size >= n:
+        images = decode(latents)
+    else:
+        latents, num_chunks = pad_chunks(latents, decode_chunk_size)
+        images = jax.lax.map(decode, latents.reshape(num_chunks, decode_chunk_size, *latents.shape[1:]))
+        images = images.reshape(num_chunks * decode_chunk_size, *images.shape[2:])[:n]
+    return (images / 2 + 0.5).clip(0, 1).transpose(0, 2, 3, 1)
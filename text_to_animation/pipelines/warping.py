@@ -0,0 +1,242 @@
+"""
+Batched warping for latents / control videos.
+
+`grid_sample` follows the semantics of `torch.nn.functional.grid_sample` (normalized grid in [-1, 1],
+last grid dim is (x, y)), but resolves every output sample of every frame and channel with a single
+flattened gather instead of per-pixel lookups.
+"""
+from functools import partial
+
+import flax
+import jax
+import jax.numpy as jnp
+
+
+def coords_grid(batch, ht, wd):
+    coords = jnp.meshgrid(jnp.arange(ht), jnp.arange(wd), indexing="ij")
+    coords = jnp.stack(coords[::-1], axis=0)
+    return coords[None].repeat(batch, 0)
+
+
+def flow_to_grid(flow, size):
+    """
+    Converts a dense flow `(f, 2, H, W)` in pixels into a normalized sampling grid `(f, h, w, 2)` at
+    resolution `size = (h, w)`, like `TextToVideoPipeline.warp_latents_independently`.
+    """
+    f, _, H, W = flow.shape
+    h, w = size
+    coords = coords_grid(f, H, W).astype(flow.dtype) + flow
+    coords = coords / jnp.array([W, H], dtype=flow.dtype)[None, :, None, None]
+    coords = coords * 2.0 - 1.0
+    if (H, W) != (h, w):
+        coords = jax.image.resize(coords, (f, 2, h, w), "linear")
+    return coords.transpose(0, 2, 3, 1)
+
+
+@flax.struct.dataclass
+class AffineMotionField:
+    """
+    Per-frame affine motion `(f, 2, 3)` in pixels of a `reference_size` (h, w) image: a pixel at
+    (x, y) samples from `params @ (x, y, 1)`. A global translation is the identity plus an offset,
+    so no dense flow tensor needs to be allocated for it.
+    """
+    params: jnp.ndarray
+    reference_size: tuple = flax.struct.field(pytree_node=False, default=(512, 512))
+
+    @classmethod
+    def translation(cls, strength_x, strength_y, frame_ids, reference_size=(512, 512), dtype=jnp.float32):
+        frame_ids = jnp.asarray(frame_ids, dtype=dtype)
+        f = frame_ids.shape[0]
+        params = jnp.broadcast_to(jnp.array([[1, 0, 0], [0, 1, 0]], dtype=dtype), (f, 2, 3))
+        params = params.at[:, 0, 2].set(strength_x * frame_ids)
+        params = params.at[:, 1, 2].set(strength_y * frame_ids)
+        return cls(params=params, reference_size=tuple(reference_size))
+
+    def __len__(self):
+        return self.params.shape[0]
+
+    def grid(self, size):
+        # evaluate directly at `size`, using the pixel centres a linear resize of the dense field would use
+        H, W = self.reference_size
+        h, w = size
+        ys = (jnp.arange(h, dtype=jnp.float32) + 0.5) * H / h - 0.5
+        xs = (jnp.arange(w, dtype=jnp.float32) + 0.5) * W / w - 0.5
+        y, x = jnp.meshgrid(ys, xs, indexing="ij")
+        points = jnp.stack([x, y, jnp.ones_like(x)], axis=-1)  # h w 3
+        coords = jnp.einsum("fij,hwj->fhwi", self.params.astype(jnp.float32), points)
+        return coords / jnp.array([W, H], dtype=jnp.float32) * 2.0 - 1.0
+
+    def to_dense(self):
+        H, W = self.reference_size
+        coords = coords_grid(len(self), H, W).astype(jnp.float32)
+        points = jnp.concatenate([coords, jnp.ones_like(coords[:, :1])], axis=1)
+        return jnp.einsum("fij,fjhw->fihw", self.params.astype(jnp.float32), points) - coords
+
+
+@flax.struct.dataclass
+class DenseMotionField:
+    # user supplied optical flow `(f, 2, H, W)` in pixels
+    flow: jnp.ndarray
+
+    def __len__(self):
+        return self.flow.shape[0]
+
+    def grid(self, size):
+        return flow_to_grid(self.flow, size)
+
+    def to_dense(self):
+        return self.flow
+
+
+def as_motion_field(motion_field):
+    if isinstance(motion_field, (AffineMotionField, DenseMotionField)):
+        return motion_field
+    return DenseMotionField(flow=motion_field)
+
+
+def _unnormalize(coord, size, align_corners):
+    if align_corners:
+        return (coord + 1) / 2 * (size - 1)
+    return ((coord + 1) * size - 1) / 2
+
+
+def _reflect(coord, twice_low, twice_high):
+    # mirrors `reflect_coordinates` of aten/src/ATen/native/GridSampler.h
+    if twice_low == twice_high:
+        return jnp.zeros_like(coord)
+    low = twice_low / 2
+    span = (twice_high - twice_low) / 2
+    coord = jnp.abs(coord - low)
+    extra = jnp.fmod(coord, span)
+    flips = jnp.floor(coord / span).astype(jnp.int32)
+    return jnp.where(flips % 2 == 0, extra + low, span - extra + low)
+
+
+def _pad_coordinates(coord, size, padding_mode, align_corners):
+    if padding_mode == "border":
+        return jnp.clip(coord, 0, size - 1)
+    if padding_mode == "reflection":
+        if align_corners:
+            coord = _reflect(coord, 0, 2 * (size - 1))
+        else:
+            coord = _reflect(coord, -1, 2 * size - 1)
+        return jnp.clip(coord, 0, size - 1)
+    return coord
+
+
+def _gather(inputs, ix, iy):
+    """
+    inputs: (n, c, h, w), ix/iy: integer indices (n, k, p). Returns (n, k, p, c) and the validity
+    mask (n, k, p); out of bounds samples read 0.
+    """
+    n, c, h, w = inputs.shape
+    valid = (ix >= 0) & (ix < w) & (iy >= 0) & (iy < h)
+    flat_index = jnp.clip(iy, 0, h - 1) * w + jnp.clip(ix, 0, w - 1)
+    flat_index = flat_index + (jnp.arange(n) * h * w)[:, None, None]
+    # channels last so that every index pulls a contiguous row of `c` values
+    table = inputs.transpose(0, 2, 3, 1).reshape(n * h * w, c)
+    values = jnp.take(table, flat_index.reshape(-1), axis=0).reshape(*flat_index.shape, c)
+    return values * valid[..., None].astype(values.dtype), valid
+
+
+@partial(jax.jit, static_argnames=("mode", "padding_mode", "align_corners"))
+def grid_sample(inputs, grid, mode="bilinear", padding_mode="zeros", align_corners=False):
+    """
+    inputs: (n, c, h, w), grid: (n, h_out, w_out, 2) with normalized (x, y) coordinates.
+    mode: "nearest" or "bilinear"; padding_mode: "zeros", "border" or "reflection".
+    Returns (n, c, h_out, w_out).
+    """
+    n, c, h, w = inputs.shape
+    _, h_out, w_out, _ = grid.shape
+    grid = grid.reshape(n, 1, h_out * w_out, 2).astype(jnp.float32)
+    x = _pad_coordinates(_unnormalize(grid[..., 0], w, align_corners), w, padding_mode, align_corners)
+    y = _pad_coordinates(_unnormalize(grid[..., 1], h, align_corners), h, padding_mode, align_corners)
+
+    if mode == "nearest":
+        # torch uses nearbyint, i.e. round half to even, same as jnp.round
+        values, _ = _gather(inputs, jnp.round(x).astype(jnp.int32), jnp.round(y).astype(jnp.int32))
+        out = values[:, 0]
+    elif mode == "bilinear":
+        x0 = jnp.floor(x)
+        y0 = jnp.floor(y)
+        wx1 = x - x0
+        wy1 = y - y0
+        wx0 = 1 - wx1
+        wy0 = 1 - wy1
+        x0 = x0.astype(jnp.int32)
+        y0 = y0.astype(jnp.int32)
+        # all four corners in one gather: nw, ne, sw, se
+        ix = jnp.concatenate([x0, x0 + 1, x0, x0 + 1], axis=1)
+        iy = jnp.concatenate([y0, y0, y0 + 1, y0 + 1], axis=1)
+        weights = jnp.concatenate([wx0 * wy0, wx1 * wy0, wx0 * wy1, wx1 * wy1], axis=1)
+        values, _ = _gather(inputs, ix, iy)
+        out = jnp.sum(values * weights[..., None].astype(values.dtype), axis=1)
+    else:
+        raise ValueError(f"Unsupported grid_sample mode {mode}")
+
+    return out.reshape(n, h_out, w_out, c).transpose(0, 3, 1, 2).astype(inputs.dtype)
+
+
+if __name__ == "__main__":
+    # parity against torch and micro-benchmark against the previous per-pixel vmap implementation
+    import time
+
+    import numpy as np
+
+    def adapt_pos_mirror(x, y, W, H):
+        x_w_mirror = ((x + W - 1) % (2 * (W - 1))) - W + 1
+        x_adapted = jnp.where(x_w_mirror > 0, x_w_mirror, -(x_w_mirror))
+        y_w_mirror = ((y + H - 1) % (2 * (H - 1))) - H + 1
+        y_adapted = jnp.where(y_w_mirror > 0, y_w_mirror, -(y_w_mirror))
+        return y_adapted, x_adapted
+
+    @partial(jax.vmap, in_axes=(0, 0))
+    @partial(jax.vmap, in_axes=(0, None))
+    @partial(jax.vmap, in_axes=(None, 0))
+    @partial(jax.vmap, in_axes=(None, 0))
+    def legacy_grid_sample(latents, grid):
+        x = jnp.array(grid[0], dtype=jnp.int16)
+        y = jnp.array(grid[1], dtype=jnp.int16)
+        return latents[adapt_pos_mirror(x, y, latents.shape[0], latents.shape[1])]
+
+    def bench(fn, *args, n=10):
+        jax.block_until_ready(fn(*args))
+        start = time.perf_counter()
+        for _ in range(n):
+            jax.block_until_ready(fn(*args))
+        return (time.perf_counter() - start) / n * 1000
+
+    try:
+        import torch
+    except ImportError as e:
+        raise SystemExit("The grid_sample parity check against torch.nn.functional.grid_sample needs torch.") from e
+
+    rng = np.random.default_rng(0)
+    for f, c, h, w in [(7, 4, 64, 64), (7, 3, 512, 512)]:
+        inputs = jnp.asarray(rng.standard_normal((f, c, h, w)), dtype=jnp.float32)
+        flow = jnp.asarray(rng.uniform(-40, 40, (f, 2, 512, 512)), dtype=jnp.float32)
+        grid = flow_to_grid(flow, (h, w))
+        pixel_grid = (coords_grid(f, h, w) + jnp.asarray(rng.uniform(-8, 8, (f, 2, h, w)))).transpose(0, 2, 3, 1)
+
+        new = jax.jit(lambda x, g: grid_sample(x, g, mode="nearest", padding_mode="reflection"))
+        legacy = jax.jit(legacy_grid_sample)
+        print(f"frames={f} channels={c} size={h}x{w}")
+        print(f"  legacy vmap grid_sample: {bench(legacy, inputs, pixel_grid):8.2f} ms")
+        print(f"  gather grid_sample (nearest): {bench(new, inputs, grid):8.2f} ms")
+        bilinear = jax.jit(lambda x, g: grid_sample(x, g, mode="bilinear", padding_mode="zeros"))
+        print(f"  gather grid_sample (bilinear): {bench(bilinear, inputs, grid):8.2f} ms")
+
+        for mode in ("nearest", "bilinear"):
+            for padding_mode in ("zeros", "reflection", "border"):
+                for align_corners in (False, True):
+                    expected = torch.nn.functional.grid_sample(
+                        torch.from_numpy(np.asarray(inputs)),
+                        torch.from_numpy(np.asarray(grid)),
+                        mode=mode,
+                        padding_mode=padding_mode,
+                        align_corners=align_corners,
+                    ).numpy()
+                    actual = np.asarray(grid_sample(inputs, grid, mode, padding_mode, align_corners))
+                    err = np.abs(expected - actual).max()
+                    print(f"  parity {mode}/{padding_mode}/align_corners={align_corners}: max abs err {err:.2e}")
+                    assert np.allclose(expected, actual, atol=1e-5), (mode, padding_mode, align_corners, err)
@@ -0,0 +1,153 @@
+"""
+On-disk cache of decoded control videos and their control (pose) maps.
+
+Entries are keyed by (video content hash, resolution, output_fps, start/end time, annotator) and stored as
+`.npy` files that are memory-mapped on load, so a cached motion clip costs neither decoding nor annotation
+nor a copy. Detected poses are stored as a keypoint `PoseSequence` of a few kilobytes instead, and their pose
+maps are rendered on load. The cache is bounded in size, least recently used entries are evicted first.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+
+import numpy as np
+
+from annotator.openpose.pose_sequence import PoseSequence
+
+# outside of "temporal", which is served by the web UI
+DEFAULT_CACHE_DIR = os.environ.get(
+    "CONTROL_MAP_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "control_animation", "control_maps")
+)
+DEFAULT_MAX_BYTES = 4 << 30
+
+
+def file_digest(path, chunk_size=1 << 20) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ControlMapCache:
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        # content hashes by (path, size, mtime), so unchanged files are only hashed once per process
+        self._digests = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _content_digest(self, video_path):
+        stat = os.stat(video_path)
+        stamp = (os.path.abspath(video_path), stat.st_size, stat.st_mtime_ns)
+        digest = self._digests.get(stamp)
+        if digest is None:
+            digest = self._digests[stamp] = file_digest(video_path)
+        return digest
+
+    def key(self, video_path, resolution, output_fps, start_t=0, end_t=-1, annotator="none") -> str:
+        parts = (self._content_digest(video_path), int(resolution), output_fps, float(start_t), float(end_t), annotator)
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        """
+        Returns `(video, control, fps)` with memory-mapped (read-only) arrays, or None.
+        """
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, "meta.json")) as f:
+                meta = json.load(f)
+            video = np.load(os.path.join(entry_dir, "video.npy"), mmap_mode="r")
+            if "poses" in meta:
+                control = self.get_poses(key).control(video.shape[-2:])
+            else:
+                control = np.load(os.path.join(entry_dir, "control.npy"), mmap_mode="r")
+            # access time for the LRU eviction, independent of the filesystem's atime setting
+            os.utime(entry_dir)
+        except (FileNotFoundError, ValueError):
+            return None
+        return video, control, meta["fps"]
+
+    def get_poses(self, key):
+        # the keypoint PoseSequence of an entry stored with `poses`, or None
+        try:
+            return PoseSequence.load(os.path.join(self._entry_dir(key), "poses.npz"))
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, video, control, fps, poses=None):
+        # with a PoseSequence `poses`, the keypoints are stored in place of the rendered `control` maps
+        entry_dir = self._entry_dir(key)
+        tmp_dir = os.path.join(self.cache_dir, f".{key}.{uuid.uuid4().hex}")
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, "video.npy"), np.ascontiguousarray(video))
+        if poses is None:
+            np.save(os.path.join(tmp_dir, "control.npy"), np.ascontiguousarray(control))
+        else:
+            poses.save(os.path.join(tmp_dir, "poses.npz"))
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump({"fps": fps, "poses": True} if poses is not None else {"fps": fps}, f)
+        try:
+            # entries appear atomically, a concurrent writer of the same key simply loses
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+
+    def get_or_compute(self, compute_fn, video_path, resolution, output_fps, start_t=0, end_t=-1, annotator="none"):
+        """
+        `compute_fn()` returns `(video, control, fps)`, or `(video, control, fps, poses)` with a PoseSequence,
+        and is only called on a miss.
+        """
+        key = self.key(video_path, resolution, output_fps, start_t, end_t, annotator)
+        entry = self.get(key)
+        with self._lock:
+            if entry is not None:
+                self.hits += 1
+                return entry
+            self.misses += 1
+        result = compute_fn()
+        self.put(key, *result)
+        entry = self.get(key)
+        # None if evicted right away, e.g. a single entry larger than the whole budget
+        return result[:3] if entry is None else entry
+
+    def entries(self):
+        # (last access, size, path) of every complete entry
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if name.startswith(".") or not os.path.isdir(entry_dir):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(entry_dir))
+            entries.append((os.stat(entry_dir).st_mtime, size, entry_dir))
+        return entries
+
+    @property
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        with self._lock:
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry_dir in entries:
+                if total <= self.max_bytes:
+                    break
+                # open memory maps stay valid after the files are unlinked
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                total -= size
+
+    def clear(self):
+        with self._lock:
+            for _, _, entry_dir in self.entries():
+                shutil.rmtree(entry_dir, ignore_errors=True)
@@ -9,7 +9,12 @@ from einops import rearrange
 import cv2
 from PIL import Image
 from annotator.util import resize_image, HWC3
+from annotator.executor import AnnotatorExecutor
 from annotator.openpose import OpenposeDetector
+from annotator.openpose.pose_sequence import PoseSequence
+from annotator.openpose.temporal import KeyframePoseDetector
+from utils.video_encoding import encode_video
+from utils.video_ingest import VideoStream
 import decord
 import jax
 import torch
@@ -65,65 +70,67 @@ def load_safetensors_model(model_link):
     return pipe
 
 
-def pre_process_pose(input_video, apply_pose_detect: bool = True):
-    detected_maps = []
-    for frame in input_video:
-        img = rearrange(frame, "c h w -> h w c").astype(np.uint8)
-        img = HWC3(img)
-        if apply_pose_detect:
-            detected_map, _ = apply_openpose(img)
-        else:
-            detected_map = img
-        detected_map = HWC3(detected_map)
-        H, W, C = img.shape
-        detected_map = cv2.resize(detected_map, (W, H), interpolation=cv2.INTER_NEAREST)
-        detected_maps.append(detected_map[None])
-    detected_maps = np.concatenate(detected_maps)
-    control = (detected_maps.copy()) / 255.0
-    return rearrange(control, "f h w c -> f c h w")
+def pose_executor(num_workers: int = None, chunk_size: int = 4) -> AnnotatorExecutor:
+    # body pose detection in worker processes, each with its own OpenposeDetector
+    return AnnotatorExecutor("openpose", num_workers, method="batch_detect", batched=True, chunk_size=chunk_size)
+
 
+def detect_poses(frames, keyframe_stride: int = 1, executor=None, **keyframe_kwargs):
+    # (candidate, subset) of every (h, w, c) uint8 frame of the iterable `frames`, all frames through the body
+    # network together; with `keyframe_stride` > 1 only keyframes are detected and the rest interpolated,
+    # `keyframe_kwargs` (refine, max_motion, min_score) go to `KeyframePoseDetector`, see temporal.py.
+    # With a `pose_executor` the frames are spread over its worker processes as they arrive instead.
+    if executor is None:
+        detect = apply_openpose.batch_detect
+    else:
+        detect = lambda frames: list(executor.map(frames))
+    if keyframe_stride > 1:
+        # keyframes and refinement pick frames by index
+        return KeyframePoseDetector(detect, stride=keyframe_stride, **keyframe_kwargs)(list(frames))
+    if executor is None:
+        return detect(list(frames))
+    return detect(frames)
+
+
+def detect_pose_sequence(input_video, fps, keyframe_stride: int = 1, executor=None, **keyframe_kwargs) -> PoseSequence:
+    # keypoints of every frame of a (f, c, h, w) video in [0, 255], see `detect_poses`
+    imgs = (
+        HWC3(np.clip(rearrange(frame, "c h w -> h w c"), 0, 255).round().astype(np.uint8)) for frame in input_video
+    )
+    poses = detect_poses(imgs, keyframe_stride=keyframe_stride, executor=executor, **keyframe_kwargs)
+    return PoseSequence(
+        [candidate for candidate, _ in poses], [subset for _, subset in poses], input_video.shape[-2:], fps
+    )
 
-def create_video(frames, fps, rescale=False, path=None, watermark=None):
-    if path is None:
-        dir = "temporal"
-        os.makedirs(dir, exist_ok=True)
-        path = os.path.join(dir, "movie.mp4")
 
-    outputs = []
-    for i, x in enumerate(frames):
-        x = torchvision.utils.make_grid(torch.Tensor(x), nrow=4)
-        if rescale:
-            x = (x + 1.0) / 2.0  # -1,1 -> 0,1
-        x = (x * 255).numpy().astype(np.uint8)
+def pre_process_pose(input_video, apply_pose_detect: bool = True, executor=None, keyframe_stride: int = 1, **keyframe_kwargs):
+    if apply_pose_detect:
+        # rendered from the keypoints, at the video resolution
+        return detect_pose_sequence(
+            input_video, fps=1, keyframe_stride=keyframe_stride, executor=executor, **keyframe_kwargs
+        ).control()
+    imgs = [HWC3(rearrange(frame, "c h w -> h w c").astype(np.uint8)) for frame in input_video]
+    control = np.stack(imgs) / 255.0
+    return rearrange(control, "f h w c -> f c h w")
 
-        if watermark is not None:
-            x = add_watermark(x, watermark)
-        outputs.append(x)
-        # imageio.imsave(os.path.join(dir, os.path.splitext(name)[0] + f'_{i}.jpg'), x)
 
-    imageio.mimsave(path, outputs, fps=fps)
-    return path
+def create_video(frames, fps, rescale=False, path=None, watermark=None, background=False):
+    # frames: iterable of HWC frames in [0, 1] (or [-1, 1] with `rescale`), written to a unique path by default
+    return encode_video(
+        frames, fps, format="mp4", path=path, rescale=rescale, watermark=watermark, background=background
+    )
 
 
-def create_gif(frames, fps, rescale=False, path=None, watermark=None):
-    if path is None:
-        dir = "temporal"
-        os.makedirs(dir, exist_ok=True)
-        path = os.path.join(dir, "canny_db.gif")
+def create_gif(frames, fps, rescale=False, path=None, watermark=None, background=False):
+    return encode_video(
+        frames, fps, format="gif", path=path, rescale=rescale, watermark=watermark, background=background
+    )
 
-    outputs = []
-    for i, x in enumerate(frames):
-        x = torchvision.utils.make_grid(torch.Tensor(x), nrow=4)
-        if rescale:
-            x = (x + 1.0) / 2.0  # -1,1 -> 0,1
-        x = (x * 255).numpy().astype(np.uint8)
-        if watermark is not None:
-            x = add_watermark(x, watermark)
-        outputs.append(x)
-        # imageio.imsave(os.path.join(dir, os.path.splitext(name)[0] + f'_{i}.jpg'), x)
 
-    imageio.mimsave(path, outputs, fps=fps)
-    return path
+def create_webp(frames, fps, rescale=False, path=None, watermark=None, background=False):
+    return encode_video(
+        frames, fps, format="webp", path=path, rescale=rescale, watermark=watermark, background=background
+    )
 
 
 def prepare_video(
@@ -135,43 +142,93 @@ def prepare_video(
     start_t: float = 0,
     end_t: float = -1,
     output_fps: int = -1,
+    chunk_size: int = 16,
+    decoder_resize: bool = False,
 ):
-    vr = decord.VideoReader(video_path)
-    initial_fps = vr.get_avg_fps()
-    if output_fps == -1:
-        output_fps = int(initial_fps)
-    if end_t == -1:
-        end_t = len(vr) / initial_fps
-    else:
-        end_t = min(len(vr) / initial_fps, end_t)
-    assert 0 <= start_t < end_t
-    assert output_fps > 0
-    start_f_ind = int(start_t * initial_fps)
-    end_f_ind = int(end_t * initial_fps)
-    num_f = int((end_t - start_t) * output_fps)
-    sample_idx = np.linspace(start_f_ind, end_f_ind, num_f, endpoint=False).astype(int)
-    video = vr.get_batch(sample_idx)
-    video = video.asnumpy()
-    _, h, w, _ = video.shape
-    video = rearrange(video, "f h w c -> f c h w")
-    video = torch.Tensor(video)  # .to(device).to(dtype)
-
-    # Use max if you want the larger side to be equal to resolution (e.g. 512)
-    # k = float(resolution) / min(h, w)
-    k = float(resolution) / max(h, w)
-    h *= k
-    w *= k
-    h = int(np.round(h / 64.0)) * 64
-    w = int(np.round(w / 64.0)) * 64
-
-    video = Resize((h, w), interpolation=InterpolationMode.BILINEAR, antialias=True)(
-        video
+    # decoded and resized `chunk_size` frames at a time, see utils/video_ingest.py; `decoder_resize` lets the
+    # decoder scale the frames, faster and leaner but not bit-identical to the antialiased Resize
+    stream = VideoStream(
+        video_path,
+        resolution,
+        start_t=start_t,
+        end_t=end_t,
+        output_fps=output_fps,
+        chunk_size=chunk_size,
+        decoder_resize=decoder_resize,
     )
+    video = stream.read()
     if normalize:
         video = video / 127.5 - 1.0
-    # video = rearrange(video, "f c h w -> f h w c").numpy() #channel first to channel last
-    video = video.numpy()
-    return video, output_fps
+    return video, stream.fps
+
+
+def prepare_control_video(
+    video_path: str,
+    resolution: int,
+    dtype,
+    output_fps: int = -1,
+    start_t: float = 0,
+    end_t: float = -1,
+    apply_pose_detect: bool = False,
+    cache=None,
+    pose_keyframe_stride: int = 1,
+    pose_keyframe_kwargs=None,
+    executor=None,
+):
+    """
+    `prepare_video` followed by `pre_process_pose`, returning `(video, control, fps)`. With a
+    `ControlMapCache` both arrays are served memory-mapped from disk after the first request; detected poses
+    are cached as keypoints and rendered on load. `pose_keyframe_stride` > 1 runs the pose detector on
+    keyframes only, with `pose_keyframe_kwargs` (refine, max_motion, min_score) passed to
+    `KeyframePoseDetector`; `executor` (see `pose_executor`) runs it in worker processes.
+    """
+
+    def compute():
+        if apply_pose_detect:
+            # the detector gets the uint8 frames of every chunk as it is decoded, the float clip is assembled
+            # from the same chunks
+            stream = VideoStream(video_path, resolution, start_t=start_t, end_t=end_t, output_fps=output_fps)
+            poses = detect_poses(
+                stream.frames(keep=True),
+                keyframe_stride=pose_keyframe_stride,
+                executor=executor,
+                **(pose_keyframe_kwargs or {}),
+            )
+            video = stream.read() if stream.video is None else stream.video
+            poses = PoseSequence(
+                [candidate for candidate, _ in poses], [subset for _, subset in poses], video.shape[-2:], stream.fps
+            )
+            return video, poses.control(), stream.fps, poses
+        video, fps = prepare_video(
+            video_path, resolution, None, dtype, False, start_t=start_t, end_t=end_t, output_fps=output_fps
+        )
+        control = pre_process_pose(video, apply_pose_detect=False).astype(np.float32)
+        return video, control, fps
+
+    if cache is None:
+        # the detected poses are only kept by the cache
+        return compute()[:3]
+    annotator = "openpose" if apply_pose_detect else "none"
+    if apply_pose_detect and pose_keyframe_stride > 1:
+        annotator += f"-keyframes{pose_keyframe_stride}"
+        # the interpolated poses depend on the thresholds as well
+        annotator += "".join(f"-{name}{value}" for name, value in sorted((pose_keyframe_kwargs or {}).items()))
+    return cache.get_or_compute(compute, video_path, resolution, output_fps, start_t, end_t, annotator)
+
+
+def prewarm_control_cache(cache, video_paths, resolution=512, output_fps=4, apply_pose_detect=False, executor=None):
+    # fill the cache for the bundled motions, e.g. at startup
+    for video_path in video_paths:
+        prepare_control_video(
+            video_path,
+            resolution,
+            None,
+            output_fps=output_fps,
+            apply_pose_detect=apply_pose_detect,
+            cache=cache,
+            executor=executor,
+        )
+    return cache.size
 
 
 def post_process_gif(list_of_results, image_resolution):
@@ -0,0 +1,171 @@
+"""
+Streaming, resolution-aware video ingest.
+
+`VideoStream` samples a clip like `prepare_video` does, but decodes it in fixed-size chunks instead of all
+sampled frames at once. With `decoder_resize` the decoder already scales the frames to the target size, so
+full resolution frames are never materialized at all; otherwise every chunk is resized with the same
+antialiased bilinear `Resize` as before, which keeps the output identical to the previous all-at-once path
+while only one chunk is held at full resolution.
+"""
+import decord
+import numpy as np
+import torch
+from torchvision.transforms import InterpolationMode, Resize
+
+
+def target_size(h, w, resolution):
+    # the larger side scaled to `resolution`, both sides rounded to multiples of 64
+    k = float(resolution) / max(h, w)
+    h *= k
+    w *= k
+    return int(np.round(h / 64.0)) * 64, int(np.round(w / 64.0)) * 64
+
+
+class VideoStream:
+    def __init__(
+        self,
+        video_path: str,
+        resolution: int,
+        start_t: float = 0,
+        end_t: float = -1,
+        output_fps: int = -1,
+        chunk_size: int = 16,
+        decoder_resize: bool = False,
+    ):
+        vr = decord.VideoReader(video_path)
+        initial_fps = vr.get_avg_fps()
+        if output_fps == -1:
+            output_fps = int(initial_fps)
+        if end_t == -1:
+            end_t = len(vr) / initial_fps
+        else:
+            end_t = min(len(vr) / initial_fps, end_t)
+        assert 0 <= start_t < end_t
+        assert output_fps > 0
+        start_f_ind = int(start_t * initial_fps)
+        end_f_ind = int(end_t * initial_fps)
+        num_f = int((end_t - start_t) * output_fps)
+        self.sample_idx = np.linspace(start_f_ind, end_f_ind, num_f, endpoint=False).astype(int)
+        self.fps = output_fps
+        self.video_path = video_path
+        self.resolution = resolution
+        self.chunk_size = chunk_size
+        self.decoder_resize = decoder_resize
+        self.video = None
+        self._source_vr = vr
+        self._source_size = None
+        self._vr = None
+
+    def __len__(self):
+        return len(self.sample_idx)
+
+    @property
+    def source_size(self):
+        if self._source_size is None:
+            # decord has no frame size metadata, so this decodes a frame; only done when the size is needed
+            # before the first chunk, e.g. to open the resizing decoder
+            self._source_size = self._source_vr[int(self.sample_idx[0]) if len(self) else 0].shape[:2]
+        return self._source_size
+
+    @property
+    def size(self):
+        return target_size(*self.source_size, self.resolution)
+
+    def _reader(self):
+        if self._vr is None:
+            if self.decoder_resize:
+                self._vr = decord.VideoReader(self.video_path, width=self.size[1], height=self.size[0])
+                self._source_vr = None
+            else:
+                self._vr = self._source_vr
+        return self._vr
+
+    def _decoded_chunks(self):
+        vr = self._reader()
+        for start in range(0, len(self.sample_idx), self.chunk_size):
+            chunk = vr.get_batch(self.sample_idx[start:start + self.chunk_size]).asnumpy()
+            if self._source_size is None:
+                self._source_size = chunk.shape[1:3]
+            yield chunk
+
+    def float_chunks(self, keep: bool = False):
+        """
+        Yields (n, c, h, w) float32 chunks in [0, 255] at the target size, the frames of `prepare_video`. With
+        `keep` they are also collected in `self.video`, (f, c, h, w) allocated at the first chunk.
+        """
+        resize = None
+        offset = 0
+        for chunk in self._decoded_chunks():
+            chunk = torch.from_numpy(chunk).permute(0, 3, 1, 2).float().contiguous()
+            if not self.decoder_resize:
+                if resize is None:
+                    resize = Resize(self.size, interpolation=InterpolationMode.BILINEAR, antialias=True)
+                chunk = resize(chunk)
+            chunk = chunk.numpy()
+            if keep:
+                if offset == 0:
+                    self.video = np.empty((len(self), *chunk.shape[1:]), dtype=np.float32)
+                self.video[offset:offset + len(chunk)] = chunk
+                offset += len(chunk)
+            yield chunk
+
+    def chunks(self, keep: bool = False):
+        # (n, h, w, c) uint8 chunks at the target size, e.g. for the annotators; with `keep` the float frames
+        # are collected in `self.video` as well, so the clip is decoded once for both
+        if self.decoder_resize and not keep:
+            yield from self._decoded_chunks()
+            return
+        for chunk in self.float_chunks(keep):
+            yield np.clip(chunk, 0, 255).round().astype(np.uint8).transpose(0, 2, 3, 1)
+
+    def frames(self, keep: bool = False):
+        # single (h, w, c) uint8 frames, e.g. for `AnnotatorExecutor.map`
+        for chunk in self.chunks(keep):
+            yield from chunk
+
+    def read(self):
+        # the whole clip as (f, c, h, w) float32 in [0, 255], allocated once at the target size
+        if not len(self):
+            return np.empty((0, 3, *self.size), dtype=np.float32)
+        for _ in self.float_chunks(keep=True):
+            pass
+        return self.video
+
+
+def _measure(args):
+    # decode time and peak RSS of one ingest mode, in a fresh process
+    import resource
+    import time
+
+    video_path, resolution, mode = args
+    start = time.perf_counter()
+    if mode == "all at once":
+        vr = decord.VideoReader(video_path)
+        video = vr.get_batch(VideoStream(video_path, resolution).sample_idx).asnumpy()
+        h, w = target_size(*video.shape[1:3], resolution)
+        video = torch.Tensor(video.transpose(0, 3, 1, 2))
+        video = Resize((h, w), interpolation=InterpolationMode.BILINEAR, antialias=True)(video).numpy()
+    else:
+        video = VideoStream(video_path, resolution, decoder_resize=mode == "decoder resize").read()
+    elapsed = time.perf_counter() - start
+    return video, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+if __name__ == "__main__":
+    # decode time, peak memory and difference to the all-at-once path on the bundled clips and, if given, a
+    # long 1080p clip: python -m utils.video_ingest [video ...]
+    import glob
+    import sys
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+
+    paths = sorted(glob.glob("__assets__/*.mp4")) + sys.argv[1:]
+    for path in paths:
+        reference = None
+        for mode in ("all at once", "chunked", "decoder resize"):
+            with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+                video, elapsed, peak = pool.submit(_measure, (path, 512, mode)).result()
+            reference = video if reference is None else reference
+            diff = np.abs(video - reference).max()
+            print(f"{path} [{mode:14s}] {len(video)} frames: {elapsed:6.2f}s, peak RSS {peak:7.1f} MiB, "
+                  f"max abs diff {diff:.2f}")
@@ -124,11 +124,11 @@ def create_demo(model: ControlAnimationModel):
                         merging_ratio = gr.Slider(
                             label="Merging ratio",
                             minimum=0.0,
-                            maximum=0.9,
+                            maximum=0.5,
                             step=0.1,
                             value=0.0,
                             visible=not on_huggingspace,
-                            info="Ratio of how many tokens are merged. The higher the more compression (less memory and faster inference).",
+                            info="Ratio of how many tokens are merged, at most half of them. The higher the more compression (less memory and faster inference).",
                         )
 
                 with gr.Column():
@@ -195,11 +195,11 @@ def create_demo(model: ControlAnimationModel):
             # t0,
             # t1,
             # negative_prompt,
-            # chunk_size,
             # video_length,
-            # merging_ratio,
             negative_prompt,
-            seed
+            seed,
+            chunk_size,
+            merging_ratio,
         ]
 
         def submit_select(initial_frame_index: int):